@@ -0,0 +1,48 @@
+"""Add refresh_tokens
+
+Revision ID: 048aac66bc1b
+Revises: b04d29277dff
+Create Date: 2022-07-09 10:41:12.508734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '048aac66bc1b'
+down_revision = 'b04d29277dff'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'refresh_tokens',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('token_hash', sa.String(), nullable=False),
+        sa.Column('family_id', sa.String(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column(
+            'created_at', sa.TIMESTAMP(timezone=True),
+            server_default=sa.text('now()'), nullable=False
+        ),
+        sa.Column('expires_at', sa.TIMESTAMP(timezone=True), nullable=False),
+        sa.Column('used_at', sa.TIMESTAMP(timezone=True), nullable=True),
+        sa.Column('revoked_at', sa.TIMESTAMP(timezone=True), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('token_hash')
+    )
+    op.create_index(
+        op.f('ix_refresh_tokens_family_id'), 'refresh_tokens', ['family_id']
+    )
+    op.create_index(
+        op.f('ix_refresh_tokens_user_id'), 'refresh_tokens', ['user_id']
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_refresh_tokens_user_id'), table_name='refresh_tokens')
+    op.drop_index(op.f('ix_refresh_tokens_family_id'), table_name='refresh_tokens')
+    op.drop_table('refresh_tokens')
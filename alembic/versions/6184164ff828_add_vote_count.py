@@ -0,0 +1,37 @@
+"""Add vote_count to posts
+
+Revision ID: 6184164ff828
+Revises: 57c93bb3a481
+Create Date: 2022-07-02 11:04:37.218311
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6184164ff828'
+down_revision = '57c93bb3a481'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        'posts',
+        sa.Column('vote_count', sa.Integer(), server_default='0', nullable=False)
+    )
+    # Backfill from the existing votes
+    op.execute(
+        '''
+        UPDATE posts SET vote_count = counts.votes
+        FROM (
+            SELECT post_id, count(*) AS votes FROM votes GROUP BY post_id
+        ) AS counts
+        WHERE posts.id = counts.post_id
+        '''
+    )
+
+
+def downgrade() -> None:
+    op.drop_column('posts', 'vote_count')
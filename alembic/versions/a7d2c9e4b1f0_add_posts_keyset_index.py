@@ -0,0 +1,35 @@
+"""Add an index on posts (created_at, id) for keyset pagination
+
+Revision ID: a7d2c9e4b1f0
+Revises: 048aac66bc1b
+Create Date: 2022-07-11 09:02:18.431260
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7d2c9e4b1f0'
+down_revision = '048aac66bc1b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # The feed pages by (created_at, id); without this index every page
+    # sorts the whole posts table. CONCURRENTLY keeps posts writable
+    # while it builds, but cannot run inside a transaction, and an
+    # interrupted build leaves the index behind marked invalid: it is
+    # dropped first so the migration can simply be rerun
+    with op.get_context().autocommit_block():
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_posts_created_at_id')
+        op.create_index(
+            'ix_posts_created_at_id', 'posts', ['created_at', 'id'],
+            postgresql_concurrently=True
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_posts_created_at_id', table_name='posts', postgresql_concurrently=True)
@@ -0,0 +1,47 @@
+"""Add full-text and trigram search on posts
+
+Revision ID: b04d29277dff
+Revises: 6184164ff828
+Create Date: 2022-07-05 18:22:51.640127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b04d29277dff'
+down_revision = '6184164ff828'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.execute(
+        '''
+        ALTER TABLE posts ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+            setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(content, '')), 'B')
+        ) STORED
+        '''
+    )
+    op.create_index(
+        'ix_posts_search_vector', 'posts', ['search_vector'],
+        postgresql_using='gin'
+    )
+    op.create_index(
+        'ix_posts_title_trgm', 'posts', ['title'],
+        postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'}
+    )
+    op.create_index(
+        'ix_posts_content_trgm', 'posts', ['content'],
+        postgresql_using='gin', postgresql_ops={'content': 'gin_trgm_ops'}
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_posts_content_trgm', table_name='posts')
+    op.drop_index('ix_posts_title_trgm', table_name='posts')
+    op.drop_index('ix_posts_search_vector', table_name='posts')
+    op.drop_column('posts', 'search_vector')
@@ -0,0 +1,38 @@
+"""Add indexes on posts.owner_id and votes.post_id
+
+Revision ID: c3e1f4a9d27b
+Revises: a7d2c9e4b1f0
+Create Date: 2022-07-11 09:14:37.920415
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3e1f4a9d27b'
+down_revision = 'a7d2c9e4b1f0'
+branch_labels = None
+depends_on = None
+
+INDEXES = (
+    ('ix_posts_owner_id', 'posts', ['owner_id']),
+    ('ix_votes_post_id', 'votes', ['post_id']),
+)
+
+
+def upgrade() -> None:
+    # Built the way a7d2c9e4b1f0 builds ix_posts_created_at_id. The
+    # (user_id, post_id) primary key cannot serve votes by post, nor can
+    # anything serve posts by owner, so deleting a user or post scanned
+    # the referencing table for its cascade
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+            op.create_index(name, table, columns, postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, columns in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
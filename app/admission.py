@@ -0,0 +1,166 @@
+'''admission.py
+
+Load shedding: per route class in-flight limits that adapt to latency;
+requests over the limit get a 503 straight away.
+'''
+import math
+import time
+
+from fastapi import status
+from fastapi.responses import ORJSONResponse
+
+from .config import settings
+
+READ = "read"
+WRITE = "write"
+AUTH = "auth"
+BULK = "bulk"
+
+# Routes whose cost differs from what their method suggests
+ROUTE_CLASSES = {
+    ("POST", "/login"): AUTH,
+    ("POST", "/users/"): AUTH,
+    ("POST", "/posts/import"): BULK,
+    ("GET", "/posts/export"): BULK,
+}
+# Never shed, so the service can still be observed while overloaded
+EXEMPT_PREFIXES = ("/metrics", "/internal", "/docs", "/redoc", "/openapi.json")
+# Open for as long as the client listens: a stream would hold its slot
+# for good, and its duration says nothing about how loaded we are
+STREAMS = ("/posts/stream",)
+
+
+def route_class(method: str, path: str):
+    '''The admission class of a request, or None if it is never shed'''
+    if (method == "OPTIONS" or path == "/" or path.startswith(EXEMPT_PREFIXES)
+            or path in STREAMS):
+        return None
+    cls = ROUTE_CLASSES.get((method, path))
+    if cls is not None:
+        return cls
+    return READ if method in ("GET", "HEAD") else WRITE
+
+
+def _ewma(average, sample: float, alpha: float):
+    return sample if average is None else average + alpha * (sample - average)
+
+
+class GradientLimit:
+    '''Concurrency limit for one route class, adjusted from latency.
+
+    short_window and long_window are the number of requests the two
+    latency averages roughly span; the limit moves once per
+    short_window requests. tolerance is how much slower than
+    the long-term average requests may get before the limit shrinks.
+    '''
+
+    def __init__(self, initial: int, min_limit: int, max_limit: int,
+                 smoothing: float = 0.2, tolerance: float = 1.5,
+                 short_window: int = 10, long_window: int = 600,
+                 backoff: float = 0.9):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.smoothing = smoothing
+        self.tolerance = tolerance
+        self.short_window = short_window
+        self.short_alpha = 2 / (short_window + 1)
+        self.long_alpha = 2 / (long_window + 1)
+        self.backoff = backoff
+        self.short_latency = None
+        self.long_latency = None
+        self.samples = 0
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    def try_acquire(self):
+        if self.in_flight >= int(self.limit):
+            self.rejected += 1
+            return False
+        self.in_flight += 1
+        self.admitted += 1
+        return True
+
+    def release(self, seconds: float, failed: bool = False):
+        '''Ends a request admitted by try_acquire and adapts the limit'''
+        in_flight = self.in_flight
+        self.in_flight -= 1
+        if failed:
+            self._set(self.limit * self.backoff)
+            return
+
+        self.short_latency = _ewma(self.short_latency, seconds, self.short_alpha)
+        self.long_latency = _ewma(self.long_latency, seconds, self.long_alpha)
+        # After a lasting drop in load the long-term average would keep
+        # the limit pinned high; let it catch up faster
+        if self.long_latency > 2 * self.short_latency:
+            self.long_latency *= 0.95
+        self.samples += 1
+        if self.samples % self.short_window:
+            return
+        # A limit the traffic is not using says nothing about capacity
+        if in_flight < self.limit / 2:
+            return
+
+        gradient = max(0.5, min(1.0, self.tolerance * self.long_latency / self.short_latency))
+        target = self.limit * gradient + math.sqrt(self.limit)
+        self._set(self.limit * (1 - self.smoothing) + target * self.smoothing)
+
+    def _set(self, limit: float):
+        self.limit = max(self.min_limit, min(self.max_limit, limit))
+
+
+def _limits():
+    return {
+        cls: GradientLimit(
+            initial=settings.admission_initial_limits.get(cls, settings.admission_min_limit),
+            min_limit=settings.admission_min_limit,
+            max_limit=settings.admission_max_limit
+        )
+        for cls in (READ, WRITE, AUTH, BULK)
+    }
+
+
+# route class -> GradientLimit, reported on /metrics
+limits = _limits()
+
+
+class AdmissionMiddleware:
+    '''Pure ASGI middleware admitting requests up to their class's limit'''
+
+    def __init__(self, app, limits: dict = limits):
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope, receive, send):
+        cls = None
+        if scope["type"] == "http" and settings.admission_control_enabled:
+            cls = route_class(scope["method"], scope["path"])
+        if cls is None:
+            await self.app(scope, receive, send)
+            return
+
+        limit = self.limits[cls]
+        if not limit.try_acquire():
+            response = ORJSONResponse(
+                {"detail": "Server busy, please retry"},
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={"Retry-After": str(settings.admission_retry_after_seconds)}
+            )
+            await response(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            limit.release(time.perf_counter() - start, failed=status_code >= 500)
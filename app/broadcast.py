@@ -0,0 +1,193 @@
+'''broadcast.py
+
+Applies cache and index events in every worker, through LISTEN/NOTIFY on
+the PostgreSQL primary.
+'''
+import asyncio
+import logging
+
+import orjson
+from sqlalchemy.engine import make_url
+
+from . import oauth2, trending
+from .config import settings
+from .database import SQLALCHEMY_DATABASE_URL, AsyncSessionLocal
+from .response_cache import response_cache
+from .trending import trending_index
+from .vote_stream import vote_stream
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "app_events"
+# NOTIFY payloads must stay under 8000 bytes
+MAX_PAYLOAD_BYTES = 7000
+# An idle connection is checked this often, so a dead one is noticed
+KEEPALIVE_SECONDS = 5
+RECONNECT_SECONDS = 1
+
+RESET = "reset"
+
+
+def _payloads(events):
+    '''JSON arrays of events, each small enough for one NOTIFY'''
+    batch, size = [], 2
+    for event in events:
+        encoded = orjson.dumps(event)
+        if batch and size + len(encoded) + 1 > MAX_PAYLOAD_BYTES:
+            yield (b"[" + b",".join(batch) + b"]").decode()
+            batch, size = [], 2
+        batch.append(encoded)
+        size += len(encoded) + 1
+    if batch:
+        yield (b"[" + b",".join(batch) + b"]").decode()
+
+
+class Broadcast:
+    '''Applies published events here and in every other worker'''
+
+    def __init__(self, dsn: str = None, channel: str = CHANNEL):
+        # None: not PostgreSQL, events stay in this worker
+        self.dsn = dsn
+        self.channel = channel
+        self.handlers = {}
+        self.stats = {"sent": 0, "received": 0, "reconnects": 0}
+        self._pending = []
+        self._wake = None
+        self._stopping = False
+        self._task = None
+
+    @property
+    def shared(self):
+        '''True if events reach the other workers'''
+        return self.dsn is not None
+
+    def on(self, kind: str, handler):
+        self.handlers[kind] = handler
+
+    def publish(self, kind: str, *args):
+        self._apply(kind, args)
+        if self._task is not None:
+            self._pending.append((kind, args))
+            self._wake.set()
+
+    def _apply(self, kind: str, args):
+        try:
+            self.handlers[kind](*args)
+        except Exception:
+            logger.exception("applying a %s event failed", kind)
+
+    def _receive(self, connection, pid, channel, payload):
+        # This worker's own NOTIFYs come back to it too
+        if pid == connection.get_server_pid():
+            return
+        for kind, args in orjson.loads(payload):
+            self.stats["received"] += 1
+            self._apply(kind, args)
+
+    async def _connect(self):
+        import asyncpg
+
+        connection = await asyncpg.connect(self.dsn)
+        try:
+            await connection.add_listener(self.channel, self._receive)
+        except BaseException:
+            connection.terminate()
+            raise
+        return connection
+
+    async def _send_forever(self, connection):
+        '''Sends pending events until stopped; raises when the
+        connection fails'''
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                await connection.execute("SELECT 1")
+                continue
+            self._wake.clear()
+            pending, self._pending = self._pending, []
+            for payload in _payloads(pending):
+                await connection.execute("SELECT pg_notify($1, $2)", self.channel, payload)
+            self.stats["sent"] += len(pending)
+            if self._stopping:
+                return
+
+    async def _run(self, connection):
+        while True:
+            if connection is not None:
+                try:
+                    await self._send_forever(connection)
+                    return
+                except Exception as exc:
+                    logger.warning("lost the broadcast connection: %s", exc)
+                finally:
+                    connection.terminate()
+            await asyncio.sleep(RECONNECT_SECONDS)
+            try:
+                connection = await self._connect()
+            except Exception as exc:
+                logger.warning("broadcast connection failed: %s", exc)
+                connection = None
+                continue
+            logger.info("broadcast connection is back, resetting every worker")
+            self.stats["reconnects"] += 1
+            # Events were lost while disconnected; the reset replaces
+            # whatever was waiting to be sent
+            self._pending = []
+            self.publish(RESET)
+
+    async def start(self):
+        '''Connects and starts sending and receiving on the running loop'''
+        if not self.shared or self._task is not None:
+            return
+        self._wake = asyncio.Event()
+        self._stopping = False
+        try:
+            connection = await self._connect()
+        except Exception as exc:
+            logger.warning("broadcast connection failed: %s", exc)
+            connection = None
+        self._task = asyncio.get_running_loop().create_task(self._run(connection))
+
+    async def stop(self):
+        '''Sends what is pending, then disconnects'''
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wake.set()
+        try:
+            await asyncio.wait_for(self._task, KEEPALIVE_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        except Exception:
+            logger.exception("broadcast task failed")
+        self._task = None
+
+
+def listen_dsn():
+    '''asyncpg DSN of the primary, or None if it is not PostgreSQL'''
+    url = make_url(settings.database_listen_url or SQLALCHEMY_DATABASE_URL)
+    if url.get_backend_name() != "postgresql":
+        return None
+    return url.set(drivername="postgresql").render_as_string(hide_password=False)
+
+
+_rebuilds = set()
+
+
+def _reset():
+    response_cache.clear()
+    oauth2.user_cache.clear()
+    rebuild = asyncio.ensure_future(trending.rebuild(AsyncSessionLocal))
+    _rebuilds.add(rebuild)
+    rebuild.add_done_callback(_rebuilds.discard)
+
+
+broadcast = Broadcast(listen_dsn())
+broadcast.on(RESET, _reset)
+broadcast.on("responses", response_cache.invalidate)
+broadcast.on("user", oauth2.invalidate_user)
+broadcast.on("trending_add", trending_index.add)
+broadcast.on("trending_vote", trending_index.vote)
+broadcast.on("trending_remove", trending_index.remove)
+broadcast.on("votes", vote_stream.publish)
@@ -0,0 +1,160 @@
+'''bulk.py
+
+Bulk post import and export, shared by the CLI and the posts router.
+'''
+import codecs
+import csv
+
+import orjson
+from pydantic import ValidationError
+from sqlalchemy import func, insert, select
+from sqlalchemy.exc import IntegrityError
+from starlette.concurrency import run_in_threadpool
+
+from . import models, schemas
+
+BATCH_SIZE = 5000
+FORMATS = ("ndjson", "csv")
+COLUMNS = ("title", "content", "published", "owner_id")
+
+
+class BulkImportError(ValueError):
+    '''A row that cannot be imported; the import is rolled back'''
+
+
+def _read_ndjson(lines):
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            row = orjson.loads(line)
+        except orjson.JSONDecodeError as exc:
+            raise BulkImportError(f"line {number}: {exc}")
+        if not isinstance(row, dict):
+            raise BulkImportError(f"line {number}: expected a JSON object")
+        yield number, row
+
+
+def _read_csv(lines):
+    reader = csv.DictReader(codecs.iterdecode(lines, "utf-8"))
+    for row in reader:
+        # Empty cells fall back to the schema defaults
+        yield reader.line_num, {key: value for key, value in row.items() if value != ""}
+
+
+def read_posts(file, format: str, owner_id: int = None):
+    '''Yields (title, content, published, owner_id) tuples from a binary file.
+
+    Rows without an owner_id are owned by owner_id.
+    '''
+    rows = _read_csv(file) if format == "csv" else _read_ndjson(file)
+    for number, row in rows:
+        row.setdefault("owner_id", owner_id)
+        try:
+            post = schemas.PostImport.parse_obj(row)
+        except ValidationError as exc:
+            errors = "; ".join(
+                f"{'.'.join(map(str, error['loc']))}: {error['msg']}"
+                for error in exc.errors()
+            )
+            raise BulkImportError(f"line {number}: {errors}")
+        yield post.title, post.content, post.published, post.owner_id
+
+
+def _batches(records, size: int):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def _read_batches(records, size: int):
+    '''Async _batches; each batch is parsed and validated in a worker thread'''
+    batches = _batches(records, size)
+    while True:
+        batch = await run_in_threadpool(next, batches, None)
+        if batch is None:
+            return
+        yield batch
+
+
+async def _copy_postgres(conn, records, batch_size: int):
+    from asyncpg.exceptions import IntegrityConstraintViolationError
+
+    ids = []
+    try:
+        async with conn.begin():
+            # Starts the driver-level transaction, so the COPYs below
+            # commit or roll back together with conn
+            await conn.exec_driver_sql("SELECT 1")
+            driver = (await conn.get_raw_connection()).driver_connection
+            async for batch in _read_batches(records, batch_size):
+                # COPY has no RETURNING, so ids are drawn from the sequence first
+                batch_ids = [row[0] for row in await driver.fetch(
+                    "SELECT nextval(pg_get_serial_sequence('posts', 'id'))"
+                    " FROM generate_series(1, $1)",
+                    len(batch)
+                )]
+                await driver.copy_records_to_table(
+                    models.Post.__tablename__,
+                    records=[(id, *record) for id, record in zip(batch_ids, batch)],
+                    columns=("id",) + COLUMNS
+                )
+                ids += batch_ids
+    except IntegrityConstraintViolationError as exc:
+        raise BulkImportError(str(exc))
+    return ids
+
+
+async def _insert_batches(conn, records, batch_size: int):
+    posts = models.Post.__table__
+    try:
+        async with conn.begin():
+            last_id = (await conn.execute(select(func.max(posts.c.id)))).scalar() or 0
+            async for batch in _read_batches(records, batch_size):
+                await conn.execute(
+                    insert(posts),
+                    [dict(zip(COLUMNS, record)) for record in batch]
+                )
+            # No RETURNING for executemany; the new rows are the ones
+            # past the highest id before the import
+            ids = (await conn.execute(
+                select(posts.c.id).where(posts.c.id > last_id).order_by(posts.c.id)
+            )).scalars().all()
+    except IntegrityError as exc:
+        raise BulkImportError(str(exc.orig))
+    return ids
+
+
+async def import_posts(engine, records, batch_size: int = BATCH_SIZE):
+    '''Inserts records from read_posts() in one transaction on an async engine.
+
+    Returns the ids of the imported posts.
+    '''
+    async with engine.connect() as conn:
+        if conn.dialect.name == "postgresql":
+            return await _copy_postgres(conn, records, batch_size)
+        return await _insert_batches(conn, records, batch_size)
+
+
+async def export_posts(db, batch_size: int = BATCH_SIZE):
+    '''Yields every post with its vote count as NDJSON, a batch per chunk'''
+    result = await db.stream(
+        select(
+            models.Post.id,
+            models.Post.title,
+            models.Post.content,
+            models.Post.published,
+            models.Post.created_at,
+            models.Post.owner_id,
+            models.Post.vote_count.label("votes"),
+        )
+        .order_by(models.Post.id)
+        .execution_options(yield_per=batch_size)
+    )
+    async for rows in result.mappings().partitions():
+        yield b"".join(orjson.dumps(dict(row)) + b"\n" for row in rows)
@@ -0,0 +1,66 @@
+'''cache.py'''
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    '''Bounded in-process LRU cache whose entries also expire.
+
+    Safe to share between the event loop and threadpool workers. Every
+    worker process has its own copy, so entries must be safe to serve
+    for up to `ttl` seconds after the source changes elsewhere.
+    '''
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        '''Returns the cached value, or default if missing or expired'''
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl: float = None):
+        '''Stores value for ttl seconds (the cache default if not given)'''
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        '''Removes key, returning its value if it was cached'''
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        '''Returns hit/miss counters and current size'''
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+        }
@@ -0,0 +1,148 @@
+'''cli.py
+
+Maintenance commands, run with `python -m app.cli <command>`.
+'''
+import argparse
+import asyncio
+import sys
+
+from sqlalchemy import delete, func, select
+
+from . import models
+from .bulk import FORMATS, BulkImportError, export_posts, import_posts, read_posts
+from .database import AsyncSessionLocal, SessionLocal, async_engine
+
+
+def repair_vote_counts(db, batch_size: int = 1000):
+    '''Recomputes posts.vote_count from votes, one id range per transaction.
+
+    Returns the number of posts whose stored count was wrong.
+    '''
+    actual = select(func.count(models.Vote.post_id)).where(
+        models.Vote.post_id == models.Post.id
+    ).scalar_subquery()
+
+    repaired = 0
+    last_id = 0
+    while True:
+        ids = [
+            id for id, in db.query(models.Post.id)
+            .filter(models.Post.id > last_id)
+            .order_by(models.Post.id)
+            .limit(batch_size)
+        ]
+        if not ids:
+            break
+        repaired += db.query(models.Post).filter(
+            models.Post.id.between(ids[0], ids[-1]),
+            models.Post.vote_count != actual
+        ).update(
+            {models.Post.vote_count: actual},
+            synchronize_session=False
+        )
+        db.commit()
+        last_id = ids[-1]
+    return repaired
+
+
+def prune_refresh_tokens(db):
+    '''Deletes expired refresh tokens; returns how many'''
+    pruned = db.execute(
+        delete(models.RefreshToken)
+        .where(models.RefreshToken.expires_at < models.now())
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.commit()
+    return pruned
+
+
+async def import_post_file(path: str, format: str, owner_id: int, batch_size: int):
+    with open(path, "rb") as file:
+        try:
+            return await import_posts(
+                async_engine,
+                read_posts(file, format, owner_id),
+                batch_size
+            )
+        finally:
+            await async_engine.dispose()
+
+
+async def export_post_file(out, batch_size: int):
+    try:
+        async with AsyncSessionLocal() as db:
+            async for chunk in export_posts(db, batch_size):
+                out.write(chunk)
+    finally:
+        await async_engine.dispose()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.cli")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    repair = commands.add_parser(
+        "repair-vote-counts",
+        help="recompute posts.vote_count from the votes table"
+    )
+    repair.add_argument("--batch-size", type=int, default=1000)
+
+    commands.add_parser(
+        "prune-refresh-tokens",
+        help="delete expired refresh tokens"
+    )
+
+    load = commands.add_parser(
+        "import-posts",
+        help="bulk load posts from an NDJSON or CSV file"
+    )
+    load.add_argument("path")
+    load.add_argument(
+        "--format", choices=FORMATS,
+        help="defaults to csv for .csv files, ndjson otherwise"
+    )
+    load.add_argument(
+        "--owner-id", type=int,
+        help="owner of rows that do not name one"
+    )
+    load.add_argument("--batch-size", type=int, default=5000)
+
+    dump = commands.add_parser(
+        "export-posts",
+        help="write every post with its vote count as NDJSON"
+    )
+    dump.add_argument("path", nargs="?", help="defaults to stdout")
+    dump.add_argument("--batch-size", type=int, default=5000)
+
+    args = parser.parse_args(argv)
+    if args.command == "import-posts":
+        format = args.format or ("csv" if args.path.endswith(".csv") else "ndjson")
+        try:
+            imported = asyncio.run(import_post_file(
+                args.path, format, args.owner_id, args.batch_size
+            ))
+        except BulkImportError as exc:
+            parser.exit(1, f"import failed, nothing was loaded: {exc}\n")
+        print(f"imported {len(imported)} posts")
+        return
+    if args.command == "export-posts":
+        if args.path:
+            with open(args.path, "wb") as out:
+                asyncio.run(export_post_file(out, args.batch_size))
+        else:
+            asyncio.run(export_post_file(sys.stdout.buffer, args.batch_size))
+        return
+
+    db = SessionLocal()
+    try:
+        if args.command == "repair-vote-counts":
+            repaired = repair_vote_counts(db, args.batch_size)
+            print(f"repaired {repaired} posts")
+        elif args.command == "prune-refresh-tokens":
+            print(f"pruned {prune_refresh_tokens(db)} refresh tokens")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
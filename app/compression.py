@@ -0,0 +1,237 @@
+'''compression.py
+
+Negotiated zstd, brotli and gzip response compression, applied by
+CompressionMiddleware and by the response cache.
+'''
+import gzip
+import logging
+import zlib
+from functools import lru_cache
+
+from .config import settings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+GZIP = "gzip"
+BROTLI = "br"
+ZSTD = "zstd"
+
+# Highest level each codec may run at
+MAX_LEVELS = {GZIP: 6, BROTLI: 5, ZSTD: 10}
+
+
+def _available():
+    codecs = [GZIP]
+    if brotli is not None:
+        codecs.insert(0, BROTLI)
+    if zstandard is not None:
+        codecs.insert(0, ZSTD)
+    return tuple(codecs)
+
+
+# Supported encodings, most preferred first
+ENCODINGS = _available()
+
+
+def _levels():
+    levels = {}
+    for encoding in (GZIP, BROTLI, ZSTD):
+        level = settings.compression_levels.get(encoding, MAX_LEVELS[encoding])
+        if level > MAX_LEVELS[encoding]:
+            logger.warning(
+                "%s compression level %d lowered to %d",
+                encoding, level, MAX_LEVELS[encoding]
+            )
+            level = MAX_LEVELS[encoding]
+        levels[encoding] = level
+    return levels
+
+
+LEVELS = _levels()
+
+
+@lru_cache(maxsize=256)
+def choose_encoding(accept_encoding: str):
+    '''The encoding to answer an Accept-Encoding header with, or None'''
+    quality = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        name = name.strip().lower()
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name:
+            quality[name] = q
+
+    best, best_q = None, 0.0
+    for encoding in ENCODINGS:
+        q = quality.get(encoding, quality.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def negotiate(headers):
+    '''The encoding for a request with these ASGI or Starlette headers'''
+    if not settings.compression_enabled:
+        return None
+    if isinstance(headers, list):
+        value = next((v for k, v in headers if k == b"accept-encoding"), b"").decode("latin-1")
+    else:
+        value = headers.get("accept-encoding", "")
+    return choose_encoding(value) if value else None
+
+
+def compressible(content_type: str, size: int):
+    '''Whether such a body is compressed for clients that accept it'''
+    if not settings.compression_enabled:
+        return False
+    media_type = content_type.partition(";")[0].strip().lower()
+    return size >= settings.compression_min_bytes and media_type in settings.compression_types
+
+
+def compress(encoding: str, data: bytes):
+    level = LEVELS[encoding]
+    if encoding == ZSTD:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    if encoding == BROTLI:
+        return brotli.compress(data, quality=level)
+    # mtime=0 makes the output depend on the body alone
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+class _GzipStream:
+    def __init__(self, level: int):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes):
+        return self._compressor.compress(data)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class _BrotliStream:
+    def __init__(self, level: int):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes):
+        return self._compressor.process(data)
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class _ZstdStream:
+    def __init__(self, level: int):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes):
+        return self._compressor.compress(data)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+STREAMS = {GZIP: _GzipStream, BROTLI: _BrotliStream, ZSTD: _ZstdStream}
+
+
+def weak_etag(etag: str):
+    '''A compressed body is a different representation, so its ETag is weak'''
+    return etag if etag.startswith("W/") else "W/" + etag
+
+
+def _vary_headers(headers):
+    '''Response headers for a compressible body sent as it is'''
+    if (b"vary", b"Accept-Encoding") in headers:
+        return headers
+    return [*headers, (b"vary", b"Accept-Encoding")]
+
+
+def _encoded_headers(headers, encoding: str, length):
+    '''Response headers for the compressed body; length None when streamed'''
+    result = []
+    for name, value in headers:
+        if name == b"content-length" or (name == b"vary" and value == b"Accept-Encoding"):
+            continue
+        if name == b"etag":
+            value = weak_etag(value.decode("latin-1")).encode("latin-1")
+        result.append((name, value))
+    result.append((b"content-encoding", encoding.encode()))
+    result.append((b"vary", b"Accept-Encoding"))
+    if length is not None:
+        result.append((b"content-length", str(length).encode()))
+    return result
+
+
+class CompressionMiddleware:
+    '''Pure ASGI middleware compressing responses the client accepts'''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.compression_enabled:
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate(scope["headers"])
+
+        start = None
+        stream = None
+
+        async def send_wrapper(message):
+            nonlocal start, stream
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start is not None:
+                headers = start["headers"]
+                names = {name for name, value in headers}
+                content_type = next(
+                    (value.decode("latin-1") for name, value in headers if name == b"content-type"), ""
+                )
+                # A streamed body counts as large; its first chunk may not be
+                size = len(body) if not more_body else settings.compression_min_bytes
+                if (b"content-encoding" in names or start["status"] in (204, 304)
+                        or not compressible(content_type, size)):
+                    await send(start)
+                elif encoding is None:
+                    # Caches must not hand this body to clients that accept compression
+                    await send({**start, "headers": _vary_headers(headers)})
+                elif not more_body:
+                    body = compress(encoding, body)
+                    await send({**start, "headers": _encoded_headers(headers, encoding, len(body))})
+                else:
+                    stream = STREAMS[encoding](LEVELS[encoding])
+                    await send({**start, "headers": _encoded_headers(headers, encoding, None)})
+                start = None
+
+            if stream is not None:
+                body = stream.compress(body)
+                if not more_body:
+                    body += stream.finish()
+            await send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+        await self.app(scope, receive, send_wrapper)
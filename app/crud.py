@@ -1,10 +1,186 @@
-# create_user(db=db, user=user)
+'''crud.py
 
+Post and user reads and writes used by the routers, one statement per
+write.
+'''
+from sqlalchemy import delete, insert, select, union, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 
-# get_users(db, skip=skip, limit=limit)
+from . import models
 
-# get_user(db, user_id=user_id)
+posts = models.Post.__table__
+users = models.User.__table__
+votes = models.Vote.__table__
 
-# create_user_item(db=db, item=item, user_id=user_id)
+# Columns handed back by user writes, never the password hash
+USER_COLUMNS = (users.c.id, users.c.email, users.c.created_at)
 
-# crud.get_items(db, skip=skip, limit=limit)
+
+def _returning(db):
+    return db.get_bind().dialect.full_returning
+
+
+async def _write_one(db, statement, columns, reselect):
+    '''Runs statement and returns the row it wrote, or None if none matched.
+
+    reselect(key) is the fallback SELECT for dialects without RETURNING;
+    key is the new primary key of an insert, otherwise None.
+    '''
+    if _returning(db):
+        row = (await db.execute(statement.returning(*columns))).first()
+    else:
+        result = await db.execute(statement)
+        if result.rowcount == 0:
+            row = None
+        else:
+            key = result.inserted_primary_key if statement.is_insert else None
+            row = (await db.execute(reselect(key))).first()
+    await db.commit()
+    return row
+
+
+async def _delete_one(db, statement, key_column):
+    '''Runs a DELETE and returns True if it removed a row'''
+    if _returning(db):
+        result = await db.execute(statement.returning(key_column))
+        deleted = result.first() is not None
+    else:
+        deleted = (await db.execute(statement)).rowcount > 0
+    await db.commit()
+    return deleted
+
+
+# Every post response embeds its owner. A many-to-one join adds no rows,
+# so joining keeps a page at one statement where selectinload would
+# take two; owner_id is NOT NULL, so the join can be an inner one
+WITH_OWNER = joinedload(models.Post.owner, innerjoin=True)
+
+
+def posts_with_votes():
+    '''SELECT of (Post, votes) rows with owners joined in, as post reads return them'''
+    return select(
+        models.Post,
+        models.Post.vote_count.label('votes')
+    ).options(WITH_OWNER)
+
+
+async def get_post_with_votes(db, id: int):
+    return (await db.execute(
+        posts_with_votes().where(models.Post.id == id)
+    )).first()
+
+
+async def get_posts_with_votes(db, ids):
+    '''(Post, votes) rows for ids, in the order of ids, skipping missing ones'''
+    if not ids:
+        return []
+    rows = (await db.execute(
+        posts_with_votes().where(models.Post.id.in_(ids))
+    )).all()
+    by_id = {row.Post.id: row for row in rows}
+    return [by_id[id] for id in ids if id in by_id]
+
+
+async def post_exists(db, id: int):
+    return (await db.execute(
+        select(posts.c.id).where(posts.c.id == id)
+    )).first() is not None
+
+
+async def create_post(db, owner_id: int, post):
+    '''Inserts schemas.PostCreate post and returns the new posts row'''
+    return await _write_one(
+        db,
+        insert(posts).values(owner_id=owner_id, **post.dict()),
+        posts.c,
+        lambda key: select(posts).where(posts.c.id == key[0])
+    )
+
+
+async def update_post(db, id: int, owner_id: int, post):
+    '''Updates post id if owner_id owns it; returns the row, else None'''
+    where = (posts.c.id == id, posts.c.owner_id == owner_id)
+    return await _write_one(
+        db,
+        update(posts).where(*where).values(**post.dict()),
+        posts.c,
+        lambda key: select(posts).where(*where)
+    )
+
+
+async def delete_post(db, id: int, owner_id: int):
+    '''Deletes post id if owner_id owns it; True if it was deleted'''
+    return await _delete_one(
+        db,
+        delete(posts).where(posts.c.id == id, posts.c.owner_id == owner_id),
+        posts.c.id
+    )
+
+
+async def get_users(db):
+    return (await db.execute(select(models.User))).scalars().all()
+
+
+async def get_user(db, id: int):
+    return await db.get(models.User, id)
+
+
+async def get_user_by_email(db, email: str):
+    return (await db.execute(
+        select(models.User).where(models.User.email == email)
+    )).scalars().first()
+
+
+async def create_user(db, email: str, password: str):
+    '''Inserts a user and returns its row, or None if the email is taken'''
+    try:
+        return await _write_one(
+            db,
+            insert(users).values(email=email, password=password),
+            USER_COLUMNS,
+            lambda key: select(*USER_COLUMNS).where(users.c.id == key[0])
+        )
+    except IntegrityError:
+        await db.rollback()
+        return None
+
+
+async def update_user(db, id: int, values: dict):
+    '''Updates user id and returns its row, None if it does not exist, or
+    False if the new email is taken'''
+    try:
+        return await _write_one(
+            db,
+            update(users).where(users.c.id == id).values(**values),
+            USER_COLUMNS,
+            lambda key: select(*USER_COLUMNS).where(users.c.id == id)
+        )
+    except IntegrityError:
+        await db.rollback()
+        return False
+
+
+async def delete_user(db, id: int):
+    '''Deletes user id; None if it did not exist.
+
+    The user's posts and votes go with them, so the other posts they voted
+    on lose a vote in the same transaction. Returns the ids of the deleted
+    posts and of the other posts voted on, for the caches to drop.
+    '''
+    voted = select(votes.c.post_id).where(votes.c.user_id == id)
+    # A UNION rather than an OR, so each half can use its index
+    rows = (await db.execute(union(
+        select(posts.c.id, posts.c.owner_id).where(posts.c.owner_id == id),
+        select(posts.c.id, posts.c.owner_id).where(posts.c.id.in_(voted))
+    ))).all()
+    await db.execute(
+        update(posts)
+        .where(posts.c.id.in_(voted), posts.c.owner_id != id)
+        .values(vote_count=posts.c.vote_count - 1)
+    )
+    if not await _delete_one(db, delete(users).where(users.c.id == id), users.c.id):
+        return None
+    owned = [post_id for post_id, owner_id in rows if owner_id == id]
+    voted_on = [post_id for post_id, owner_id in rows if owner_id != id]
+    return owned, voted_on
@@ -1,23 +1,116 @@
 '''Database.py'''
-from sqlalchemy import create_engine
+from fastapi import Request
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from .config import settings
+from .dbpool import PoolStats, instrument, pool_options
+from .metrics import instrument_engine
+from .replicas import ReplicaRouter
 
 # SQLALCHEMY_DATABASE_URL = "sqlite:///./sql_app.db"
-SQLALCHEMY_DATABASE_URL = f"postgresql://{settings.database_username}:{settings.database_password}@{settings.database_hostname}:{settings.database_port}/{settings.database_name}"
+SQLALCHEMY_DATABASE_URL = settings.database_url or f"postgresql://{settings.database_username}:{settings.database_password}@{settings.database_hostname}:{settings.database_port}/{settings.database_name}"
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL
-)
+# asyncio drivers for the async engine used by the routers
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def async_url(url: str):
+    '''Returns url with its driver swapped for the asyncio equivalent'''
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+
+
+def connect_args(url: str, is_async: bool = False):
+    if url.startswith("sqlite"):
+        # SQLite connections are handed between threads by the pool
+        return {"check_same_thread": False}
+    if is_async and settings.database_null_pool and make_url(url).get_backend_name() == "postgresql":
+        # PgBouncer's transaction pooling runs each transaction on any
+        # server connection, which lacks statements asyncpg prepared on
+        # another, so asyncpg must not cache them
+        return {"statement_cache_size": 0, "prepared_statement_cache_size": 0}
+    return {}
+
+
+def _enable_foreign_keys(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+def enforce_foreign_keys(engine):
+    '''SQLite ignores foreign keys, ON DELETE CASCADE included, unless
+    each connection turns them on'''
+    sync_engine = getattr(engine, "sync_engine", engine)
+    if sync_engine.dialect.name == "sqlite":
+        event.listen(sync_engine, "connect", _enable_foreign_keys)
+    return engine
+
+
+# Sync engine: used by the CLI, migrations and get_sync_db
+sync_pool_stats = PoolStats("sync")
+engine = instrument(create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args=connect_args(SQLALCHEMY_DATABASE_URL),
+    **pool_options(SQLALCHEMY_DATABASE_URL, sync_pool_stats)
+), sync_pool_stats)
+instrument_engine(enforce_foreign_keys(engine))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+
+def create_instrumented_async_engine(url: str, name: str):
+    '''Async engine for url with its pool and statements instrumented'''
+    stats = PoolStats(name)
+    engine = instrument(create_async_engine(
+        async_url(url),
+        connect_args=connect_args(url, is_async=True),
+        **pool_options(url, stats, is_async=True)
+    ), stats)
+    return instrument_engine(enforce_foreign_keys(engine))
+
+
+async_engine = create_instrumented_async_engine(SQLALCHEMY_DATABASE_URL, "async")
+
+replica_router = ReplicaRouter(
+    check_interval=settings.database_replica_check_interval,
+    read_your_writes_seconds=settings.read_your_writes_seconds,
+    secret=settings.secret_key.encode()
+)
+for number, url in enumerate(settings.database_replica_urls, 1):
+    replica_router.add(
+        f"replica{number}",
+        create_instrumented_async_engine(url, f"replica{number}")
+    )
+
+# expire_on_commit=False so committed objects can still be serialized
+# without an implicit (and, under asyncio, impossible) lazy refresh
+AsyncSessionLocal = sessionmaker(
+    bind=async_engine,
+    class_=AsyncSession,
+    autoflush=False,
+    expire_on_commit=False
+)
+
 Base = declarative_base()
 
 
 # Dependency
-def get_db():
-    '''Get DB'''
+async def get_db(request: Request):
+    '''Get DB: a replica for reads when configured, else the primary'''
+    replica = replica_router.engine_for(request)
+    session = AsyncSessionLocal(bind=replica) if replica is not None else AsyncSessionLocal()
+    async with session as db:
+        yield db
+
+
+def get_sync_db():
+    '''Get a blocking DB session, for sync (def) endpoints only'''
     db = SessionLocal()
     try:
         yield db
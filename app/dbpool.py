@@ -0,0 +1,140 @@
+'''dbpool.py
+
+Connection pool configuration and instrumentation for database.py.
+'''
+import threading
+import time
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+from sqlalchemy.util import greenlet_spawn
+
+from .config import settings
+
+
+class PoolStats:
+    '''Counters for one engine's pool, updated from pool events'''
+
+    def __init__(self, name: str):
+        self.name = name
+        self.engine = None
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.in_use = 0
+        self.in_use_peak = 0
+        self.overflow_peak = 0
+        self._lock = threading.Lock()
+
+    def record_wait(self, seconds: float):
+        with self._lock:
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def record_checkout(self, pool):
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.in_use_peak = max(self.in_use_peak, self.in_use)
+            if isinstance(pool, QueuePool):
+                self.overflow_peak = max(self.overflow_peak, pool.overflow())
+
+    def record_checkin(self):
+        with self._lock:
+            self.in_use -= 1
+
+    def snapshot(self):
+        pool = self.engine.pool if self.engine is not None else None
+        data = {
+            "pool": type(pool).__name__ if pool is not None else None,
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "wait_avg_ms": round(
+                self.wait_total / self.checkouts * 1000, 3
+            ) if self.checkouts else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 3),
+            "in_use": self.in_use,
+            "in_use_peak": self.in_use_peak,
+            "overflow_peak": self.overflow_peak,
+        }
+        if isinstance(pool, QueuePool):
+            data.update({
+                "size": pool.size(),
+                "checked_in": pool.checkedin(),
+                "checked_out": pool.checkedout(),
+                # QueuePool counts overflow from -pool_size upwards
+                "overflow": max(pool.overflow(), 0),
+            })
+        return data
+
+
+class _TimedCheckout:
+    '''Pool mixin timing how long checkouts wait for a connection'''
+    stats = None
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.stats.timeouts += 1
+            raise
+        finally:
+            self.stats.record_wait(time.perf_counter() - start)
+
+
+def _pool_class(base, stats: PoolStats):
+    # A class per engine, so Pool.recreate() (which instantiates
+    # self.__class__) keeps reporting into the same stats
+    return type(f"Instrumented{base.__name__}", (_TimedCheckout, base), {"stats": stats})
+
+
+def pool_options(url: str, stats: PoolStats, is_async: bool = False):
+    '''Returns create_engine() keyword arguments for the configured pool'''
+    if settings.database_null_pool:
+        # Let PgBouncer do the pooling, never hold connections here
+        return {"poolclass": NullPool}
+    if url.startswith("sqlite") and ":memory:" in url:
+        return {}
+    base = AsyncAdaptedQueuePool if is_async else QueuePool
+    return {
+        "poolclass": _pool_class(base, stats),
+        "pool_size": settings.database_pool_size,
+        "max_overflow": settings.database_max_overflow,
+        "pool_timeout": settings.database_pool_timeout,
+        "pool_recycle": settings.database_pool_recycle,
+        "pool_pre_ping": settings.database_pool_pre_ping,
+    }
+
+
+# engine name -> PoolStats, reported by the internal stats endpoint
+pool_stats = {}
+
+
+def instrument(engine, stats: PoolStats):
+    '''Attaches checkout/checkin listeners feeding stats to engine's pool'''
+    sync_engine = getattr(engine, "sync_engine", engine)
+    stats.engine = sync_engine
+    pool_stats[stats.name] = stats
+
+    @event.listens_for(sync_engine, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        stats.record_checkout(sync_engine.pool)
+
+    @event.listens_for(sync_engine, "checkin")
+    def on_checkin(dbapi_connection, connection_record):
+        stats.record_checkin()
+
+    return engine
+
+
+async def close_pool(engine):
+    '''Closes the idle connections of an async engine's pool.
+
+    AsyncEngine.dispose() would replace the pool, and a replacement guards
+    its first connect with a threading lock that deadlocks concurrent
+    connects on the event loop, so an app started again in the same
+    process (as in the tests) would hang. The pool itself is kept.
+    '''
+    await greenlet_spawn(engine.sync_engine.pool.dispose)
@@ -1,32 +1,86 @@
 '''Main.py'''
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 
-from app.routers.vote import vote
-from . import models
-from .database import engine
-from .routers import post, user, auth, vote
+from . import trending, warmup
+from .broadcast import broadcast
+from .config import settings
+from .database import AsyncSessionLocal, async_engine, replica_router
+from .dbpool import close_pool
+from .passwords import password_service
+from .admission import AdmissionMiddleware
+from .compression import CompressionMiddleware
+from .metrics import MetricsMiddleware
+from .query_budget import QueryBudgetMiddleware
+from .replicas import ReadYourWritesMiddleware
+from .vote_stream import vote_stream
+from .routers import post, user, auth, vote, internal, metrics
 from fastapi.middleware.cors import CORSMiddleware
 
 # models.Base.metadata.create_all(bind=engine)
 
-app = FastAPI()
-
 origins = ["*"]
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
 
-app.include_router(post.router)
-app.include_router(user.router)
-app.include_router(auth.router)
-app.include_router(vote.router)
+async def startup():
+    replica_router.start()
+    if settings.warmup_enabled:
+        await warmup.run()
+    await trending.rebuild(AsyncSessionLocal)
+    vote_stream.start()
+    await broadcast.start()
+
+
+async def shutdown():
+    await broadcast.stop()
+    await vote_stream.stop()
+    await replica_router.stop()
+    # Pooled aiosqlite connections each run a thread that would
+    # otherwise keep the interpreter alive
+    await close_pool(async_engine)
+    password_service.shutdown()
 
 
-@app.get('/')
 def root():
     return{'message': 'Check out the documentation https://fastapi-hrkj.herokuapp.com/docs or https://fastapi-hrkj.herokuapp.com/redoc'}
+
+
+def create_app():
+    '''Builds the application; warmup runs in its startup hook'''
+    app = FastAPI(
+        default_response_class=ORJSONResponse,
+        on_startup=[startup],
+        on_shutdown=[shutdown]
+    )
+
+    app.add_middleware(CompressionMiddleware)
+    # Innermost but for routing and compression, so 503s still carry
+    # CORS headers
+    app.add_middleware(AdmissionMiddleware)
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=origins,
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+        expose_headers=["X-Next-Cursor", "X-Prev-Cursor"],
+    )
+    app.add_middleware(
+        ReadYourWritesMiddleware, max_age=settings.read_your_writes_seconds
+    )
+    # Inside MetricsMiddleware, which counts the request's statements
+    app.add_middleware(QueryBudgetMiddleware)
+    app.add_middleware(MetricsMiddleware)
+
+    app.include_router(post.router)
+    app.include_router(user.router)
+    app.include_router(auth.router)
+    app.include_router(vote.router)
+    app.include_router(internal.router)
+    app.include_router(metrics.router)
+
+    app.get('/')(root)
+    return app
+
+
+app = create_app()
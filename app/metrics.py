@@ -0,0 +1,195 @@
+'''metrics.py
+
+Per-route request metrics in Prometheus text format.
+
+MetricsMiddleware times every request and, through the cursor events
+installed by instrument_engine(), counts the queries it runs and the
+time spent in them. Recording happens once per request on the event
+loop, so the registry needs no locking and the per-query hooks only
+bump two numbers on a context-local object.
+'''
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    '''Cumulative-bucket histogram as Prometheus expects it'''
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        '''Yields (le, cumulative count) pairs, ending with +Inf'''
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield _format_number(bound), total
+        yield "+Inf", self.count
+
+
+class RequestStats:
+    '''Query count and DB time of the request being handled'''
+    __slots__ = ("queries", "db_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+current_request = ContextVar("current_request", default=None)
+
+
+class Registry:
+    def __init__(self):
+        self.requests = {}
+        self.latency = {}
+        self.queries = {}
+        self.db_seconds = {}
+        # name -> callable returning {labels tuple: value}, read on scrape
+        self.gauges = {}
+
+    def record(self, method: str, route: str, status: int, seconds: float, stats: RequestStats):
+        key = (method, route)
+        status_key = (method, route, str(status))
+        self.requests[status_key] = self.requests.get(status_key, 0) + 1
+        latency = self.latency.get(key)
+        if latency is None:
+            latency = self.latency[key] = Histogram(LATENCY_BUCKETS)
+            self.queries[key] = Histogram(QUERY_COUNT_BUCKETS)
+            self.db_seconds[key] = 0.0
+        latency.observe(seconds)
+        self.queries[key].observe(stats.queries)
+        self.db_seconds[key] += stats.db_seconds
+
+    def gauge(self, name: str, help: str, labels, collect):
+        '''Registers a gauge whose samples are read when /metrics is scraped'''
+        self.gauges[name] = (help, labels, collect)
+
+    def render(self):
+        '''Returns all metrics in the Prometheus text exposition format'''
+        lines = []
+        route_labels = ("method", "route")
+
+        lines += _header("http_requests_total", "counter", "Requests by route and status")
+        for labels, value in self.requests.items():
+            lines.append(_sample("http_requests_total", ("method", "route", "status"), labels, value))
+
+        _histogram(lines, "http_request_duration_seconds", "Request latency", route_labels, self.latency)
+        _histogram(lines, "http_request_db_queries", "SQL statements per request", route_labels, self.queries)
+
+        lines += _header("http_request_db_seconds_total", "counter", "Time spent in SQL statements")
+        for labels, value in self.db_seconds.items():
+            lines.append(_sample("http_request_db_seconds_total", route_labels, labels, value))
+
+        for name, (help, label_names, collect) in self.gauges.items():
+            lines += _header(name, "gauge", help)
+            for labels, value in collect().items():
+                lines.append(_sample(name, label_names, labels, value))
+
+        return "\n".join(lines) + "\n"
+
+
+def _format_number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value: str):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _header(name: str, kind: str, help: str):
+    return [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+
+
+def _sample(name: str, label_names, labels, value, extra: str = ""):
+    pairs = [f'{key}="{_escape(val)}"' for key, val in zip(label_names, labels)]
+    if extra:
+        pairs.append(extra)
+    label_text = "{" + ",".join(pairs) + "}" if pairs else ""
+    return f"{name}{label_text} {_format_number(value)}"
+
+
+def _histogram(lines, name: str, help: str, label_names, histograms):
+    lines += _header(name, "histogram", help)
+    for labels, histogram in histograms.items():
+        for le, count in histogram.samples():
+            lines.append(_sample(f"{name}_bucket", label_names, labels, count, f'le="{le}"'))
+        lines.append(_sample(f"{name}_sum", label_names, labels, histogram.sum))
+        lines.append(_sample(f"{name}_count", label_names, labels, histogram.count))
+
+
+registry = Registry()
+
+
+class MetricsMiddleware:
+    '''Pure ASGI middleware recording latency, status and SQL per route'''
+
+    def __init__(self, app, registry: Registry = registry):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            current_request.reset(token)
+            # The matched route template keeps label cardinality bounded
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            self.registry.record(scope["method"], path, status_code, elapsed, stats)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_request.get() is not None:
+        context._metrics_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current_request.get()
+    if stats is not None:
+        stats.queries += 1
+        start = getattr(context, "_metrics_start", None)
+        if start is not None:
+            stats.db_seconds += time.perf_counter() - start
+
+
+def instrument_engine(engine):
+    '''Attributes statements run on engine to the current request'''
+    sync_engine = getattr(engine, "sync_engine", engine)
+    event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+    return engine
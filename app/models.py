@@ -1,31 +1,106 @@
 '''models.py'''
-from sqlalchemy import TIMESTAMP, Boolean, Column, ForeignKey, Integer, String
-from sqlalchemy.sql.expression import text
+from sqlalchemy import DDL, TIMESTAMP, Boolean, Column, ForeignKey, Index, Integer, String, event
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement, true
 from sqlalchemy.orm import relationship
 
 from .database import Base
 
 
+class now(FunctionElement):
+    '''now() server default; on SQLite it matches the text format
+    SQLAlchemy binds datetimes in, so stored and bound values compare'''
+    type = TIMESTAMP(timezone=True)
+    inherit_cache = True
+
+
+@compiles(now)
+def _now_default(element, compiler, **kw):
+    return "now()"
+
+
+@compiles(now, "sqlite")
+def _now_sqlite(element, compiler, **kw):
+    return "(strftime('%Y-%m-%d %H:%M:%f000', 'now'))"
+
+
 class Post(Base):
     '''SQLAlchemy Post Model: For Database'''
     __tablename__ = "posts"
+    __table_args__ = (
+        # The feed's keyset order, see pagination.keyset_page
+        Index("ix_posts_created_at_id", "created_at", "id"),
+    )
 
     id = Column(Integer, primary_key=True, nullable=False)
     title = Column(String, nullable=False)
     content = Column(String, nullable=False)
-    published = Column(Boolean, server_default='TRUE', nullable=False)
+    published = Column(Boolean, server_default=true(), nullable=False)
     created_at = Column(
         TIMESTAMP(timezone=True),
         nullable=False,
-        server_default=text('now()')
+        server_default=now()
     )
     phone_number = Column(String)
+    # Maintained by the vote router so reads don't aggregate votes
+    vote_count = Column(Integer, nullable=False, server_default='0')
     owner_id = Column(
         Integer,
         ForeignKey("users.id", ondelete="CASCADE"),
-        nullable=False
+        nullable=False,
+        index=True
+    )
+    # Never loaded implicitly: post reads join the owner in (see
+    # crud.posts_with_votes), anything else fails instead of querying
+    owner = relationship("User", lazy="raise")
+
+
+# Full-text search over title and content (see app/search.py). On
+# Postgres the migrations own this; the DDL here covers create_all().
+for statement in (
+    """ALTER TABLE posts ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(content, '')), 'B')
+    ) STORED""",
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX ix_posts_search_vector ON posts USING gin (search_vector)",
+    "CREATE INDEX ix_posts_title_trgm ON posts USING gin (title gin_trgm_ops)",
+    "CREATE INDEX ix_posts_content_trgm ON posts USING gin (content gin_trgm_ops)",
+):
+    event.listen(
+        Post.__table__, "after_create",
+        DDL(statement).execute_if(dialect="postgresql")
     )
-    owner = relationship("User")
+
+for statement in (
+    """CREATE VIRTUAL TABLE posts_fts USING fts5(
+        title, content, content='posts', content_rowid='id'
+    )""",
+    """CREATE TRIGGER posts_fts_insert AFTER INSERT ON posts BEGIN
+        INSERT INTO posts_fts(rowid, title, content)
+        VALUES (new.id, new.title, new.content);
+    END""",
+    """CREATE TRIGGER posts_fts_delete AFTER DELETE ON posts BEGIN
+        INSERT INTO posts_fts(posts_fts, rowid, title, content)
+        VALUES ('delete', old.id, old.title, old.content);
+    END""",
+    """CREATE TRIGGER posts_fts_update AFTER UPDATE OF title, content ON posts BEGIN
+        INSERT INTO posts_fts(posts_fts, rowid, title, content)
+        VALUES ('delete', old.id, old.title, old.content);
+        INSERT INTO posts_fts(rowid, title, content)
+        VALUES (new.id, new.title, new.content);
+    END""",
+):
+    event.listen(
+        Post.__table__, "after_create",
+        DDL(statement).execute_if(dialect="sqlite")
+    )
+
+# The triggers are dropped with posts, the FTS5 table is not
+event.listen(
+    Post.__table__, "before_drop",
+    DDL("DROP TABLE IF EXISTS posts_fts").execute_if(dialect="sqlite")
+)
 
 
 class User(Base):
@@ -38,7 +113,7 @@ class User(Base):
     created_at = Column(
         TIMESTAMP(timezone=True),
         nullable=False,
-        server_default=text('now()')
+        server_default=now()
     )
 
 class Vote(Base):
@@ -50,8 +125,37 @@ class Vote(Base):
         ForeignKey("users.id", ondelete="CASCADE"),
         primary_key=True
     )
+    # The primary key leads with user_id, so votes by post (and the
+    # cascade when a post is deleted) need their own index
     post_id = Column(
         Integer,
         ForeignKey("posts.id", ondelete="CASCADE"),
-        primary_key=True
+        primary_key=True,
+        index=True
+    )
+
+
+class RefreshToken(Base):
+    '''SQLAlchemy RefreshToken Model: For Database'''
+    __tablename__ = "refresh_tokens"
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    # sha256 of the opaque token; the token itself is never stored
+    token_hash = Column(String, nullable=False, unique=True)
+    # Tokens rotated from the same login share a family, which is
+    # revoked as a whole when a used token comes back
+    family_id = Column(String, nullable=False, index=True)
+    user_id = Column(
+        Integer,
+        ForeignKey("users.id", ondelete="CASCADE"),
+        nullable=False,
+        index=True
+    )
+    created_at = Column(
+        TIMESTAMP(timezone=True),
+        nullable=False,
+        server_default=now()
     )
+    expires_at = Column(TIMESTAMP(timezone=True), nullable=False)
+    used_at = Column(TIMESTAMP(timezone=True))
+    revoked_at = Column(TIMESTAMP(timezone=True))
@@ -1,12 +1,15 @@
 '''oauth2.py'''
+import hashlib
+import time
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from .config import settings
 
-from . import models
+from . import crud
+from .cache import TTLCache
 
 from . import schemas, database
 
@@ -16,6 +19,15 @@ SECRET_KEY = settings.secret_key
 ALGORITHM = settings.algorithm
 ACCESS_TOKEN_EXPIRE_MINUTES = settings.access_token_expire_minutes
 
+# sha256(token) -> (schemas.TokenData, exp); each entry lives until exp
+token_cache = TTLCache(maxsize=settings.token_cache_size, ttl=0)
+
+# user_id -> schemas.CurrentUser, invalidated by the user router
+user_cache = TTLCache(
+    maxsize=settings.user_cache_size,
+    ttl=settings.user_cache_ttl_seconds
+)
+
 
 def create_access_token(data: dict):
     '''Creates Access token'''
@@ -29,6 +41,14 @@ def create_access_token(data: dict):
 
 
 def verify_access_token(token: str, credentials_exception):
+    key = hashlib.sha256(token.encode()).digest()
+    cached = token_cache.get(key)
+    if cached is not None:
+        token_data, exp = cached
+        if time.time() < exp:
+            return token_data
+        token_cache.pop(key)
+
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         id: str = payload.get("user_id")
@@ -41,21 +61,56 @@ def verify_access_token(token: str, credentials_exception):
     except JWTError:
         raise credentials_exception
 
+    exp = payload.get("exp")
+    if exp is not None:
+        token_cache.set(key, (token_data, exp), ttl=exp - time.time())
+
     return token_data
 
 
-async def get_current_user(
-    token: str = Depends(oauth2_scheme),
-    db: Session = Depends(database.get_db)
-):
-    credentials_exception = HTTPException(
+def _credentials_exception():
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail='Could not validate credentials',
         headers={'WWW-Authenticate': 'Bearer'}
     )
 
-    token = verify_access_token(token, credentials_exception)
 
-    user = db.query(models.User).filter(models.User.id == token.id).first()
+async def get_current_user(
+    token: str = Depends(oauth2_scheme),
+    db: AsyncSession = Depends(database.get_db)
+):
+    token = verify_access_token(token, _credentials_exception())
+
+    user_id = int(token.id)
+    user = user_cache.get(user_id)
+    if user is None:
+        found_user = await crud.get_user(db, user_id)
+        if found_user is None:
+            return None
+        user = schemas.CurrentUser.from_orm(found_user)
+        user_cache.set(user_id, user)
 
     return user
+
+
+def get_current_user_id(token: str = Depends(oauth2_scheme)):
+    '''The user id of a valid access token, without loading the user.
+
+    For long-lived streams, which must not hold a database session open.
+    '''
+    return int(verify_access_token(token, _credentials_exception()).id)
+
+
+async def get_current_admin(current_user=Depends(get_current_user)):
+    if current_user is None or current_user.id not in settings.admin_user_ids:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not Authorised to perform requested action"
+        )
+    return current_user
+
+
+def invalidate_user(user_id: int):
+    '''Drops a cached user after it is updated or deleted'''
+    user_cache.pop(user_id)
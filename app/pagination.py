@@ -0,0 +1,94 @@
+'''pagination.py'''
+import base64
+import json
+from datetime import datetime
+from typing import Optional
+
+from fastapi import HTTPException, status
+from sqlalchemy import literal, tuple_
+
+from . import models
+
+NEXT = "next"
+PREV = "prev"
+
+
+def encode_cursor(created_at: datetime, id: int, direction: str = NEXT):
+    '''Encodes the (created_at, id) position of a post as an opaque token'''
+    raw = json.dumps(
+        {"c": created_at.isoformat(), "i": id, "d": direction},
+        separators=(",", ":")
+    )
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    '''Decodes a token from encode_cursor into (created_at, id, direction)'''
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        created_at = datetime.fromisoformat(payload["c"])
+        id = int(payload["i"])
+        direction = payload.get("d", NEXT)
+        if direction not in (NEXT, PREV):
+            raise ValueError(direction)
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+    return created_at, id, direction
+
+
+async def keyset_page(db, query, limit: int, cursor: Optional[str] = None):
+    '''Returns (rows, next_cursor, prev_cursor, lookahead_id) for a
+    select over Post rows.
+
+    Posts are ordered newest first by (created_at, id), so a page only
+    has to seek past the cursor position instead of scanning and
+    discarding every row before it like OFFSET does. lookahead_id is the
+    post fetched past the page to tell whether another page exists, or
+    None: the cursors are only as current as that post.
+    '''
+    key = tuple_(models.Post.created_at, models.Post.id)
+    direction = NEXT
+    if cursor:
+        created_at, id, direction = decode_cursor(cursor)
+        position = tuple_(
+            literal(created_at, models.Post.created_at.type),
+            literal(id, models.Post.id.type)
+        )
+        if direction == NEXT:
+            query = query.where(key < position)
+        else:
+            query = query.where(key > position)
+
+    if direction == NEXT:
+        query = query.order_by(
+            models.Post.created_at.desc(), models.Post.id.desc()
+        )
+    else:
+        query = query.order_by(
+            models.Post.created_at.asc(), models.Post.id.asc()
+        )
+
+    # Fetch one extra row to learn whether another page exists
+    rows = (await db.execute(query.limit(limit + 1))).all()
+    has_more = len(rows) > limit
+    lookahead_id = rows[limit].Post.id if has_more else None
+    rows = rows[:limit]
+    if direction == PREV:
+        rows.reverse()
+
+    if not rows:
+        return rows, None, None, None
+
+    first, last = rows[0].Post, rows[-1].Post
+    if direction == NEXT:
+        has_next, has_prev = has_more, cursor is not None
+    else:
+        has_next, has_prev = True, has_more
+
+    next_cursor = encode_cursor(last.created_at, last.id, NEXT) if has_next else None
+    prev_cursor = encode_cursor(first.created_at, first.id, PREV) if has_prev else None
+    return rows, next_cursor, prev_cursor, lookahead_id
@@ -0,0 +1,101 @@
+'''passwords.py'''
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from fastapi import HTTPException, status
+
+from . import utils
+from .config import settings
+
+
+def _timed(fn, *args):
+    '''Runs fn in a worker; returns its result and the CPU seconds it took'''
+    start = time.process_time()
+    return fn(*args), time.process_time() - start
+
+
+def _ready():
+    '''No-op task; running it makes a worker import this module and passlib'''
+    return os.getpid()
+
+
+class PasswordService:
+    '''Runs bcrypt in a dedicated process pool.
+
+    Hashing there keeps it off the event loop, the shared threadpool
+    and the GIL. At most `workers` hashes run at once and at most
+    `queue_limit` more wait; anything beyond that is rejected with a 503
+    straight away instead of queueing behind a login burst.
+    '''
+
+    def __init__(self, workers: int, queue_limit: int):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.pending = 0
+        self.rejected = 0
+        # bcrypt CPU time spent checking passwords, see verify_and_update
+        self.verifies = 0
+        self.verify_seconds = 0.0
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            # spawn, so workers don't inherit the app's sockets and threads
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    async def _run(self, fn, *args):
+        if self.pending >= self.workers + self.queue_limit:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server busy, please retry",
+                headers={"Retry-After": "1"}
+            )
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), fn, *args)
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password: str):
+        '''Hash the password'''
+        return await self._run(utils.hash, password)
+
+    async def verify_and_update(self, password: str, hashed_password: str):
+        '''Returns (verified, new_hash); new_hash is set when the stored
+        hash uses outdated parameters and should be replaced'''
+        result, seconds = await self._run(
+            _timed, utils.verify_and_update, password, hashed_password
+        )
+        self.verifies += 1
+        self.verify_seconds += seconds
+        return result
+
+    async def start(self):
+        '''Spawns the workers now rather than on the first login'''
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        await asyncio.gather(*(
+            loop.run_in_executor(executor, _ready) for _ in range(self.workers)
+        ))
+
+    def shutdown(self):
+        if self._executor is not None:
+            # Waits for the processes to exit: app.serve workers end with
+            # os._exit(), which would otherwise orphan them
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+
+password_service = PasswordService(
+    workers=settings.password_workers or os.cpu_count() or 1,
+    queue_limit=settings.password_queue_limit
+)
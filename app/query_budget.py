@@ -0,0 +1,69 @@
+'''query_budget.py
+
+Per-route limits on the SQL statements a request may run, so N+1
+queries show up as soon as they are introduced.
+'''
+import logging
+
+from .config import settings
+from .metrics import RequestStats, current_request
+
+logger = logging.getLogger(__name__)
+
+# (method, route) -> requests that went over budget, served by /metrics
+exceeded = {}
+
+
+class QueryBudgetExceeded(RuntimeError):
+    pass
+
+
+def query_budget(limit: int):
+    '''Declares the most SQL statements one request to the endpoint may run'''
+    def declare(endpoint):
+        endpoint.query_budget = limit
+        return endpoint
+    return declare
+
+
+def route_budget(scope):
+    '''The budget declared by the endpoint of the matched route, or None'''
+    route = scope.get("route")
+    return getattr(getattr(route, "endpoint", None), "query_budget", None)
+
+
+class QueryBudgetMiddleware:
+    '''Pure ASGI middleware checking requests against their route's budget'''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or settings.query_budget_action == "off":
+            await self.app(scope, receive, send)
+            return
+
+        # Normally MetricsMiddleware, further out, has started the count
+        stats = current_request.get()
+        token = None
+        if stats is None:
+            stats = RequestStats()
+            token = current_request.set(stats)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            if token is not None:
+                current_request.reset(token)
+
+        limit = route_budget(scope)
+        if limit is None or stats.queries <= limit:
+            return
+        key = (scope["method"], scope["route"].path)
+        exceeded[key] = exceeded.get(key, 0) + 1
+        message = (
+            f"{scope['method']} {scope['route'].path} ran {stats.queries} "
+            f"SQL statements, over its budget of {limit}"
+        )
+        if settings.query_budget_action == "raise":
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
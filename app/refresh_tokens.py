@@ -0,0 +1,103 @@
+'''refresh_tokens.py
+
+Rotating refresh tokens; presenting a used token revokes its family.
+'''
+import hashlib
+import secrets
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import insert, select, update
+
+from . import models
+from .config import settings
+
+tokens = models.RefreshToken.__table__
+
+# Outcomes of rotate()
+REFRESHED = "refreshed"
+INVALID = "invalid"
+REUSED = "reused"
+
+# Counters served by /metrics; every refresh is a login not repeated
+stats = {"issued": 0, REFRESHED: 0, INVALID: 0, REUSED: 0, "revoked": 0}
+
+
+def _hash(token: str):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def _insert(user_id: int, family_id: str):
+    token = secrets.token_urlsafe(32)
+    statement = insert(tokens).values(
+        token_hash=_hash(token),
+        family_id=family_id,
+        user_id=user_id,
+        expires_at=datetime.now(timezone.utc) + timedelta(days=settings.refresh_token_expire_days)
+    )
+    return token, statement
+
+
+async def issue(db, user_id: int):
+    '''Starts a token family for a login and returns its first token'''
+    token, statement = _insert(user_id, uuid.uuid4().hex)
+    await db.execute(statement)
+    await db.commit()
+    stats["issued"] += 1
+    return token
+
+
+async def rotate(db, token: str):
+    '''Uses up token; returns (outcome, user_id, successor token).
+
+    user_id and the successor are only set when outcome is REFRESHED.
+    '''
+    row = (await db.execute(
+        select(
+            tokens.c.id,
+            tokens.c.user_id,
+            tokens.c.family_id,
+            tokens.c.used_at.isnot(None).label("used"),
+            (tokens.c.revoked_at.is_(None) & (tokens.c.expires_at > models.now())).label("live"),
+        ).where(tokens.c.token_hash == _hash(token))
+    )).first()
+    if row is None or not row.live:
+        stats[INVALID] += 1
+        return INVALID, None, None
+
+    # Conditional, so of two requests racing with one token only one wins
+    if row.used or (await db.execute(
+        update(tokens)
+        .where(tokens.c.id == row.id, tokens.c.used_at.is_(None))
+        .values(used_at=models.now())
+    )).rowcount == 0:
+        await db.execute(
+            update(tokens)
+            .where(tokens.c.family_id == row.family_id, tokens.c.revoked_at.is_(None))
+            .values(revoked_at=models.now())
+        )
+        await db.commit()
+        stats[REUSED] += 1
+        return REUSED, None, None
+
+    successor, statement = _insert(row.user_id, row.family_id)
+    await db.execute(statement)
+    await db.commit()
+    stats[REFRESHED] += 1
+    return REFRESHED, row.user_id, successor
+
+
+async def revoke_user(db, user_id: int):
+    '''Revokes every unused refresh token of user_id; returns how many'''
+    revoked = (await db.execute(
+        update(tokens)
+        .where(
+            tokens.c.user_id == user_id,
+            tokens.c.used_at.is_(None),
+            tokens.c.revoked_at.is_(None)
+        )
+        .values(revoked_at=models.now())
+    )).rowcount
+    await db.commit()
+    stats["revoked"] += revoked
+    return revoked
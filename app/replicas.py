@@ -0,0 +1,179 @@
+'''replicas.py
+
+Routes read-only requests to healthy read replicas, and clients that
+just wrote to the primary.
+'''
+import asyncio
+import hashlib
+import hmac
+import itertools
+import logging
+import math
+import time
+
+from sqlalchemy import event, text
+
+from .dbpool import close_pool
+
+logger = logging.getLogger(__name__)
+
+SAFE_METHODS = frozenset(("GET", "HEAD"))
+
+PIN_COOKIE = "read_your_writes"
+
+
+class Replica:
+    __slots__ = ("name", "engine", "healthy", "sessions")
+
+    def __init__(self, name: str, engine):
+        self.name = name
+        self.engine = engine
+        self.healthy = True
+        self.sessions = 0
+
+
+def _bearer_token(request):
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    return token if scheme.lower() == "bearer" and token else None
+
+
+def reads_replica(request):
+    '''True if request's session reads from a replica, which may lag'''
+    return getattr(request.state, "replica", None) is not None
+
+
+def reads_own_writes(request):
+    '''True if request carries a valid pin, so it must see its client's
+    writes even before other workers' caches have dropped what they
+    replaced'''
+    return getattr(request.state, "reads_own_writes", False)
+
+
+class ReplicaRouter:
+    def __init__(self, check_interval: float, read_your_writes_seconds: float,
+                 secret: bytes, check_timeout: float = 2.0):
+        self.replicas = []
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+        self.read_your_writes_seconds = read_your_writes_seconds
+        self.primary_sessions = 0
+        self._secret = secret
+        self._turn = itertools.count()
+        self._task = None
+
+    def add(self, name: str, engine):
+        replica = Replica(name, engine)
+        self.replicas.append(replica)
+
+        @event.listens_for(getattr(engine, "sync_engine", engine), "handle_error")
+        def on_error(context):
+            if context.is_disconnect and replica.healthy:
+                logger.warning("replica %s disconnected, routing reads elsewhere", replica.name)
+                replica.healthy = False
+
+        return replica
+
+    def engine_for(self, request):
+        '''Returns the replica engine to read from, or None for the primary.
+
+        State-changing requests pin their client to the primary up front,
+        so its next reads cannot race ahead of replication. The choice is
+        kept on request.state for reads_replica() and reads_own_writes().
+        '''
+        if self.replicas:
+            token = _bearer_token(request)
+            if request.method not in SAFE_METHODS:
+                if token is not None:
+                    self.pin(request, token)
+            elif token is not None and self.pinned(request, token):
+                request.state.reads_own_writes = True
+            else:
+                healthy = [replica for replica in self.replicas if replica.healthy]
+                if healthy:
+                    replica = healthy[next(self._turn) % len(healthy)]
+                    replica.sessions += 1
+                    request.state.replica = replica.name
+                    return replica.engine
+        self.primary_sessions += 1
+        return None
+
+    def _sign(self, token: str, expires: int):
+        message = hashlib.sha256(token.encode()).digest() + str(expires).encode()
+        return hmac.new(self._secret, message, hashlib.sha256).hexdigest()
+
+    def pin(self, request, token: str):
+        '''Sends reads made with token to the primary for a while, by
+        having ReadYourWritesMiddleware set the pin cookie on the response'''
+        if self.replicas:
+            expires = math.ceil(time.time() + self.read_your_writes_seconds)
+            request.state.replica_pin = f"{expires}.{self._sign(token, expires)}"
+
+    def pinned(self, request, token: str):
+        '''True while request carries an unexpired pin signed for token'''
+        expires, _, signature = request.cookies.get(PIN_COOKIE, "").partition(".")
+        if not expires.isdigit() or int(expires) < time.time():
+            return False
+        return hmac.compare_digest(signature, self._sign(token, int(expires)))
+
+    async def check(self, replica: Replica):
+        try:
+            async with replica.engine.connect() as connection:
+                await asyncio.wait_for(
+                    connection.execute(text("SELECT 1")), self.check_timeout
+                )
+        except Exception as exc:
+            if replica.healthy:
+                logger.warning("replica %s failed its health check: %s", replica.name, exc)
+            replica.healthy = False
+        else:
+            if not replica.healthy:
+                logger.info("replica %s is healthy again", replica.name)
+            replica.healthy = True
+
+    async def _check_forever(self):
+        while True:
+            await asyncio.gather(*(self.check(replica) for replica in self.replicas))
+            await asyncio.sleep(self.check_interval)
+
+    def start(self):
+        '''Starts the background health checks on the running event loop'''
+        if self.replicas and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._check_forever())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for replica in self.replicas:
+            await close_pool(replica.engine)
+
+
+class ReadYourWritesMiddleware:
+    '''Pure ASGI middleware setting the pin cookie of ReplicaRouter.pin()'''
+
+    def __init__(self, app, max_age: float):
+        self.app = app
+        self.max_age = math.ceil(max_age)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_pin(message):
+            pin = scope.get("state", {}).get("replica_pin")
+            if message["type"] == "http.response.start" and pin is not None:
+                cookie = (
+                    f"{PIN_COOKIE}={pin}; Max-Age={self.max_age}; Path=/; "
+                    "HttpOnly; SameSite=Lax"
+                )
+                message["headers"] = [
+                    *message.get("headers", []), (b"set-cookie", cookie.encode())
+                ]
+            await send(message)
+
+        await self.app(scope, receive, send_with_pin)
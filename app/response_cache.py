@@ -0,0 +1,234 @@
+'''response_cache.py
+
+Per-worker cache of serialized GET /posts responses, tagged with the
+posts they contain so a write evicts only the entries it changed.
+Writes evict in every worker through broadcast.py.
+'''
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from fastapi import Response, status
+
+from .compression import compress, compressible, negotiate, weak_etag
+from .config import settings
+
+# Tags for list pages whose contents a new or deleted post can shift
+FEED_HEAD = "feed:head"
+FEED_OFFSET = "feed:offset"
+SEARCH = "search"
+
+
+def post_tag(id: int):
+    return f"post:{id}"
+
+
+class CachedResponse:
+    __slots__ = (
+        "body", "etag", "headers", "expires_at", "tags",
+        "cache", "variants", "size", "stored"
+    )
+
+    def __init__(self, body: bytes, headers: dict, ttl: float, tags, cache=None):
+        self.body = body
+        self.etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+        self.headers = {**headers, "ETag": self.etag}
+        self.expires_at = time.monotonic() + ttl
+        self.tags = frozenset(tags)
+        self.cache = cache
+        # encoding -> compressed body
+        self.variants = {}
+        self.size = len(body)
+        self.stored = False
+
+    def matches(self, if_none_match):
+        '''True when an If-None-Match header lists this entry's ETag'''
+        if not if_none_match:
+            return False
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag == "*" or tag.removeprefix("W/") == self.etag:
+                return True
+        return False
+
+    def to_response(self, request):
+        encoding = None
+        vary = {}
+        if compressible("application/json", len(self.body)):
+            encoding = negotiate(request.headers)
+            # Whichever variant is sent, the response depends on Accept-Encoding
+            vary = {"Vary": "Accept-Encoding"}
+        etag = self.etag if encoding is None else weak_etag(self.etag)
+        if self.matches(request.headers.get("if-none-match")):
+            return Response(
+                status_code=status.HTTP_304_NOT_MODIFIED,
+                headers={"ETag": etag, **vary}
+            )
+        if encoding is None:
+            return Response(
+                self.body,
+                media_type="application/json",
+                headers={**self.headers, **vary}
+            )
+        return Response(
+            self.variant(encoding),
+            media_type="application/json",
+            headers={
+                **self.headers,
+                **vary,
+                "ETag": etag,
+                "Content-Encoding": encoding,
+            }
+        )
+
+    def variant(self, encoding: str):
+        '''The body compressed with encoding, compressed on first use'''
+        body = self.variants.get(encoding)
+        if body is None:
+            body = compress(encoding, self.body)
+            if self.cache is not None:
+                self.cache.add_variant(self, encoding, body)
+            else:
+                self.variants[encoding] = body
+        return body
+
+
+class ResponseCache:
+    '''LRU bounded by total body size, with per-entry TTL and tags.
+
+    Every invalidate() starts a new generation and stamps its tags with
+    it. A reader takes generation() before querying and passes it to
+    set(), which then refuses to store a body read before one of its
+    tags was invalidated: a write committing during the read must not
+    leave the old body cached until it expires.
+    '''
+
+    def __init__(self, max_bytes: int, ttl: float, enabled: bool = True,
+                 max_stamps: int = 100000):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.enabled = enabled
+        self.max_stamps = max_stamps
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._tags = {}
+        # tag -> generation that last invalidated it, oldest first
+        self._stamps = OrderedDict()
+        self._generation = 0
+        # Newest generation whose stamps were evicted from _stamps
+        self._forgotten = 0
+        self._lock = threading.Lock()
+
+    def generation(self):
+        '''The current generation, to pass to set() after reading'''
+        return self._generation
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def set(self, key, body: bytes, headers: dict, tags, generation: int = None,
+            store: bool = True):
+        '''Stores body under key and returns the entry to respond with.
+
+        body is not stored if any of tags was invalidated after
+        generation, taken from generation() before body was read, or if
+        store is False.
+        '''
+        entry = CachedResponse(body, headers, self.ttl, tags, self)
+        if not store or not self.enabled or len(body) > self.max_bytes:
+            return entry
+        with self._lock:
+            if generation is not None and self._invalidated_since(entry.tags, generation):
+                return entry
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            entry.stored = True
+            self.size += entry.size
+            for tag in entry.tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+        return entry
+
+    def add_variant(self, entry: CachedResponse, encoding: str, body: bytes):
+        '''Keeps a compressed body with entry, counting it if entry is cached'''
+        with self._lock:
+            if encoding in entry.variants:
+                return
+            entry.variants[encoding] = body
+            entry.size += len(body)
+            if entry.stored:
+                self.size += len(body)
+                while self.size > self.max_bytes:
+                    self._remove(next(iter(self._entries)))
+
+    def invalidate(self, *tags):
+        '''Evicts every entry carrying any of tags'''
+        with self._lock:
+            self._generation += 1
+            for tag in tags:
+                self._stamps[tag] = self._generation
+                self._stamps.move_to_end(tag)
+            while len(self._stamps) > self.max_stamps:
+                _, self._forgotten = self._stamps.popitem(last=False)
+            keys = set()
+            for tag in tags:
+                keys |= self._tags.get(tag, set())
+            for key in keys:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            for entry in self._entries.values():
+                entry.stored = False
+            self._entries.clear()
+            self._tags.clear()
+            self.size = 0
+
+    def _invalidated_since(self, tags, generation: int):
+        # A stamp too old to be kept may have been for one of tags
+        if generation < self._forgotten:
+            return True
+        return any(self._stamps.get(tag, 0) > generation for tag in tags)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        entry.stored = False
+        self.size -= entry.size
+        for tag in entry.tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+def posts_key(limit: int, cursor, skip: int, search):
+    '''Normalized cache key for a GET /posts/ query'''
+    return ("posts", limit, cursor or None, skip or 0, (search or "").strip() or None)
+
+
+def post_key(id: int):
+    return ("post", id)
+
+
+response_cache = ResponseCache(
+    max_bytes=settings.response_cache_max_bytes,
+    ttl=settings.response_cache_ttl_seconds,
+    enabled=settings.response_cache_enabled
+)
@@ -1,9 +1,11 @@
 '''auth.py'''
-from fastapi import Depends, HTTPException, status, APIRouter
+from fastapi import Depends, HTTPException, Request, Response, status, APIRouter
 from fastapi.security.oauth2 import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
-from ..database import get_db
-from .. import schemas, models, utils, oauth2
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..database import get_db, replica_router
+from .. import crud, oauth2, refresh_tokens, schemas
+from ..passwords import password_service
+from ..query_budget import query_budget
 
 router = APIRouter(tags=['Authentication'])
 
@@ -13,15 +15,15 @@ router = APIRouter(tags=['Authentication'])
     status_code=status.HTTP_200_OK,
     response_model=schemas.Token
 )
-def login(
+@query_budget(4)
+async def login(
+    request: Request,
     user_credentials: OAuth2PasswordRequestForm = Depends(),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     '''Login'''
     # OAuth2PasswordRequestForm returns username and password
-    user = db.query(models.User).filter(
-        models.User.email == user_credentials.username
-    ).first()
+    user = await crud.get_user_by_email(db, user_credentials.username)
 
     if user is None:
         raise HTTPException(
@@ -29,11 +31,72 @@ def login(
             detail="Invalid Credentials"
         )
 
-    if not utils.verify(user_credentials.password, user.password):
+    verified, new_hash = await password_service.verify_and_update(
+        user_credentials.password, user.password
+    )
+    if not verified:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Invalid Credentials"
         )
 
+    # Upgrade hashes made with outdated bcrypt parameters
+    if new_hash is not None:
+        await crud.update_user(db, user.id, {"password": new_hash})
+
     access_token = oauth2.create_access_token(data={"user_id": user.id})
-    return {"access_token": access_token, "token_type": "bearer"}
+    # The account may be too new to have reached the replicas yet
+    replica_router.pin(request, access_token)
+    return {
+        "access_token": access_token,
+        "token_type": "bearer",
+        "refresh_token": await refresh_tokens.issue(db, user.id)
+    }
+
+
+@router.post(
+    '/token/refresh',
+    status_code=status.HTTP_200_OK,
+    response_model=schemas.Token
+)
+@query_budget(3)
+async def refresh(
+    request: Request,
+    token: schemas.TokenRefresh,
+    db: AsyncSession = Depends(get_db)
+):
+    '''Refresh
+
+    Trades a refresh token for a new access token and a new refresh
+    token, without the password. Each refresh token works once; using
+    one again logs out every session descended from the same login.
+    '''
+    outcome, user_id, refresh_token = await refresh_tokens.rotate(db, token.refresh_token)
+    if outcome != refresh_tokens.REFRESHED:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid refresh token"
+        )
+
+    access_token = oauth2.create_access_token(data={"user_id": user_id})
+    replica_router.pin(request, access_token)
+    return {
+        "access_token": access_token,
+        "token_type": "bearer",
+        "refresh_token": refresh_token
+    }
+
+
+@router.post(
+    '/token/revoke',
+    status_code=status.HTTP_204_NO_CONTENT
+)
+@query_budget(2)
+async def revoke(
+    db: AsyncSession = Depends(get_db),
+    current_user=Depends(oauth2.get_current_user)
+):
+    '''Revoke the current user's refresh tokens, logging out every session
+    once its access token expires'''
+    await refresh_tokens.revoke_user(db, current_user.id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
@@ -0,0 +1,23 @@
+'''internal.py'''
+from fastapi import APIRouter, Depends
+
+from .. import oauth2, warmup
+from ..dbpool import pool_stats
+
+router = APIRouter(
+    prefix="/internal",
+    tags=['Internal'],
+    include_in_schema=False
+)
+
+
+@router.get('/pool')
+def get_pool_stats(current_user=Depends(oauth2.get_current_admin)):
+    '''Connection pool usage and checkout wait times per engine (admins only)'''
+    return {name: stats.snapshot() for name, stats in pool_stats.items()}
+
+
+@router.get('/warmup')
+def get_warmup_timings(current_user=Depends(oauth2.get_current_admin)):
+    '''Seconds spent in each startup warmup step (admins only)'''
+    return warmup.timings
@@ -0,0 +1,149 @@
+'''metrics.py'''
+import secrets
+
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
+
+from .. import admission, oauth2, refresh_tokens
+from ..broadcast import broadcast
+from ..config import settings
+from ..database import replica_router
+from ..dbpool import pool_stats
+from ..metrics import registry
+from ..passwords import password_service
+from ..query_budget import exceeded
+from ..response_cache import response_cache
+from ..vote_stream import vote_stream
+
+router = APIRouter(tags=['Internal'], include_in_schema=False)
+
+
+def _pool_gauge(field: str):
+    def collect():
+        samples = {}
+        for name, stats in pool_stats.items():
+            value = stats.snapshot().get(field)
+            if value is not None:
+                samples[(name,)] = value
+        return samples
+    return collect
+
+
+for field, help in (
+    ("checked_out", "Connections checked out of the pool"),
+    ("overflow", "Connections open beyond pool_size"),
+    ("timeouts", "Checkouts that timed out waiting for a connection"),
+    ("wait_max_ms", "Longest checkout wait in milliseconds"),
+):
+    registry.gauge(f"db_pool_{field}", help, ("engine",), _pool_gauge(field))
+
+registry.gauge(
+    "db_replica_healthy", "1 while a read replica passes its health checks", ("replica",),
+    lambda: {(replica.name,): int(replica.healthy) for replica in replica_router.replicas}
+)
+registry.gauge(
+    "db_sessions_routed", "Request sessions opened per database", ("database",),
+    lambda: {
+        ("primary",): replica_router.primary_sessions,
+        **{(replica.name,): replica.sessions for replica in replica_router.replicas},
+    }
+)
+
+for field, help in (
+    ("limit", "Adaptive in-flight request limit"),
+    ("in_flight", "Requests admitted and not yet finished"),
+    ("admitted", "Requests admitted"),
+    ("rejected", "Requests shed with a 503 at the limit"),
+):
+    registry.gauge(
+        f"admission_{field}", help, ("class",),
+        lambda field=field: {
+            (cls,): round(getattr(limit, field), 2) for cls, limit in admission.limits.items()
+        }
+    )
+
+registry.gauge(
+    "http_request_db_query_budget_exceeded",
+    "Requests that ran more SQL statements than their route's budget",
+    ("method", "route"), lambda: exceeded
+)
+
+registry.gauge(
+    "auth_cache_hits", "Authentication cache hits", ("cache",),
+    lambda: {("user",): oauth2.user_cache.hits, ("token",): oauth2.token_cache.hits}
+)
+registry.gauge(
+    "auth_cache_misses", "Authentication cache misses", ("cache",),
+    lambda: {("user",): oauth2.user_cache.misses, ("token",): oauth2.token_cache.misses}
+)
+
+registry.gauge(
+    "auth_refresh_tokens", "Refresh tokens issued and refresh outcomes", ("outcome",),
+    lambda: {(outcome,): count for outcome, count in refresh_tokens.stats.items()}
+)
+
+
+def _bcrypt_seconds_avoided():
+    # Each refresh stands in for a login's bcrypt check
+    if not password_service.verifies:
+        return {}
+    mean = password_service.verify_seconds / password_service.verifies
+    return {(): refresh_tokens.stats[refresh_tokens.REFRESHED] * mean}
+
+
+registry.gauge(
+    "auth_bcrypt_seconds_avoided",
+    "bcrypt CPU seconds saved by refreshing tokens instead of logging in again",
+    (), _bcrypt_seconds_avoided
+)
+
+registry.gauge(
+    "response_cache", "Post response cache counters", ("stat",),
+    lambda: {
+        ("hits",): response_cache.hits,
+        ("misses",): response_cache.misses,
+        ("bytes",): response_cache.size,
+    }
+)
+
+registry.gauge(
+    "broadcast_events", "Events sent to and received from the other workers", ("stat",),
+    lambda: {(stat,): count for stat, count in broadcast.stats.items()}
+)
+
+registry.gauge(
+    "vote_stream", "Live vote stream counters", ("stat",),
+    lambda: {
+        ("subscribers",): len(vote_stream.subscribers),
+        ("published",): vote_stream.stats["published"],
+        ("messages",): vote_stream.stats["messages"],
+        ("dropped",): vote_stream.stats["dropped"],
+    }
+)
+
+
+def require_scraper(request: Request):
+    '''Admits requests bearing settings.metrics_token: the pool gauges
+    are as sensitive as /internal/pool'''
+    if not settings.metrics_token:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Metrics are disabled, set METRICS_TOKEN to enable them"
+        )
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not secrets.compare_digest(
+        token.encode(), settings.metrics_token.encode()
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+
+
+@router.get('/metrics', dependencies=[Depends(require_scraper)])
+def get_metrics():
+    '''Prometheus scrape endpoint, for bearers of the metrics token'''
+    return Response(
+        registry.render(),
+        media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
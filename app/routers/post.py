@@ -1,10 +1,35 @@
 '''post.py'''
+import asyncio
+import tempfile
+from functools import partial
 from typing import List, Optional
-from sqlalchemy import func
-from sqlalchemy.orm import Session
-from fastapi import Depends, HTTPException, Response, status, APIRouter
-from .. import models, schemas, oauth2
-from ..database import get_db
+import orjson
+from pydantic import parse_obj_as
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import (
+    Depends, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect,
+    status, APIRouter
+)
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from .. import crud, models, schemas, oauth2, pagination
+from ..broadcast import broadcast
+from ..bulk import BulkImportError, export_posts, import_posts, read_posts
+from ..config import settings
+from ..database import async_engine, get_db
+from ..response_cache import (
+    FEED_HEAD, FEED_OFFSET, SEARCH, post_key, post_tag, posts_key, response_cache
+)
+from ..query_budget import query_budget
+from ..replicas import reads_own_writes, reads_replica
+from ..search import search_posts
+from ..trending import trending_index
+from ..vote_stream import vote_stream
+from ..serializers import serialize_many, serialize_post_out
+
+# Import bodies larger than this are spooled to disk
+UPLOAD_SPOOL_BYTES = 8 * 1024 * 1024
 
 router = APIRouter(
     prefix="/posts",
@@ -12,28 +37,250 @@ router = APIRouter(
 )
 
 
+def _render(serializer, model, data):
+    '''JSON body for trusted rows, validated only if fast_responses is off'''
+    if settings.fast_responses:
+        return orjson.dumps(serializer(data))
+    return orjson.dumps(jsonable_encoder(parse_obj_as(model, data)))
+
+
 @router.get("/", response_model=List[schemas.PostOut])
-def get_posts(
-    db: Session = Depends(get_db),
+@query_budget(2)
+async def get_posts(
+    request: Request,
+    db: AsyncSession = Depends(get_db),
     current_user=Depends(oauth2.get_current_user),
-    limit: int = 10,
-    skip: int = 0,
+    limit: int = Query(10, ge=1, le=100),
+    cursor: Optional[str] = None,
+    skip: int = Query(0, ge=0, deprecated=True),
     search: Optional[str] = ""
 ):
-    '''Get All Posts'''
+    '''Get All Posts
+
+    Pages newest first. Pass the X-Next-Cursor / X-Prev-Cursor response
+    header back as `cursor` to move between pages; `skip` is kept only
+    for older clients and still pages with OFFSET. A `search` term ranks
+    matching posts by relevance instead, paged with `skip`.
+    '''
+    key = posts_key(limit, cursor, skip, search)
+    cached = None if reads_own_writes(request) else response_cache.get(key)
+    if cached is not None:
+        return cached.to_response(request)
+    generation = response_cache.generation()
+
     # posts = db.query(models.Post).filter(models.Post.title.contains(search)).limit(limit).offset(skip).all()
 
-    posts = db.query(
-        models.Post,
-        func.count(models.Vote.post_id).label('votes')).join(
-            models.Vote,
-            models.Vote.post_id == models.Post.id,
-            isouter=True
-        ).group_by(models.Post.id).filter(models.Post.title.contains(search)).limit(limit).offset(skip).all()
+    posts_query = crud.posts_with_votes()
+
+    headers = {}
+    if search and search.strip():
+        posts_query = search_posts(db, posts_query, search.strip())
+        posts = (await db.execute(posts_query.limit(limit).offset(skip))).all()
+        tags = {SEARCH}
+    elif skip and cursor is None:
+        posts_query = posts_query.order_by(
+            models.Post.created_at.desc(), models.Post.id.desc()
+        )
+        posts = (await db.execute(posts_query.limit(limit).offset(skip))).all()
+        tags = {FEED_OFFSET}
+    else:
+        posts, next_cursor, prev_cursor, lookahead_id = await pagination.keyset_page(
+            db, posts_query, limit, cursor
+        )
+        if next_cursor:
+            headers["X-Next-Cursor"] = next_cursor
+        if prev_cursor:
+            headers["X-Prev-Cursor"] = prev_cursor
+        # Only a page at the top of the feed changes when a post is added
+        tags = set() if prev_cursor else {FEED_HEAD}
+        # Deleting the post past the page may leave no page to go on to
+        if lookahead_id is not None:
+            tags.add(post_tag(lookahead_id))
 
     # To get posts only of current_user
     # posts = db.query(models.Post).filter(models.Post.owner_id == current_user.id).all()
-    return posts
+    tags.update(post_tag(row.Post.id) for row in posts)
+    body = _render(
+        partial(serialize_many, serialize_post_out),
+        List[schemas.PostOut],
+        posts
+    )
+    # A lagging replica's body would be served to clients pinned to the primary
+    return response_cache.set(
+        key, body, headers, tags, generation, store=not reads_replica(request)
+    ).to_response(request)
+
+
+@router.get("/trending", response_model=List[schemas.PostOut])
+@query_budget(2)
+async def get_trending_posts(
+    db: AsyncSession = Depends(get_db),
+    current_user=Depends(oauth2.get_current_user),
+    limit: int = Query(10, ge=1, le=100)
+):
+    '''Get Trending Posts
+
+    Hottest first, by votes and recency with a configurable half-life.
+    '''
+    ids = [post_id for post_id, score in trending_index.top(limit)]
+    posts = await crud.get_posts_with_votes(db, ids)
+    return Response(
+        _render(partial(serialize_many, serialize_post_out), List[schemas.PostOut], posts),
+        media_type="application/json"
+    )
+
+
+@router.post(
+    "/import",
+    status_code=status.HTTP_201_CREATED,
+    response_model=schemas.ImportResult
+)
+async def import_post_file(
+    request: Request,
+    format: str = Query("ndjson", regex="^(ndjson|csv)$"),
+    current_user=Depends(oauth2.get_current_admin)
+):
+    '''Bulk import posts from an NDJSON or CSV request body (admins only)
+
+    Rows need title and content, and may set published and owner_id;
+    posts without an owner_id belong to the importing admin. The body is
+    spooled to a temporary file and loaded in a single transaction; file
+    writes and parsing run in worker threads.
+    '''
+    with tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES) as upload:
+        async for chunk in request.stream():
+            await run_in_threadpool(upload.write, chunk)
+        upload.seek(0)
+        try:
+            ids = await import_posts(
+                async_engine,
+                read_posts(upload, format, owner_id=current_user.id)
+            )
+        except BulkImportError as exc:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=str(exc)
+            )
+    broadcast.publish("responses", FEED_HEAD, FEED_OFFSET, SEARCH)
+    for post_id in ids:
+        broadcast.publish("trending_add", post_id)
+    return {"imported": len(ids)}
+
+
+@router.get("/export", response_class=StreamingResponse)
+async def export_post_file(
+    db: AsyncSession = Depends(get_db),
+    current_user=Depends(oauth2.get_current_admin)
+):
+    '''Stream every post with its vote count as NDJSON (admins only)'''
+    return StreamingResponse(
+        export_posts(db),
+        media_type="application/x-ndjson"
+    )
+
+
+async def _vote_events(post_ids):
+    '''Server-sent events for a vote stream subscription'''
+    subscriber = vote_stream.subscribe(post_ids)
+    try:
+        # How soon EventSource reconnects once the stream is dropped
+        yield b"retry: 1000\n\n"
+        while True:
+            message = await subscriber.next_message(settings.vote_stream_keepalive_seconds)
+            if subscriber.dropped:
+                return
+            if message is None:
+                yield b": keepalive\n\n"
+            else:
+                yield b"event: votes\ndata: " + orjson.dumps(
+                    message, option=orjson.OPT_NON_STR_KEYS
+                ) + b"\n\n"
+    finally:
+        vote_stream.unsubscribe(subscriber)
+
+
+@router.get("/stream", response_class=StreamingResponse)
+async def stream_votes(
+    ids: List[int] = Query(...),
+    user_id: int = Depends(oauth2.get_current_user_id)
+):
+    '''Stream vote count changes of the given posts as server-sent events
+
+    Pass each post as `ids`. Each `votes` event is a JSON object of post
+    id to the change in its votes since the last event; posts whose
+    count did not change are left out. Read the counts themselves with
+    GET /posts/{id}, and again after reconnecting.
+    '''
+    if len(set(ids)) > vote_stream.max_posts:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"A stream may watch at most {vote_stream.max_posts} posts"
+        )
+    return StreamingResponse(
+        _vote_events(ids),
+        media_type="text/event-stream",
+        # X-Accel-Buffering stops nginx from holding events back
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+def _websocket_token(websocket: WebSocket):
+    '''The bearer token of a WebSocket handshake. Browsers cannot set
+    headers on one, so the access_token query parameter also works'''
+    scheme, _, token = websocket.headers.get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and token:
+        return token
+    return websocket.query_params.get("access_token", "")
+
+
+async def _receive_subscriptions(websocket: WebSocket, subscriber):
+    '''Applies the client's subscribe and unsubscribe messages until it
+    disconnects'''
+    while True:
+        try:
+            subscription = schemas.StreamSubscription.parse_raw(await websocket.receive_text())
+            vote_stream.unwatch(subscriber, subscription.unsubscribe)
+            vote_stream.watch(subscriber, subscription.subscribe)
+        except WebSocketDisconnect:
+            return
+        except ValueError as exc:
+            await websocket.send_text(orjson.dumps({"error": str(exc)}).decode())
+
+
+@router.websocket("/stream")
+async def stream_votes_websocket(websocket: WebSocket):
+    '''Stream vote count changes over a WebSocket
+
+    Send `{"subscribe": [ids]}` and `{"unsubscribe": [ids]}` to choose
+    the posts. Messages are `{"votes": {post id: change}}` as in the
+    server-sent events of GET /posts/stream. A client too slow to keep
+    up is disconnected with code 1013.
+    '''
+    try:
+        oauth2.get_current_user_id(_websocket_token(websocket))
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+
+    subscriber = vote_stream.subscribe()
+    receiver = asyncio.ensure_future(_receive_subscriptions(websocket, subscriber))
+    try:
+        while True:
+            getter = asyncio.ensure_future(subscriber.next_message(None))
+            await asyncio.wait((getter, receiver), return_when=asyncio.FIRST_COMPLETED)
+            if receiver.done():
+                getter.cancel()
+                return
+            if subscriber.dropped:
+                await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+                return
+            await websocket.send_text(orjson.dumps(
+                {"votes": getter.result()}, option=orjson.OPT_NON_STR_KEYS
+            ).decode())
+    finally:
+        receiver.cancel()
+        vote_stream.unsubscribe(subscriber)
 
 
 @router.get(
@@ -41,26 +288,31 @@ def get_posts(
     status_code=status.HTTP_200_OK,
     response_model=schemas.PostOut
 )
-def get_post(
+@query_budget(2)
+async def get_post(
     id: int,
-    db: Session = Depends(get_db),
+    request: Request,
+    db: AsyncSession = Depends(get_db),
     current_user=Depends(oauth2.get_current_user)
 ):
     '''Get Post with specified ID'''
+    key = post_key(id)
+    cached = None if reads_own_writes(request) else response_cache.get(key)
+    if cached is not None:
+        return cached.to_response(request)
+    generation = response_cache.generation()
+
     # post = db.query(models.Post).get(id)
-    post = db.query(
-        models.Post,
-        func.count(models.Vote.post_id).label('votes')).join(
-            models.Vote,
-            models.Vote.post_id == models.Post.id,
-            isouter=True
-        ).group_by(models.Post.id).filter(models.Post.id == id).first()
+    post = await crud.get_post_with_votes(db, id)
     if post is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Post Not Found"
         )
-    return post
+    body = _render(serialize_post_out, schemas.PostOut, post)
+    return response_cache.set(
+        key, body, {}, {post_tag(id)}, generation, store=not reads_replica(request)
+    ).to_response(request)
 
 
 @router.post(
@@ -68,44 +320,48 @@ def get_post(
     status_code=status.HTTP_201_CREATED,
     response_model=schemas.Post
 )
-def create_post(
+@query_budget(3)
+async def create_post(
     post: schemas.PostCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user=Depends(oauth2.get_current_user)
 ):
     '''Create Post'''
 
-    new_post = models.Post(owner_id=current_user.id, **post.dict())
-    db.add(new_post)
-    db.commit()
-    db.refresh(new_post)
-    return new_post
+    new_post = await crud.create_post(db, current_user.id, post)
+    broadcast.publish("responses", FEED_HEAD, FEED_OFFSET, SEARCH)
+    broadcast.publish("trending_add", new_post.id)
+    return {**new_post._mapping, "owner": current_user}
+
+
+async def _write_refused(db, id: int):
+    '''The error for an ownership-checked write that matched no post'''
+    if await crud.post_exists(db, id):
+        return HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not Authorised to perform requested action"
+        )
+    return HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail="Post Not Found"
+    )
 
 
 @router.delete(
     "/{id}",
     status_code=status.HTTP_204_NO_CONTENT
 )
-def delete_post(
+@query_budget(3)
+async def delete_post(
     id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user=Depends(oauth2.get_current_user)
 ):
     '''Delete Post with specified ID'''
-    post_query = db.query(models.Post).filter(models.Post.id == id)
-    post = post_query.first()
-    if post is None:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Post Not Found"
-        )
-    if post.owner_id != current_user.id:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Not Authorised to perform requested action"
-        )
-    post_query.delete(synchronize_session=False)
-    db.commit()
+    if not await crud.delete_post(db, id, current_user.id):
+        raise await _write_refused(db, id)
+    broadcast.publish("responses", post_tag(id), FEED_OFFSET, SEARCH)
+    broadcast.publish("trending_remove", id)
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
@@ -114,25 +370,17 @@ def delete_post(
     status_code=status.HTTP_202_ACCEPTED,
     response_model=schemas.Post
 )
-def update_post(
+@query_budget(3)
+async def update_post(
     id: int,
     updated_post: schemas.PostCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user=Depends(oauth2.get_current_user)
 ):
     '''Update Post with specified ID'''
-    post_query = db.query(models.Post).filter(models.Post.id == id)
-    post = post_query.first()
+    post = await crud.update_post(db, id, current_user.id, updated_post)
     if post is None:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Post Not Found"
-            )
-    if post.owner_id != current_user.id:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Not Authorised to perform requested action"
-        )
-    post_query.update(updated_post.dict(), synchronize_session=False)
-    db.commit()
-    return post_query.first()
+        raise await _write_refused(db, id)
+    broadcast.publish("responses", post_tag(id), SEARCH)
+    # Only the owner gets this far, so the owner is the current user
+    return {**post._mapping, "owner": current_user}
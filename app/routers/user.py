@@ -1,11 +1,15 @@
 '''user.py'''
 from typing import List
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import APIRouter, Depends, HTTPException, Response, status
 
 from app import oauth2
-from .. import models, schemas, utils
+from .. import crud, refresh_tokens, schemas
+from ..broadcast import broadcast
 from ..database import get_db
+from ..passwords import password_service
+from ..query_budget import query_budget
+from ..response_cache import FEED_HEAD, FEED_OFFSET, SEARCH, post_tag
 
 router = APIRouter(
     prefix="/users",
@@ -13,28 +17,49 @@ router = APIRouter(
 )
 
 
+def _not_found():
+    return HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail="User Not Found"
+    )
+
+
+def _email_taken():
+    return HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail="User with the email already exists"
+    )
+
+
+async def _check_self(db, id: int, current_user):
+    '''Users may only change themselves; 404 for unknown ids, else 403'''
+    if id == current_user.id:
+        return
+    if await crud.get_user(db, id) is None:
+        raise _not_found()
+    raise HTTPException(
+        status_code=status.HTTP_403_FORBIDDEN,
+        detail="Not Authorised to perform requested action"
+    )
+
+
 @router.post(
     "/",
     status_code=status.HTTP_201_CREATED,
     response_model=schemas.User
 )
-def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
+@query_budget(3)
+async def create_user(user: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
     '''Create User'''
-
-    found_user = db.query(models.User).filter(models.User.email == user.email).first()
-    if found_user is not None:
-        raise HTTPException(
-            status_code=status.HTTP_409_CONFLICT,
-            detail="User with the email already exists"
-        )
+    # Checked first so duplicates cost no bcrypt work
+    if await crud.get_user_by_email(db, user.email) is not None:
+        raise _email_taken()
     # hash the password
-    hashed_password = utils.hash(user.password)
-    user.password = hashed_password
+    hashed_password = await password_service.hash(user.password)
 
-    new_user = models.User(**user.dict())
-    db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    new_user = await crud.create_user(db, user.email, hashed_password)
+    if new_user is None:
+        raise _email_taken()
     return new_user
 
 
@@ -43,13 +68,13 @@ def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
     status_code=status.HTTP_200_OK,
     response_model=List[schemas.User]
 )
-def get_users(
-    db: Session = Depends(get_db),
+@query_budget(2)
+async def get_users(
+    db: AsyncSession = Depends(get_db),
     current_user=Depends(oauth2.get_current_user)
 ):
     '''Get All Users'''
-    users = db.query(models.User).all()
-    return users
+    return await crud.get_users(db)
 
 
 @router.get(
@@ -57,18 +82,16 @@ def get_users(
     status_code=status.HTTP_200_OK,
     response_model=schemas.User
 )
-def get_user(
+@query_budget(2)
+async def get_user(
     id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user=Depends(oauth2.get_current_user)
 ):
     '''Get User with specified ID'''
-    user = db.query(models.User).get(id)
+    user = await crud.get_user(db, id)
     if user is None:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User Not Found"
-        )
+        raise _not_found()
 
     return user
 
@@ -77,25 +100,28 @@ def get_user(
     "/{id}",
     status_code=status.HTTP_204_NO_CONTENT
 )
-def delete_user(
+@query_budget(4)
+async def delete_user(
     id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user=Depends(oauth2.get_current_user)
 ):
     '''Delete User with specified ID'''
-    user = db.query(models.User).filter(models.User.id == id)
-    if user.first() is None:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User Not Found"
-        )
-    if user.first().id != current_user.id:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Not Authorised to perform requested action"
-        )
-    user.delete(synchronize_session=False)
-    db.commit()
+    await _check_self(db, id, current_user)
+    deleted = await crud.delete_user(db, id)
+    if deleted is None:
+        raise _not_found()
+    owned, voted_on = deleted
+    broadcast.publish("user", id)
+    for post_id in owned:
+        broadcast.publish("trending_remove", post_id)
+    for post_id in voted_on:
+        broadcast.publish("trending_vote", post_id, 0)
+        broadcast.publish("votes", post_id, -1)
+    tags = [post_tag(post_id) for post_id in owned + voted_on]
+    if owned:
+        tags += [FEED_HEAD, FEED_OFFSET, SEARCH]
+    broadcast.publish("responses", *tags)
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
@@ -104,25 +130,23 @@ def delete_user(
     status_code=status.HTTP_202_ACCEPTED,
     response_model=schemas.User
 )
-def update_user(
+@query_budget(4)
+async def update_user(
     id: int,
     updated_user: schemas.UserCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user=Depends(oauth2.get_current_user)
 ):
     '''Update User with specified ID'''
-    user_query = db.query(models.User).filter(models.User.id == id)
-    found_user = user_query.first()
-    if found_user is None:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User Not Found"
-        )
-    if found_user.id != current_user.id:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Not Authorised to perform requested action"
-        )
-    user_query.update(updated_user.dict(), synchronize_session=False)
-    db.commit()
-    return user_query.first()
+    await _check_self(db, id, current_user)
+    values = updated_user.dict()
+    values["password"] = await password_service.hash(updated_user.password)
+    user = await crud.update_user(db, id, values)
+    if user is None:
+        raise _not_found()
+    if user is False:
+        raise _email_taken()
+    broadcast.publish("user", id)
+    # A new password ends the sessions started with the old one
+    await refresh_tokens.revoke_user(db, id)
+    return user
@@ -1,52 +1,82 @@
 '''vote.py'''
-from typing import List, Optional
-from sqlalchemy.orm import Session
-from fastapi import Depends, HTTPException, Response, status, APIRouter
-from .. import models, schemas, oauth2
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import Depends, HTTPException, status, APIRouter
+from .. import schemas, oauth2, votes
+from ..broadcast import broadcast
 from ..database import get_db
+from ..query_budget import query_budget
+from ..response_cache import post_tag
 
 router = APIRouter(
     prefix="/vote",
     tags=['Vote']
 )
 
+
+def _publish(items, outcomes):
+    '''Evicts cached responses showing the counts of changed posts and
+    feeds the changes to the trending index and vote streams, in every
+    worker'''
+    changed = [
+        vote for vote, outcome in zip(items, outcomes)
+        if outcome in (votes.VOTED, votes.DELETED)
+    ]
+    if changed:
+        broadcast.publish("responses", *(post_tag(vote.post_id) for vote in changed))
+    for vote in changed:
+        broadcast.publish("trending_vote", vote.post_id, vote.dir)
+        broadcast.publish("votes", vote.post_id, 1 if vote.dir else -1)
+
+
 @router.post(
     '',
     status_code=status.HTTP_201_CREATED
 )
-def vote(
+@query_budget(5)
+async def vote(
     vote: schemas.Vote,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user=Depends(oauth2.get_current_user)
 ):
-    post = db.query(models.Post).get(vote.post_id)
-    if post is None:
+    outcome, = await votes.apply_votes(db, current_user.id, [vote])
+    _publish([vote], [outcome])
+    if outcome == votes.POST_NOT_FOUND:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Post Not Found"
         )
-    vote_query = db.query(models.Vote).filter(
-        models.Vote.post_id == vote.post_id,
-        models.Vote.user_id == current_user.id
-    )
-    found_vote = vote_query.first()
-    if vote.dir:
-        if found_vote:
-            raise HTTPException(
-                status_code=status.HTTP_409_CONFLICT,
-                detail=f'user {current_user.id} has aready voted on post {vote.post_id}'
-            )
-        new_vote = models.Vote(post_id = vote.post_id, user_id = current_user.id)
-        db.add(new_vote)
-        db.commit()
+    if outcome == votes.ALREADY_VOTED:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f'user {current_user.id} has aready voted on post {vote.post_id}'
+        )
+    if outcome == votes.NOT_VOTED:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail='Vote does not exist'
+        )
+    if outcome == votes.VOTED:
         return {'message': 'sucussefully voted'}
-    else:
-        if not found_vote:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail='Vote does not exist'
-            )
-        vote_query.delete(synchronize_session=False)
-        db.commit()
+    return{'message': 'Vote deleted'}
+
 
-        return{'message': 'Vote deleted'}
+@router.post(
+    '/batch',
+    status_code=status.HTTP_200_OK,
+    response_model=schemas.VoteBatchOut
+)
+@query_budget(7)
+async def vote_batch(
+    batch: schemas.VoteBatch,
+    db: AsyncSession = Depends(get_db),
+    current_user=Depends(oauth2.get_current_user)
+):
+    '''Apply many votes at once, reporting an outcome per item'''
+    outcomes = await votes.apply_votes(db, current_user.id, batch.votes)
+    _publish(batch.votes, outcomes)
+    return {
+        'results': [
+            {'post_id': vote.post_id, 'dir': vote.dir, 'status': outcome}
+            for vote, outcome in zip(batch.votes, outcomes)
+        ]
+    }
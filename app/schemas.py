@@ -1,6 +1,6 @@
 '''Schemas.py'''
-from typing import Optional
-from pydantic import BaseModel, EmailStr, conint
+from typing import List, Optional
+from pydantic import BaseModel, EmailStr, conint, conlist, validator
 
 
 class UserCreate(BaseModel):
@@ -20,6 +20,15 @@ class User(BaseModel):
         orm_mode = True
 
 
+class CurrentUser(User):
+    '''Pydantic CurrentUser Model:
+    Immutable snapshot of the authenticated user, safe to cache'''
+
+    class Config:
+        orm_mode = True
+        frozen = True
+
+
 class UserLogin(BaseModel):
     '''Pydantic Userogin Model:
     Used for validation of request coming from Postman'''
@@ -41,6 +50,17 @@ class PostCreate(PostBase):
     pass
 
 
+class PostImport(PostBase):
+    '''Pydantic PostImport Model:
+    Used for validation of rows in a bulk post import'''
+    owner_id: int
+
+
+class ImportResult(BaseModel):
+    '''Pydantic ImportResult Model: Used for sending import counts to Postman'''
+    imported: int
+
+
 class Post(PostBase):
     '''Pydantic Post Model: Used for sending Post data to Postman'''
     id: int
@@ -65,6 +85,13 @@ class Token(BaseModel):
     Used for sending Post data to Postman'''
     access_token: str
     token_type: str
+    refresh_token: str
+
+
+class TokenRefresh(BaseModel):
+    '''Pydantic TokenRefresh Model:
+    Used for receiving refresh tokens from Postman'''
+    refresh_token: str
 
 
 class TokenData(BaseModel):
@@ -77,3 +104,35 @@ class Vote(BaseModel):
     Used for validation of request coming from Postman'''
     post_id: int
     dir: conint(le=1)  # either 0 or 1
+
+
+class VoteBatch(BaseModel):
+    '''Pydantic VoteBatch Model:
+    Used for validation of batched votes coming from Postman'''
+    votes: conlist(Vote, min_items=1, max_items=500)
+
+    @validator('votes')
+    def unique_posts(cls, votes):
+        post_ids = [vote.post_id for vote in votes]
+        if len(set(post_ids)) != len(post_ids):
+            raise ValueError('each post_id may appear only once per batch')
+        return votes
+
+
+class VoteOutcome(BaseModel):
+    '''Pydantic VoteOutcome Model: Used for sending vote results to Postman'''
+    post_id: int
+    dir: int
+    status: str
+
+
+class VoteBatchOut(BaseModel):
+    '''Pydantic VoteBatchOut Model: Used for sending vote results to Postman'''
+    results: List[VoteOutcome]
+
+
+class StreamSubscription(BaseModel):
+    '''Pydantic StreamSubscription Model:
+    Used for validation of messages on the /posts/stream WebSocket'''
+    subscribe: List[int] = []
+    unsubscribe: List[int] = []
@@ -0,0 +1,66 @@
+'''search.py'''
+from sqlalchemy import column, false, func, literal_column, or_, table
+
+from . import models
+
+# FTS5 index kept in sync with posts by the triggers in models.py
+posts_fts = table("posts_fts", column("rowid"), column("rank"))
+
+
+def _like_pattern(term: str):
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def _postgres(query, term: str):
+    search_vector = literal_column("posts.search_vector")
+    # asyncpg binds strings as varchar, which does not cast to regconfig
+    ts_query = func.websearch_to_tsquery(literal_column("'english'::regconfig"), term)
+    pattern = _like_pattern(term)
+    # @@ is served by the GIN tsvector index, ILIKE by the trigram indexes
+    query = query.where(or_(
+        search_vector.op("@@")(ts_query),
+        models.Post.title.ilike(pattern, escape="\\"),
+        models.Post.content.ilike(pattern, escape="\\"),
+    ))
+    rank = func.ts_rank(search_vector, ts_query) + func.similarity(
+        models.Post.title, term
+    )
+    return query.order_by(rank.desc(), models.Post.id.desc())
+
+
+def _fts5_query(term: str):
+    # Quote every word so user input can't use FTS5 query syntax, and
+    # prefix-match it to approximate substring search
+    words = ('"' + word.replace('"', '""') + '"*' for word in term.split())
+    return " ".join(words)
+
+
+def _sqlite(query, term: str):
+    match = _fts5_query(term)
+    if not match:
+        return query.where(false())
+    query = query.join(posts_fts, posts_fts.c.rowid == models.Post.id).where(
+        literal_column("posts_fts").op("MATCH")(match)
+    )
+    # FTS5 rank is bm25, where lower is more relevant
+    return query.order_by(posts_fts.c.rank, models.Post.id.desc())
+
+
+def _fallback(query, term: str):
+    pattern = _like_pattern(term)
+    query = query.where(or_(
+        models.Post.title.ilike(pattern, escape="\\"),
+        models.Post.content.ilike(pattern, escape="\\"),
+    ))
+    return query.order_by(models.Post.created_at.desc(), models.Post.id.desc())
+
+
+def search_posts(db, query, term: str):
+    '''Filters a select over Post to posts matching term, most relevant first'''
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        return _postgres(query, term)
+    if dialect == "sqlite":
+        return _sqlite(query, term)
+    return _fallback(query, term)
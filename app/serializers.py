@@ -0,0 +1,45 @@
+'''serializers.py
+
+Row-to-dict serializers compiled once from the response schemas. They
+read attributes straight off trusted ORM rows, skipping the pydantic
+validation FastAPI runs for response_model, and pair with orjson.
+'''
+from operator import attrgetter
+
+from pydantic import BaseModel
+
+from . import schemas
+
+
+def compile_serializer(model):
+    '''Builds a function turning an ORM object or Row into the dict
+    that model would produce'''
+    fields = []
+    for name, field in model.__fields__.items():
+        get = attrgetter(name)
+        if isinstance(field.type_, type) and issubclass(field.type_, BaseModel):
+            nested = compile_serializer(field.type_)
+            fields.append((name, get, nested))
+        else:
+            fields.append((name, get, None))
+
+    def serialize(obj):
+        data = {}
+        for name, get, nested in fields:
+            value = get(obj)
+            if nested is not None and value is not None:
+                value = nested(value)
+            data[name] = value
+        return data
+
+    serialize.__name__ = f"serialize_{model.__name__}"
+    return serialize
+
+
+serialize_user = compile_serializer(schemas.User)
+serialize_post = compile_serializer(schemas.Post)
+serialize_post_out = compile_serializer(schemas.PostOut)
+
+
+def serialize_many(serializer, rows):
+    return [serializer(row) for row in rows]
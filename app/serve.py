@@ -0,0 +1,215 @@
+'''serve.py
+
+Production entry point, `python -m app.serve`: a supervisor forking
+preloaded uvicorn workers that share one socket.
+'''
+import argparse
+import logging
+import math
+import os
+import random
+import signal
+import time
+
+import uvicorn
+
+from .config import settings
+
+logger = logging.getLogger("app.serve")
+
+# A worker that dies sooner than this after starting is crashing, so the
+# supervisor waits a moment before replacing it
+MIN_WORKER_SECONDS = 5
+
+
+def _read(path: str):
+    try:
+        with open(path) as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+
+def cpu_count():
+    '''CPUs this process may use, honouring a cgroup CPU quota'''
+    quota = _read("/sys/fs/cgroup/cpu.max")
+    if quota is not None:
+        limit, _, period = quota.partition(" ")
+        if limit != "max":
+            return max(1, math.ceil(int(limit) / int(period)))
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def memory_bytes():
+    '''Memory available to this process's cgroup, else physical memory'''
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        value = _read(path)
+        # cgroup v1 reports "no limit" as a huge number
+        if value is not None and value != "max" and int(value) < 1 << 60:
+            return int(value)
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def worker_count():
+    if settings.web_concurrency:
+        return settings.web_concurrency
+    workers = cpu_count()
+    memory = memory_bytes()
+    if memory is not None:
+        workers = min(workers, max(1, memory // (settings.worker_memory_mb * 1024 * 1024)))
+    return workers
+
+
+def _installed(module: str, fallback: str):
+    '''module's name if it can be imported, else fallback'''
+    try:
+        __import__(module)
+    except ImportError:
+        logger.warning("%s is not installed, using %s", module, fallback)
+        return fallback
+    return module
+
+
+def _after_fork():
+    '''Drops state a worker must not share with its parent and siblings'''
+    from .database import engine
+
+    # The supervisor never connects, but make sure no pooled socket is
+    # shared between processes. The async engines are left alone: a
+    # recreated async pool guards its first connect with a threading lock,
+    # which deadlocks concurrent connects on the event loop
+    engine.dispose(close=False)
+    random.seed()
+
+
+class Supervisor:
+    '''Forks uvicorn workers sharing one socket and replaces those that exit'''
+
+    def __init__(self, config: uvicorn.Config, workers: int,
+                 max_requests: int, max_requests_jitter: int):
+        self.config = config
+        self.workers = workers
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.children = {}
+        self.stopping = False
+
+    def spawn(self, socket):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            _after_fork()
+            if self.max_requests:
+                self.config.limit_max_requests = self.max_requests + random.randint(
+                    0, self.max_requests_jitter
+                )
+            os._exit(self._serve(socket))
+        self.children[pid] = time.monotonic()
+        logger.info("started worker %d", pid)
+
+    def _serve(self, socket):
+        '''Runs uvicorn in a forked worker; returns its exit code'''
+        try:
+            uvicorn.Server(self.config).run(sockets=[socket])
+        except SystemExit as exc:
+            return exc.code if isinstance(exc.code, int) else 1
+        except BaseException:
+            logger.exception("worker %d crashed", os.getpid())
+            return 1
+        return 0
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        socket = self.config.bind_socket()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for _ in range(self.workers):
+            self.spawn(socket)
+
+        while self.children:
+            pid, status = os.wait()
+            started = self.children.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            if code == 0:
+                logger.info("worker %d reached max_requests, replacing it", pid)
+            else:
+                logger.warning("worker %d exited with %d, replacing it", pid, code)
+                if time.monotonic() - started < MIN_WORKER_SECONDS:
+                    time.sleep(1)
+            self.spawn(socket)
+        socket.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.serve")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=settings.port)
+    parser.add_argument("--workers", type=int, help="default: sized from CPUs and memory")
+    parser.add_argument("--max-requests", type=int, default=settings.max_requests)
+    parser.add_argument("--max-requests-jitter", type=int, default=settings.max_requests_jitter)
+    parser.add_argument("--keep-alive", type=int, default=settings.keep_alive_seconds)
+    parser.add_argument("--backlog", type=int, default=settings.backlog)
+    parser.add_argument("--loop", choices=("uvloop", "asyncio"))
+    parser.add_argument("--http", choices=("httptools", "h11"))
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(process)d %(name)s %(message)s")
+    workers = args.workers or worker_count()
+
+    # Preload: import the app once here, before forking
+    from .main import app
+
+    # Workers keep their caches in step over PostgreSQL only
+    from .broadcast import broadcast
+    if workers > 1 and not broadcast.shared:
+        parser.error(
+            f"{workers} workers need a PostgreSQL database to keep their caches "
+            "in step; use --workers 1"
+        )
+
+    # Never let each worker start a bcrypt pool of one process per CPU
+    from .passwords import password_service
+    if settings.password_workers is None:
+        password_service.workers = max(1, cpu_count() // workers)
+
+    config = uvicorn.Config(
+        app,
+        host=args.host,
+        port=args.port,
+        loop=args.loop or _installed("uvloop", "asyncio"),
+        http=args.http or _installed("httptools", "h11"),
+        backlog=args.backlog,
+        timeout_keep_alive=args.keep_alive,
+        proxy_headers=True,
+        forwarded_allow_ips="*",
+        lifespan="on",
+    )
+    logger.info(
+        "serving with %d workers, %s loop, %s parser",
+        workers, config.loop, config.http
+    )
+    if not hasattr(os, "fork"):
+        config.limit_max_requests = args.max_requests or None
+        uvicorn.Server(config).run()
+        return
+    Supervisor(config, workers, args.max_requests, args.max_requests_jitter).run()
+
+
+if __name__ == "__main__":
+    main()
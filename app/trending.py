@@ -0,0 +1,161 @@
+'''trending.py
+
+Per-worker in-memory index of the hottest posts, scored by votes with
+a half-life, served by GET /posts/trending. Writes reach the index of
+every worker through broadcast.py.
+'''
+import heapq
+import logging
+import math
+import time
+from datetime import datetime, timedelta, timezone
+from operator import itemgetter
+
+from sqlalchemy import select
+
+from . import models
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+# Rescale to a new epoch before exp() gets anywhere near overflowing
+MAX_EXPONENT = 100.0
+# Scores decayed below this are dropped when rescaling
+MIN_SCORE = 1e-3
+
+
+def _timestamp(value: datetime):
+    # SQLite hands back naive datetimes; created_at is stored in UTC
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+class TrendingIndex:
+    def __init__(self, half_life_seconds: float, capacity: int):
+        self.rate = math.log(2) / half_life_seconds
+        self.capacity = capacity
+        self.epoch = time.time()
+        self.scores = {}
+        self.leaders = {}
+        self._heap = []
+
+    def _weight(self, at: float):
+        return math.exp(self.rate * (at - self.epoch))
+
+    def add(self, post_id: int, delta: float = 1.0, at: float = None):
+        '''Adds delta events for post_id at `at` (now if not given)'''
+        at = time.time() if at is None else at
+        if self.rate * (at - self.epoch) > MAX_EXPONENT:
+            self._rescale(at)
+        score = max(self.scores.get(post_id, 0.0) + delta * self._weight(at), 0.0)
+        self.scores[post_id] = score
+        self._offer(post_id, score)
+
+    def vote(self, post_id: int, direction: int):
+        '''Records a vote being cast (1) or withdrawn (0)'''
+        self.add(post_id, 1.0 if direction else -1.0)
+
+    def remove(self, post_id: int):
+        self.scores.pop(post_id, None)
+        if self.leaders.pop(post_id, None) is not None:
+            if len(self.leaders) < self.capacity // 2 < len(self.scores):
+                self._refill()
+
+    def top(self, limit: int):
+        '''Returns up to limit (post_id, decayed score) pairs, hottest first'''
+        scale = self._weight(time.time())
+        return [
+            (post_id, score / scale)
+            for post_id, score in heapq.nlargest(limit, self.leaders.items(), key=itemgetter(1))
+        ]
+
+    def _offer(self, post_id: int, score: float):
+        if post_id not in self.leaders and len(self.leaders) >= self.capacity:
+            weakest_id, weakest = self._weakest()
+            if score <= weakest:
+                return
+            del self.leaders[weakest_id]
+        self.leaders[post_id] = score
+        heapq.heappush(self._heap, (score, post_id))
+        if len(self._heap) > 4 * self.capacity:
+            self._reheap()
+
+    def _weakest(self):
+        # Entries whose score no longer matches the leader's are stale
+        while self._heap:
+            score, post_id = self._heap[0]
+            if self.leaders.get(post_id) == score:
+                return post_id, score
+            heapq.heappop(self._heap)
+        raise LookupError("no leaders")
+
+    def _reheap(self):
+        self._heap = [(score, post_id) for post_id, score in self.leaders.items()]
+        heapq.heapify(self._heap)
+
+    def _refill(self):
+        self.leaders = dict(heapq.nlargest(self.capacity, self.scores.items(), key=itemgetter(1)))
+        self._reheap()
+
+    def _rescale(self, now: float):
+        factor = math.exp(-self.rate * (now - self.epoch))
+        self.epoch = now
+        self.scores = {
+            post_id: score * factor
+            for post_id, score in self.scores.items()
+            if score * factor >= MIN_SCORE
+        }
+        self._refill()
+
+    async def rebuild(self, db, window_seconds: float, batch_size: int = 10000):
+        '''Reloads scores for posts created within window_seconds.
+
+        Reads posts a batch of ids at a time and swaps the new scores in
+        at the end. Returns the number of posts indexed.
+        '''
+        now = time.time()
+        rebuilt = TrendingIndex(math.log(2) / self.rate, self.capacity)
+        rebuilt.epoch = now
+        cutoff = datetime.fromtimestamp(now - window_seconds, timezone.utc)
+        last_id = 0
+        while True:
+            rows = (await db.execute(
+                select(models.Post.id, models.Post.created_at, models.Post.vote_count)
+                .where(models.Post.id > last_id, models.Post.created_at >= cutoff)
+                .order_by(models.Post.id)
+                .limit(batch_size)
+            )).all()
+            if not rows:
+                break
+            for id, created_at, vote_count in rows:
+                rebuilt.add(id, 1.0 + vote_count, _timestamp(created_at))
+            last_id = rows[-1].id
+        self.epoch = rebuilt.epoch
+        self.scores = rebuilt.scores
+        self.leaders = rebuilt.leaders
+        self._heap = rebuilt._heap
+        return len(self.scores)
+
+
+trending_index = TrendingIndex(
+    half_life_seconds=settings.trending_half_life_hours * 3600,
+    capacity=settings.trending_capacity
+)
+
+
+async def rebuild(session_factory):
+    '''Rebuilds trending_index at startup; failures are logged, not raised'''
+    start = time.perf_counter()
+    try:
+        async with session_factory() as db:
+            count = await trending_index.rebuild(
+                db, timedelta(days=settings.trending_window_days).total_seconds()
+            )
+    except Exception:
+        logger.exception("trending index rebuild failed")
+        return
+    logger.info(
+        "trending index rebuilt from %d posts in %.0f ms",
+        count, (time.perf_counter() - start) * 1000
+    )
@@ -1,7 +1,13 @@
 '''utils.py'''
 from passlib.context import CryptContext
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Hashes below min_rounds are upgraded on the next successful login
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=12,
+    bcrypt__min_rounds=12
+)
 
 
 def hash(password: str):
@@ -12,3 +18,9 @@ def hash(password: str):
 def verify(password, hashed_password):
     '''Verifies if password is same'''
     return pwd_context.verify(password, hashed_password)
+
+
+def verify_and_update(password, hashed_password):
+    '''Verifies the password and, if the hash is outdated, rehashes it.
+    Returns (verified, new_hash or None)'''
+    return pwd_context.verify_and_update(password, hashed_password)
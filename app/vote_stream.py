@@ -0,0 +1,137 @@
+'''vote_stream.py
+
+Live vote count deltas for the /posts/stream endpoints, summed per post
+and sent to each subscriber once per tick. Votes handled by the other
+workers arrive through broadcast.py.
+'''
+import asyncio
+import logging
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class Subscriber:
+    '''One stream connection: the posts it watches and its pending messages'''
+    __slots__ = ("post_ids", "queue", "dropped")
+
+    def __init__(self, queue_size: int):
+        self.post_ids = set()
+        # Each message maps post id -> summed delta
+        self.queue = asyncio.Queue(queue_size)
+        self.dropped = False
+
+    async def next_message(self, timeout: float):
+        '''The next message; None after timeout or once dropped'''
+        if self.dropped:
+            return None
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class VoteStream:
+    '''Coalesces vote deltas and fans them out to subscribers every tick'''
+
+    def __init__(self, tick_seconds: float, queue_size: int, max_posts: int):
+        self.tick_seconds = tick_seconds
+        self.queue_size = queue_size
+        self.max_posts = max_posts
+        self.subscribers = set()
+        # post id -> subscribers watching it
+        self.watchers = {}
+        # post id -> delta since the last tick
+        self.pending = {}
+        self.stats = {"published": 0, "messages": 0, "dropped": 0}
+        self._task = None
+
+    def subscribe(self, post_ids=()):
+        subscriber = Subscriber(self.queue_size)
+        self.subscribers.add(subscriber)
+        self.watch(subscriber, post_ids)
+        return subscriber
+
+    def watch(self, subscriber: Subscriber, post_ids):
+        '''Adds posts to a subscription; ValueError past max_posts'''
+        post_ids = set(post_ids) - subscriber.post_ids
+        if len(subscriber.post_ids) + len(post_ids) > self.max_posts:
+            raise ValueError(f"A stream may watch at most {self.max_posts} posts")
+        subscriber.post_ids |= post_ids
+        for post_id in post_ids:
+            self.watchers.setdefault(post_id, set()).add(subscriber)
+
+    def unwatch(self, subscriber: Subscriber, post_ids):
+        for post_id in set(post_ids) & subscriber.post_ids:
+            subscriber.post_ids.discard(post_id)
+            watchers = self.watchers[post_id]
+            watchers.discard(subscriber)
+            if not watchers:
+                del self.watchers[post_id]
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.unwatch(subscriber, list(subscriber.post_ids))
+        self.subscribers.discard(subscriber)
+
+    def drop(self, subscriber: Subscriber):
+        '''Ends a subscription; its connection closes on its next read'''
+        subscriber.dropped = True
+        self.unsubscribe(subscriber)
+        # Wakes a reader waiting on an empty queue
+        try:
+            subscriber.queue.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
+
+    def publish(self, post_id: int, delta: int):
+        if post_id in self.watchers:
+            self.pending[post_id] = self.pending.get(post_id, 0) + delta
+            self.stats["published"] += 1
+
+    def flush(self):
+        '''Delivers the deltas gathered since the last tick'''
+        pending, self.pending = self.pending, {}
+        messages = {}
+        for post_id, delta in pending.items():
+            # An up and a down vote in the same tick cancel out
+            if delta:
+                for subscriber in self.watchers.get(post_id, ()):
+                    messages.setdefault(subscriber, {})[post_id] = delta
+        for subscriber, message in messages.items():
+            try:
+                subscriber.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                logger.info("dropping a vote stream subscriber %d ticks behind", self.queue_size)
+                self.stats["dropped"] += 1
+                self.drop(subscriber)
+            else:
+                self.stats["messages"] += 1
+
+    async def _tick_forever(self):
+        while True:
+            await asyncio.sleep(self.tick_seconds)
+            self.flush()
+
+    def start(self):
+        '''Starts delivering on the running event loop'''
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._tick_forever())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for subscriber in list(self.subscribers):
+            self.drop(subscriber)
+
+
+vote_stream = VoteStream(
+    settings.vote_stream_tick_seconds,
+    settings.vote_stream_queue_size,
+    settings.vote_stream_max_posts
+)
@@ -0,0 +1,127 @@
+'''votes.py
+
+Set-based vote writes shared by POST /vote and POST /vote/batch.
+'''
+from sqlalchemy import delete, insert, literal, select, union_all, update
+from sqlalchemy.dialects import postgresql
+
+from . import models
+
+# Per-item outcomes
+VOTED = "voted"
+ALREADY_VOTED = "already_voted"
+DELETED = "deleted"
+NOT_VOTED = "not_voted"
+POST_NOT_FOUND = "post_not_found"
+
+
+def _outcome(direction: int, exists: bool, changed: bool):
+    if not exists:
+        return POST_NOT_FOUND
+    if direction:
+        return VOTED if changed else ALREADY_VOTED
+    return DELETED if changed else NOT_VOTED
+
+
+async def _apply_postgres(db, user_id: int, up: list, down: list, post_ids: list):
+    '''One statement: the inserts, deletes and vote_count updates run as
+    data-modifying CTEs, and the outer SELECT reports what happened'''
+    inserted = postgresql.insert(models.Vote).from_select(
+        ["user_id", "post_id"],
+        select(literal(user_id), models.Post.id).where(models.Post.id.in_(up))
+    ).on_conflict_do_nothing().returning(models.Vote.post_id).cte("inserted")
+
+    deleted = delete(models.Vote).where(
+        models.Vote.user_id == user_id,
+        models.Vote.post_id.in_(down)
+    ).returning(models.Vote.post_id).cte("deleted")
+
+    changes = union_all(
+        select(inserted.c.post_id, literal(1).label("delta")),
+        select(deleted.c.post_id, literal(-1).label("delta")),
+    ).cte("changes")
+
+    counted = update(models.Post).where(
+        models.Post.id == changes.c.post_id
+    ).values(
+        vote_count=models.Post.vote_count + changes.c.delta
+    ).returning(models.Post.id).cte("counted")
+
+    # Every changed post has its count updated, so the posts counted
+    # returns are the changed ones
+    statement = select(
+        models.Post.id,
+        models.Post.id.in_(select(counted.c.id)).label("changed"),
+    ).where(models.Post.id.in_(post_ids))
+
+    rows = (await db.execute(statement)).all()
+    existing = {row.id for row in rows}
+    changed = {row.id for row in rows if row.changed}
+    return existing, changed
+
+
+async def _apply_generic(db, user_id: int, up: list, down: list, post_ids: list):
+    '''Fixed number of statements however many items there are, for
+    databases without data-modifying CTEs (SQLite)'''
+    existing = set((await db.execute(
+        select(models.Post.id).where(models.Post.id.in_(post_ids))
+    )).scalars())
+    voted = set((await db.execute(
+        select(models.Vote.post_id).where(
+            models.Vote.user_id == user_id,
+            models.Vote.post_id.in_(post_ids)
+        )
+    )).scalars())
+
+    to_insert = [id for id in up if id in existing and id not in voted]
+    to_delete = [id for id in down if id in voted]
+
+    if to_insert:
+        await db.execute(
+            insert(models.Vote),
+            [{"user_id": user_id, "post_id": id} for id in to_insert]
+        )
+        await db.execute(
+            update(models.Post)
+            .where(models.Post.id.in_(to_insert))
+            .values(vote_count=models.Post.vote_count + 1)
+            .execution_options(synchronize_session=False)
+        )
+    if to_delete:
+        await db.execute(
+            delete(models.Vote)
+            .where(
+                models.Vote.user_id == user_id,
+                models.Vote.post_id.in_(to_delete)
+            )
+            .execution_options(synchronize_session=False)
+        )
+        await db.execute(
+            update(models.Post)
+            .where(models.Post.id.in_(to_delete))
+            .values(vote_count=models.Post.vote_count - 1)
+            .execution_options(synchronize_session=False)
+        )
+    return existing, set(to_insert) | set(to_delete)
+
+
+async def apply_votes(db, user_id: int, votes):
+    '''Applies schemas.Vote items for user_id in one transaction.
+
+    post_ids must be unique across votes. Returns one outcome string
+    per item, in order.
+    '''
+    up = [vote.post_id for vote in votes if vote.dir]
+    down = [vote.post_id for vote in votes if not vote.dir]
+    post_ids = up + down
+
+    if db.get_bind().dialect.name == "postgresql":
+        existing, changed = await _apply_postgres(db, user_id, up, down, post_ids)
+    else:
+        existing, changed = await _apply_generic(db, user_id, up, down, post_ids)
+    await db.commit()
+
+    return [
+        _outcome(vote.dir, vote.post_id in existing, vote.post_id in changed)
+        for vote in votes
+    ]
@@ -0,0 +1,108 @@
+'''warmup.py
+
+Startup work that would otherwise land on the first requests after a
+deploy: pool connections, compiled statements, serializers and bcrypt.
+'''
+import asyncio
+import inspect
+import logging
+import time
+from collections import namedtuple
+from contextlib import AsyncExitStack
+from datetime import datetime, timezone
+from typing import List
+
+import orjson
+from pydantic import parse_obj_as
+from sqlalchemy.pool import QueuePool
+
+from . import crud, models, pagination, schemas
+from .config import settings
+from .database import AsyncSessionLocal, async_engine, replica_router
+from .passwords import password_service
+from .serializers import serialize_many, serialize_post, serialize_post_out, serialize_user
+
+logger = logging.getLogger(__name__)
+
+# Seconds spent in each step of the last warmup, served by /internal/warmup
+timings = {}
+
+
+async def fill_pool(engine, count: int):
+    '''Opens up to count connections at once, then returns them to the pool'''
+    pool = engine.sync_engine.pool
+    if not isinstance(pool, QueuePool):
+        return 0
+    count = min(count, pool.size())
+    async with AsyncExitStack() as stack:
+        await asyncio.gather(*(
+            stack.enter_async_context(engine.connect()) for _ in range(count)
+        ))
+    return count
+
+
+async def compile_statements(engine):
+    '''Executes the hot reads once against engine with throwaway parameters'''
+    cursor = pagination.encode_cursor(datetime.now(timezone.utc), 0)
+    async with AsyncSessionLocal(bind=engine) as db:
+        await pagination.keyset_page(db, crud.posts_with_votes(), 10)
+        await pagination.keyset_page(db, crud.posts_with_votes(), 10, cursor)
+        await crud.get_post_with_votes(db, 0)
+        await crud.get_user(db, 0)
+        await crud.get_user_by_email(db, "")
+
+
+WarmRow = namedtuple("WarmRow", ["Post", "votes"])
+
+
+def build_serializers():
+    '''Runs both response paths once on a transient row'''
+    owner = models.User(id=0, email="warmup@example.com", password="")
+    post = models.Post(
+        id=0, title="", content="", published=True,
+        owner_id=0, owner=owner, created_at=datetime.now(timezone.utc)
+    )
+    row = WarmRow(post, 0)
+    orjson.dumps(serialize_many(serialize_post_out, [row]))
+    orjson.dumps(serialize_post(post))
+    orjson.dumps(serialize_user(owner))
+    parse_obj_as(List[schemas.PostOut], [row])
+    parse_obj_as(schemas.PostOut, row)
+
+
+async def _step(name: str, fn, *args):
+    start = time.perf_counter()
+    try:
+        result = fn(*args)
+        if inspect.isawaitable(result):
+            await result
+    except Exception:
+        # A cold first request beats an app that cannot start
+        logger.exception("warmup step %s failed", name)
+    timings[name] = time.perf_counter() - start
+
+
+async def _warm_engine(name: str, engine, connections: int):
+    await _step(f"{name}_pool", fill_pool, engine, connections)
+    await _step(f"{name}_statements", compile_statements, engine)
+
+
+async def run():
+    '''Runs every warmup step; returns the step timings in seconds'''
+    start = time.perf_counter()
+    timings.clear()
+    connections = settings.warmup_connections or settings.database_pool_size
+    engines = [("primary", async_engine)] + [
+        (replica.name, replica.engine) for replica in replica_router.replicas
+    ]
+    await asyncio.gather(
+        _step("password_workers", password_service.start),
+        _step("serializers", build_serializers),
+        *(_warm_engine(name, engine, connections) for name, engine in engines),
+    )
+    timings["total"] = time.perf_counter() - start
+    logger.info(
+        "warmup finished in %.0f ms: %s", timings["total"] * 1000,
+        ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in timings.items())
+    )
+    return dict(timings)
@@ -0,0 +1,105 @@
+'''cold_start.py
+
+Measures what a fresh worker process costs before it serves at full
+speed, with the startup warmup (app/warmup.py) off and on.
+
+Each run starts a new interpreter that times importing the app, its
+startup hook, and then the first and second request to each hot
+endpoint. Needs data from benchmarks.seed. Run from the repository
+root:
+
+    python -m benchmarks.cold_start --runs 3
+'''
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+ENDPOINTS = ("posts", "post", "users", "login")
+
+
+def child():
+    '''Runs inside the measured process and prints its timings as JSON'''
+    start = time.perf_counter()
+    from app.main import create_app
+    app = create_app()
+    imported = time.perf_counter()
+
+    from app.response_cache import response_cache
+    from .load import Client, Fixture, scenarios
+
+    # Second requests must reach the database too, not the response cache
+    response_cache.enabled = False
+
+    async def measure():
+        startup_start = time.perf_counter()
+        await app.router.startup()
+        timings = {
+            "import_s": imported - start,
+            "startup_s": time.perf_counter() - startup_start,
+        }
+        client = Client(app)
+        builders = scenarios(Fixture(1.1, random.Random(0)))
+        try:
+            for name in ENDPOINTS:
+                for attempt in ("first", "second"):
+                    method, path, query, headers, body = builders[name]()
+                    request_start = time.perf_counter()
+                    status = await client.request(method, path, query, headers, body)
+                    timings[f"{name}_{attempt}_ms"] = (time.perf_counter() - request_start) * 1000
+                    if status >= 400:
+                        raise SystemExit(f"{method} {path} returned {status}")
+        finally:
+            await app.router.shutdown()
+        timings["ready_s"] = timings["import_s"] + timings["startup_s"]
+        return timings
+
+    print(json.dumps(asyncio.run(measure())))
+
+
+def run(warmup: bool):
+    env = dict(os.environ, WARMUP_ENABLED="true" if warmup else "false")
+    result = subprocess.run(
+        [sys.executable, "-m", "benchmarks.cold_start", "--child"],
+        env=env, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise SystemExit(result.stderr)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.cold_start")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--out", help="write the median timings to this JSON file")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        child()
+        return
+
+    results = {}
+    for mode, warmup in (("cold", False), ("warm", True)):
+        runs = [run(warmup) for _ in range(args.runs)]
+        results[mode] = {
+            key: round(statistics.median(run[key] for run in runs), 4)
+            for key in runs[0]
+        }
+
+    print(f"{'median of ' + str(args.runs):>22} {'cold':>10} {'warm':>10}")
+    for key in results["cold"]:
+        print(f"{key:>22} {results['cold'][key]:>10.3f} {results['warm'][key]:>10.3f}")
+
+    if args.out:
+        with open(args.out, "w") as out:
+            json.dump(results, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+'''load.py
+
+In-process load test of the API against data from benchmarks.seed.
+
+Requests go straight into the ASGI app, with no sockets or HTTP parsing,
+from a fixed number of concurrent clients. Each scenario reports
+throughput and p50/p95/p99 latency:
+
+* login: POST /login as a random seeded user (bcrypt bound)
+* posts: GET /posts/, the first feed page
+* post: GET /posts/{id}, ids drawn with the same skew as the seeded votes
+* vote: POST /vote, random up or down votes on skewed posts
+* users: GET /users/{id}
+
+Results are written as JSON. Pass an earlier file as --baseline to print
+the change against it. Run from the repository root:
+
+    python -m benchmarks.load --out after.json --baseline before.json
+'''
+import argparse
+import asyncio
+import json
+import platform
+import random
+import subprocess
+import time
+from urllib.parse import urlencode
+
+from sqlalchemy import func, select
+
+from app import models, oauth2
+from app.database import engine
+from app.main import app
+from app.response_cache import response_cache
+
+from .seed import EMAIL_PATTERN, SEED_PASSWORD, zipf_sampler
+
+SCENARIOS = ("login", "posts", "post", "vote", "users")
+
+
+class Client:
+    '''Calls an ASGI app directly and returns the response status'''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def request(self, method: str, path: str, query: dict = None,
+                      headers: dict = None, body: bytes = b""):
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": urlencode(query or {}).encode(),
+            "root_path": "",
+            "headers": [
+                (name.lower().encode(), value.encode())
+                for name, value in (headers or {}).items()
+            ],
+            "client": ("127.0.0.1", 50000),
+            "server": ("benchmark", 80),
+        }
+        done = asyncio.Event()
+        status = 500
+        sent = False
+
+        async def receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            # Only a finished response "disconnects", like a patient client
+            await done.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif not message.get("more_body", False):
+                done.set()
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            done.set()
+        return status
+
+
+class Fixture:
+    '''Seeded users and posts the scenarios pick from'''
+
+    def __init__(self, skew: float, rng: random.Random):
+        with engine.connect() as connection:
+            self.users = connection.execute(
+                select(models.User.id, models.User.email)
+                .where(models.User.email.like(EMAIL_PATTERN))
+                .order_by(models.User.id)
+                .limit(10000)
+            ).all()
+            first, last = connection.execute(
+                select(func.min(models.Post.id), func.max(models.Post.id))
+            ).one()
+            self.user_count = connection.execute(select(func.count(models.User.id))).scalar()
+            self.posts = connection.execute(select(func.count(models.Post.id))).scalar()
+            self.votes = connection.execute(select(func.count()).select_from(models.Vote)).scalar()
+        if not self.users or first is None:
+            raise SystemExit("no seeded data, run python -m benchmarks.seed first")
+        self.first_post, self.last_post = first, last
+        self.rng = rng
+        self.tokens = [
+            {"Authorization": "Bearer " + oauth2.create_access_token({"user_id": id})}
+            for id, _ in self.users
+        ]
+        self.draw_post = zipf_sampler(last - first + 1, skew, rng)
+
+    def post_id(self):
+        return self.first_post + self.draw_post()
+
+    def auth(self):
+        return self.rng.choice(self.tokens)
+
+
+def scenarios(fixture: Fixture):
+    '''Scenario name -> function building the next request's arguments'''
+    rng = fixture.rng
+    form = {"Content-Type": "application/x-www-form-urlencoded"}
+    json_body = {"Content-Type": "application/json"}
+    return {
+        "login": lambda: ("POST", "/login", None, form, urlencode({
+            "username": rng.choice(fixture.users).email,
+            "password": SEED_PASSWORD,
+        }).encode()),
+        "posts": lambda: ("GET", "/posts/", {"limit": 10}, fixture.auth(), b""),
+        "post": lambda: ("GET", f"/posts/{fixture.post_id()}", None, fixture.auth(), b""),
+        "vote": lambda: ("POST", "/vote", None, {**fixture.auth(), **json_body}, json.dumps({
+            "post_id": fixture.post_id(),
+            "dir": rng.randint(0, 1),
+        }).encode()),
+        "users": lambda: ("GET", f"/users/{rng.choice(fixture.users).id}", None, fixture.auth(), b""),
+    }
+
+
+def percentile(ordered, fraction: float):
+    '''Nearest-rank percentile of an ascending list'''
+    if not ordered:
+        return None
+    index = max(int(round(fraction * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+async def run_scenario(client: Client, build, requests: int, concurrency: int):
+    latencies = []
+    statuses = {}
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            method, path, query, headers, body = build()
+            start = time.perf_counter()
+            status = await client.request(method, path, query, headers, body)
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "seconds": round(elapsed, 4),
+        "throughput": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3),
+        "statuses": {str(code): count for code, count in sorted(statuses.items())},
+    }
+
+
+async def run(names, requests: int, login_requests: int, concurrency: int,
+              warmup: int, fixture: Fixture):
+    client = Client(app)
+    builders = scenarios(fixture)
+    results = {}
+    await app.router.startup()
+    try:
+        for name in names:
+            count = login_requests if name == "login" else requests
+            await run_scenario(client, builders[name], min(warmup, count), concurrency)
+            results[name] = await run_scenario(client, builders[name], count, concurrency)
+    finally:
+        await app.router.shutdown()
+    return results
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline: dict):
+    '''Prints each scenario's change from a baseline results file'''
+    print(f"\nchange vs baseline {baseline['meta'].get('revision')}:")
+    for name, current in results["scenarios"].items():
+        before = baseline["scenarios"].get(name)
+        if before is None:
+            continue
+        changes = []
+        for metric in ("throughput", "p50_ms", "p95_ms", "p99_ms"):
+            if before[metric]:
+                delta = (current[metric] - before[metric]) / before[metric] * 100
+                changes.append(f"{metric} {delta:+6.1f}%")
+        print(f"{name:>8}: " + "  ".join(changes))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.load")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument(
+        "--login-requests", type=int, default=200,
+        help="login is bcrypt bound, so it runs fewer requests"
+    )
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--warmup", type=int, default=100)
+    parser.add_argument("--skew", type=float, default=1.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--no-response-cache", action="store_true",
+        help="measure the database path of the post reads"
+    )
+    parser.add_argument("--out", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    args = parser.parse_args(argv)
+
+    if args.no_response_cache:
+        response_cache.enabled = False
+    fixture = Fixture(args.skew, random.Random(args.seed))
+    scenario_results = asyncio.run(run(
+        args.scenarios, args.requests, args.login_requests,
+        args.concurrency, args.warmup, fixture
+    ))
+
+    results = {
+        "meta": {
+            "revision": _git_revision(),
+            "database": engine.dialect.name,
+            "python": platform.python_version(),
+            "users": fixture.user_count,
+            "posts": fixture.posts,
+            "votes": fixture.votes,
+            "concurrency": args.concurrency,
+            "response_cache": response_cache.enabled,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        },
+        "scenarios": scenario_results,
+    }
+
+    print(f"{'scenario':>8} {'req/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}  statuses")
+    for name, result in scenario_results.items():
+        print(
+            f"{name:>8} {result['throughput']:>10.1f} {result['p50_ms']:>9.2f} "
+            f"{result['p95_ms']:>9.2f} {result['p99_ms']:>9.2f}  {result['statuses']}"
+        )
+
+    if args.out:
+        with open(args.out, "w") as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as file:
+            compare(results, json.load(file))
+
+
+if __name__ == "__main__":
+    main()
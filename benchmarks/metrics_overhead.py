@@ -0,0 +1,79 @@
+'''metrics_overhead.py
+
+Measures what MetricsMiddleware and the SQL cursor hooks add per
+request and per query, to check they are cheap enough to leave on.
+
+Run from the repository root:
+
+    python -m benchmarks.metrics_overhead
+'''
+import argparse
+import asyncio
+import time
+
+from sqlalchemy import create_engine, text
+
+from app.metrics import MetricsMiddleware, Registry, RequestStats, current_request, instrument_engine
+
+SCOPE = {"type": "http", "method": "GET", "path": "/posts/", "headers": []}
+
+
+async def endpoint(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"[]"})
+
+
+async def receive():
+    return {"type": "http.request", "body": b"", "more_body": False}
+
+
+async def send(message):
+    pass
+
+
+async def time_requests(app, count: int):
+    start = time.perf_counter()
+    for _ in range(count):
+        await app(dict(SCOPE), receive, send)
+    return (time.perf_counter() - start) / count
+
+
+def time_queries(engine, count: int):
+    token = current_request.set(RequestStats())
+    try:
+        with engine.connect() as connection:
+            statement = text("SELECT 1")
+            start = time.perf_counter()
+            for _ in range(count):
+                connection.execute(statement)
+            return (time.perf_counter() - start) / count
+    finally:
+        current_request.reset(token)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.metrics_overhead")
+    parser.add_argument("--requests", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=50000)
+    args = parser.parse_args(argv)
+
+    bare = asyncio.run(time_requests(endpoint, args.requests))
+    wrapped = asyncio.run(
+        time_requests(MetricsMiddleware(endpoint, Registry()), args.requests)
+    )
+
+    plain_engine = create_engine("sqlite://")
+    hooked_engine = instrument_engine(create_engine("sqlite://"))
+    plain = time_queries(plain_engine, args.queries)
+    hooked = time_queries(hooked_engine, args.queries)
+
+    print(f"request without middleware: {bare * 1e6:8.2f} us")
+    print(f"request with middleware:    {wrapped * 1e6:8.2f} us")
+    print(f"middleware overhead:        {(wrapped - bare) * 1e6:8.2f} us/request")
+    print(f"query without hooks:        {plain * 1e6:8.2f} us")
+    print(f"query with hooks:           {hooked * 1e6:8.2f} us")
+    print(f"cursor hook overhead:       {(hooked - plain) * 1e6:8.2f} us/query")
+
+
+if __name__ == "__main__":
+    main()
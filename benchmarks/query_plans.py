@@ -0,0 +1,328 @@
+'''query_plans.py
+
+Query plan regression check: fails when a query the routers run would
+scan a whole table instead of using an index.
+
+Every route is called once through the ASGI app, as in benchmarks.load,
+and each SQL statement it runs is recorded. Each distinct statement is
+then run again under EXPLAIN with the same parameters: EXPLAIN (FORMAT
+JSON) on PostgreSQL, with sequential scans disabled so a plan only has
+one when no index can serve the query, and EXPLAIN QUERY PLAN on
+SQLite. Foreign keys are checked too: deleting a row looks up the rows
+that reference it, which EXPLAIN on the DELETE does not show.
+
+Routes that list a whole table (GET /users/, GET /posts/export) may
+scan it. Everything else fails the check, and the script exits with
+status 1 and prints the offending plans. tests/test_query_plans.py runs
+the same check on the test database.
+
+The database is seeded first if it has no posts. Run from the
+repository root, against a scratch database as it writes rows:
+
+    python -m benchmarks.query_plans
+'''
+import argparse
+import asyncio
+import json
+import re
+import sys
+from urllib.parse import urlencode
+
+from sqlalchemy import event, func, select
+from sqlalchemy.exc import DBAPIError
+
+from app import models, oauth2, refresh_tokens
+from app.config import settings
+from app.database import AsyncSessionLocal, Base, async_engine, engine
+from app.main import app
+from app.pagination import encode_cursor
+from app.response_cache import response_cache
+
+from .load import Client
+from .seed import EMAIL_PATTERN, SEED_PASSWORD, seed
+
+STATEMENT_TYPES = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+EXPLAIN = {"postgresql": "EXPLAIN (FORMAT JSON) ", "sqlite": "EXPLAIN QUERY PLAN "}
+
+# SQLite full scans read "SCAN posts"; "SCAN posts USING INDEX ..." and
+# "SEARCH ..." use an index
+SQLITE_SCAN = re.compile(r"^SCAN (\w+?)(?:_\d+)?$")
+
+
+class Fixture:
+    '''Seeded rows the routes are called with'''
+
+    def __init__(self):
+        with engine.connect() as connection:
+            self.users = connection.execute(
+                select(models.User.id, models.User.email)
+                .where(models.User.email.like(EMAIL_PATTERN))
+                .order_by(models.User.id)
+                .limit(3)
+            ).all()
+            self.post = connection.execute(
+                select(models.Post.id, models.Post.owner_id, models.Post.created_at)
+                .order_by(models.Post.id.desc())
+                .limit(1)
+            ).first()
+        if len(self.users) < 3 or self.post is None:
+            raise SystemExit("not enough seeded data, run python -m benchmarks.seed first")
+
+    def auth(self, user_id: int):
+        token = oauth2.create_access_token({"user_id": user_id})
+        return {"Authorization": "Bearer " + token}
+
+
+def routes(fixture: Fixture, refresh_token: str):
+    '''(label, tables it may scan, request arguments) for every route'''
+    user, deleted_user = fixture.users[0], fixture.users[2]
+    post_id = fixture.post.id
+    auth = fixture.auth(user.id)
+    owner = fixture.auth(fixture.post.owner_id)
+    form = {"Content-Type": "application/x-www-form-urlencoded"}
+    json_body = {**auth, "Content-Type": "application/json"}
+    post = json.dumps({"title": "plan", "content": "query plan check"}).encode()
+    return [
+        ("login", (), ("POST", "/login", None, form, urlencode({
+            "username": user.email, "password": SEED_PASSWORD,
+        }).encode())),
+        ("refresh", (), ("POST", "/token/refresh", None, {"Content-Type": "application/json"},
+                         json.dumps({"refresh_token": refresh_token}).encode())),
+        ("refresh reused", (), ("POST", "/token/refresh", None,
+                                {"Content-Type": "application/json"},
+                                json.dumps({"refresh_token": refresh_token}).encode())),
+        ("revoke", (), ("POST", "/token/revoke", None, auth, b"")),
+        ("feed", (), ("GET", "/posts/", {"limit": 10}, auth, b"")),
+        ("feed next", (), ("GET", "/posts/", {"limit": 10, "cursor": encode_cursor(
+            fixture.post.created_at, post_id
+        )}, auth, b"")),
+        ("feed offset", (), ("GET", "/posts/", {"limit": 10, "skip": 20}, auth, b"")),
+        ("search", (), ("GET", "/posts/", {"search": "post"}, auth, b"")),
+        ("trending", (), ("GET", "/posts/trending", None, auth, b"")),
+        ("export", ("posts",), ("GET", "/posts/export", None, auth, b"")),
+        ("post", (), ("GET", f"/posts/{post_id}", None, auth, b"")),
+        ("create post", (), ("POST", "/posts/", None, json_body, post)),
+        ("update post", (), ("PUT", f"/posts/{post_id}", None,
+                             {**owner, "Content-Type": "application/json"}, post)),
+        ("vote", (), ("POST", "/vote", None, json_body,
+                      json.dumps({"post_id": post_id, "dir": 1}).encode())),
+        ("unvote", (), ("POST", "/vote", None, json_body,
+                        json.dumps({"post_id": post_id, "dir": 0}).encode())),
+        ("vote batch", (), ("POST", "/vote/batch", None, json_body, json.dumps({"votes": [
+            {"post_id": post_id, "dir": 1}, {"post_id": post_id - 1, "dir": 1},
+        ]}).encode())),
+        ("delete post", (), ("DELETE", f"/posts/{post_id}", None, owner, b"")),
+        ("create user", (), ("POST", "/users/", None, {"Content-Type": "application/json"},
+                             json.dumps({"email": "plans@example.com", "password": "x"}).encode())),
+        ("users", ("users",), ("GET", "/users/", None, auth, b"")),
+        ("user", (), ("GET", f"/users/{user.id}", None, auth, b"")),
+        ("update user", (), ("PUT", f"/users/{deleted_user.id}", None, {
+            **fixture.auth(deleted_user.id), "Content-Type": "application/json"
+        }, json.dumps({"email": deleted_user.email, "password": "x"}).encode())),
+        ("delete user", (), ("DELETE", f"/users/{deleted_user.id}", None,
+                             fixture.auth(deleted_user.id), b"")),
+    ]
+
+
+async def record(client: Client, fixture: Fixture):
+    '''Calls every route and runs every foreign key lookup; returns
+    [(label, tables it may scan, SQL, statement, parameters)]'''
+    async with AsyncSessionLocal() as db:
+        refresh_token = await refresh_tokens.issue(db, fixture.users[0].id)
+
+    statements = []
+    current = None
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if (current is not None and context.compiled is not None
+                and statement.lstrip().upper().startswith(STATEMENT_TYPES)):
+            statements.append((
+                *current, statement, context.compiled.statement, context.compiled_parameters[0]
+            ))
+
+    # The export route is for admins only
+    settings.admin_user_ids.append(fixture.users[0].id)
+    event.listen(async_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        for label, may_scan, request in routes(fixture, refresh_token):
+            # Cached responses would skip the queries
+            response_cache.clear()
+            current = (label, may_scan)
+            try:
+                status = await client.request(*request)
+            except Exception as exc:
+                status = f"{type(exc).__name__}: {exc}"
+            current = None
+            if not isinstance(status, int) or status >= 500:
+                print(f"{label} failed ({status}), its queries may be missing", file=sys.stderr)
+        async with async_engine.connect() as connection:
+            for label, statement in foreign_key_lookups():
+                current = (label, ())
+                await connection.execute(statement)
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+        settings.admin_user_ids.remove(fixture.users[0].id)
+    return statements
+
+
+# Index name -> (table, first indexed column)
+LEADING_COLUMNS = """
+    SELECT index_class.relname, table_class.relname, attribute.attname
+    FROM pg_index
+    JOIN pg_class AS index_class ON index_class.oid = pg_index.indexrelid
+    JOIN pg_class AS table_class ON table_class.oid = pg_index.indrelid
+    JOIN pg_attribute AS attribute
+        ON attribute.attrelid = pg_index.indrelid AND attribute.attnum = pg_index.indkey[0]
+    JOIN pg_namespace ON pg_namespace.oid = table_class.relnamespace
+    WHERE pg_namespace.nspname = current_schema()
+"""
+
+
+def _postgresql_scans(plan, leading_columns):
+    '''Tables a PostgreSQL JSON plan reads in full: with a sequential
+    scan, or through an index whose first column it does not constrain'''
+    if plan.get("Node Type") == "Seq Scan":
+        yield plan["Relation Name"]
+    elif "Index Cond" in plan and plan.get("Index Name") in leading_columns:
+        table, column = leading_columns[plan["Index Name"]]
+        if not re.search(rf"\b{column}\b", plan["Index Cond"]):
+            yield table
+    for child in plan.get("Plans", ()):
+        yield from _postgresql_scans(child, leading_columns)
+
+
+async def explain(connection, statement, parameters, leading_columns=None):
+    '''(tables scanned in full, plan text) for one statement.
+
+    The statement is executed as usual, so the driver gets its
+    parameters with the same types, but its SQL is prefixed with EXPLAIN
+    on the way out and the plan is read before SQLAlchemy sees the rows.
+    '''
+    dialect = connection.dialect.name
+    plans = []
+
+    def prefix(conn, cursor, sql, params, context, executemany):
+        return EXPLAIN[dialect] + sql, params
+
+    def fetch(conn, cursor, sql, params, context, executemany):
+        plans.append(cursor.fetchall())
+
+    sync_connection = connection.sync_connection
+    event.listen(sync_connection, "before_cursor_execute", prefix, retval=True)
+    event.listen(sync_connection, "after_cursor_execute", fetch)
+    try:
+        await connection.execute(statement, parameters)
+    except DBAPIError:
+        raise
+    except Exception:
+        # Reading the plan as the statement's own result may fail
+        if not plans:
+            raise
+    finally:
+        event.remove(sync_connection, "before_cursor_execute", prefix)
+        event.remove(sync_connection, "after_cursor_execute", fetch)
+
+    if dialect == "postgresql":
+        plan = plans[0][0][0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        plan = plan[0]["Plan"]
+        return set(_postgresql_scans(plan, leading_columns)), json.dumps(plan, indent=2)
+
+    details = [row[-1] for row in plans[0]]
+    scans = {match.group(1) for match in map(SQLITE_SCAN.match, details) if match}
+    return scans, "\n".join(details)
+
+
+def foreign_key_lookups():
+    '''(label, select) per foreign key: the lookup deleting a parent runs'''
+    lookups = []
+    for table in Base.metadata.sorted_tables:
+        for key in table.foreign_keys:
+            column = key.parent
+            lookups.append((
+                f"delete {key.column.table.name} -> {table.name}.{column.name}",
+                select(column).where(column == 1)
+            ))
+    return lookups
+
+
+async def check(statements):
+    '''Returns ([(label, SQL, problem, plan)] for every statement whose
+    plan scans a table it may not, number of statements checked)'''
+    tables = set(Base.metadata.tables)
+    failures = []
+    seen = set()
+    leading_columns = None
+    async with async_engine.connect() as connection:
+        if connection.dialect.name == "postgresql":
+            # Makes a sequential scan the planner's last resort, so small
+            # seeded tables do not hide a missing index
+            await connection.exec_driver_sql("SET LOCAL enable_seqscan = off")
+            leading_columns = {
+                index: (table, column)
+                for index, table, column in await connection.exec_driver_sql(LEADING_COLUMNS)
+            }
+        for label, may_scan, sql, statement, parameters in statements:
+            if sql in seen:
+                continue
+            seen.add(sql)
+            try:
+                async with connection.begin_nested():
+                    scans, plan = await explain(connection, statement, parameters, leading_columns)
+            except DBAPIError as exc:
+                failures.append((label, sql, "EXPLAIN failed", str(exc.orig)))
+                continue
+            scans = (scans & tables) - set(may_scan)
+            if scans:
+                failures.append((label, sql, "full scan of " + ", ".join(sorted(scans)), plan))
+        await connection.rollback()
+    return failures, len(seen)
+
+
+def seed_if_empty(posts: int):
+    with engine.connect() as connection:
+        seeded = connection.execute(select(func.count(models.Post.id))).scalar()
+    if not seeded:
+        seed(max(posts // 10, 3), posts, posts * 3)
+
+
+async def run_check():
+    '''Records every route's statements under the app's lifespan and
+    checks their plans; returns check()'s result'''
+    await app.router.startup()
+    try:
+        # Checked before shutdown, which closes the pooled connections
+        return await check(await record(Client(app), Fixture()))
+    finally:
+        await app.router.shutdown()
+
+
+def describe(label, sql, problem, plan):
+    return "\n".join((
+        f"FAIL {label}: {problem}",
+        "  " + sql.strip().replace("\n", "\n  "),
+        "  " + plan.replace("\n", "\n  "),
+    ))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.query_plans")
+    parser.add_argument(
+        "--posts", type=int, default=2000,
+        help="posts to seed when the database has none"
+    )
+    args = parser.parse_args(argv)
+
+    seed_if_empty(args.posts)
+    failures, checked = asyncio.run(run_check())
+    for failure in failures:
+        print(describe(*failure))
+    print(f"{checked} statements checked, {len(failures)} failed")
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+'''seed.py
+
+Fills the configured database with benchmark users, posts and votes.
+
+Sizes run from thousands to tens of millions of rows. Rows are generated
+lazily and loaded with COPY on PostgreSQL, or batched executemany on
+other databases, so memory stays flat at any scale. Post popularity
+follows a Zipf distribution: a few posts get most of the votes, as in a
+real feed, which is what makes vote contention and hot-row caching show
+up in the load test.
+
+Votes are generated twice from the same random seed: once to count
+them per post, so posts.vote_count is loaded with each post, and once
+to load them. Seeded users are bench<id>@example.com and all share
+SEED_PASSWORD (hashed once). New rows are numbered after the existing ones, so seeding
+twice adds more data. Run from the repository root:
+
+    python -m benchmarks.seed --posts 100000
+'''
+import argparse
+import csv
+import io
+import random
+import time
+from array import array
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func, insert, select, text
+
+from app import models, utils
+from app.database import engine
+
+SEED_PASSWORD = "benchmark"
+EMAIL_PATTERN = "bench%@example.com"
+BATCH_SIZE = 10000
+
+WORDS = (
+    "fastapi python postgres sqlite async await index query cache vote "
+    "post user token latency throughput feed search cursor page batch "
+    "pool worker request response json stream import export metric"
+).split()
+
+
+def zipf_sampler(count: int, skew: float, rng: random.Random):
+    '''Returns a function drawing ranks in [0, count) from a Zipf-like law.
+
+    Uses the inverse CDF of the continuous power law, so drawing needs
+    no per-rank table and works for any count.
+    '''
+    if abs(skew - 1.0) < 1e-9:
+        return lambda: min(int((count + 1) ** rng.random()) - 1, count - 1)
+    exponent = 1.0 - skew
+    top = (count + 1) ** exponent - 1.0
+    return lambda: min(
+        int((top * rng.random() + 1.0) ** (1.0 / exponent)) - 1, count - 1
+    )
+
+
+def user_rows(first_id: int, count: int, password_hash: str):
+    for id in range(first_id, first_id + count):
+        yield {"id": id, "email": f"bench{id}@example.com", "password": password_hash}
+
+
+def post_rows(first_id: int, count: int, user_ids, vote_counts, rng: random.Random):
+    start = datetime.now(timezone.utc) - timedelta(days=365)
+    step = timedelta(days=365) / max(count, 1)
+    for n in range(count):
+        yield {
+            "id": first_id + n,
+            "title": f"Benchmark post {first_id + n}",
+            "content": " ".join(rng.choices(WORDS, k=rng.randint(10, 120))),
+            "published": rng.random() < 0.95,
+            "created_at": start + step * n,
+            "owner_id": rng.choice(user_ids),
+            "vote_count": vote_counts[n],
+        }
+
+
+def vote_rows(user_ids, post_ids, count: int, skew: float, rng: random.Random):
+    '''Yields about count unique votes, spread evenly over users and
+    skewed over posts'''
+    draw = zipf_sampler(len(post_ids), skew, rng)
+    # A fixed stride scatters the hot ranks across the id range
+    stride = _coprime_stride(len(post_ids))
+    per_user = count / len(user_ids)
+    produced = 0
+    for n, user_id in enumerate(user_ids):
+        target = int(per_user * (n + 1)) - produced
+        seen = set()
+        for _ in range(min(target * 3, len(post_ids))):
+            if len(seen) >= target:
+                break
+            seen.add(post_ids[(draw() * stride) % len(post_ids)])
+        produced += len(seen)
+        for post_id in seen:
+            yield {"user_id": user_id, "post_id": post_id}
+
+
+def _coprime_stride(count: int):
+    stride = 7919
+    while count % stride == 0:
+        stride += 2
+    return stride
+
+
+class _CSVStream(io.RawIOBase):
+    '''File-like CSV view of a row generator, for COPY FROM STDIN'''
+
+    def __init__(self, rows, columns):
+        self.rows = iter(rows)
+        self.columns = columns
+        self.buffer = b""
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        out = io.StringIO()
+        writer = csv.writer(out)
+        while size < 0 or len(self.buffer) < size:
+            chunk = []
+            for row in self.rows:
+                chunk.append([_csv_value(row[column]) for column in self.columns])
+                if len(chunk) >= 1000:
+                    break
+            if not chunk:
+                break
+            writer.writerows(chunk)
+            self.buffer += out.getvalue().encode()
+            out.seek(0)
+            out.truncate()
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def _csv_value(value):
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def load(connection, table, rows, columns):
+    '''Loads rows into table with COPY or batched INSERTs; returns the count'''
+    if connection.dialect.name == "postgresql":
+        cursor = connection.connection.cursor()
+        cursor.copy_expert(
+            f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+            _CSVStream(rows, columns)
+        )
+        return cursor.rowcount
+
+    loaded = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            connection.execute(insert(table), batch)
+            loaded += len(batch)
+            batch = []
+    if batch:
+        connection.execute(insert(table), batch)
+        loaded += len(batch)
+    return loaded
+
+
+def _next_id(connection, column):
+    return connection.execute(select(func.coalesce(func.max(column), 0))).scalar() + 1
+
+
+def _reset_sequence(connection, table):
+    if connection.dialect.name == "postgresql":
+        connection.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+            f"(SELECT max(id) FROM {table.name}))"
+        ))
+
+
+def seed(users: int, posts: int, votes: int, skew: float = 1.1, random_seed: int = 0):
+    '''Adds the given numbers of rows and returns what was loaded'''
+    rng = random.Random(random_seed)
+    users_table = models.User.__table__
+    posts_table = models.Post.__table__
+    votes_table = models.Vote.__table__
+    loaded = {}
+    timings = {}
+
+    with engine.begin() as connection:
+        first_user = _next_id(connection, users_table.c.id)
+        first_post = _next_id(connection, posts_table.c.id)
+
+    user_ids = range(first_user, first_user + users)
+    post_ids = range(first_post, first_post + posts)
+    password_hash = utils.hash(SEED_PASSWORD)
+
+    def votes_rows():
+        return vote_rows(user_ids, post_ids, votes, skew, random.Random(random_seed + 1))
+
+    start = time.perf_counter()
+    vote_counts = array("I", bytes(4 * posts))
+    for vote in votes_rows():
+        vote_counts[vote["post_id"] - first_post] += 1
+    timings["vote_counts"] = time.perf_counter() - start
+
+    steps = (
+        ("users", users_table, ("id", "email", "password"),
+         lambda: user_rows(first_user, users, password_hash)),
+        ("posts", posts_table,
+         ("id", "title", "content", "published", "created_at", "owner_id", "vote_count"),
+         lambda: post_rows(first_post, posts, user_ids, vote_counts, rng)),
+        ("votes", votes_table, ("user_id", "post_id"), votes_rows),
+    )
+    for name, table, columns, rows in steps:
+        start = time.perf_counter()
+        with engine.begin() as connection:
+            loaded[name] = load(connection, table, rows(), columns)
+            if name != "votes":
+                _reset_sequence(connection, table)
+        timings[name] = time.perf_counter() - start
+    return loaded, timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.seed")
+    parser.add_argument("--posts", type=int, default=10000)
+    parser.add_argument("--users", type=int, help="defaults to posts / 10")
+    parser.add_argument("--votes", type=int, help="defaults to posts * 3")
+    parser.add_argument(
+        "--skew", type=float, default=1.1,
+        help="Zipf exponent of post popularity; higher is more skewed"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    users = args.users or max(args.posts // 10, 1)
+    votes = args.votes if args.votes is not None else args.posts * 3
+    loaded, timings = seed(users, args.posts, votes, args.skew, args.seed)
+    for name, seconds in timings.items():
+        count = loaded.get(name)
+        rate = f" ({count / seconds:,.0f} rows/s)" if count and seconds else ""
+        print(f"{name:>12}: {count if count is not None else '-':>10} in {seconds:7.2f}s{rate}")
+    print(f"users log in as bench<id>@example.com / {SEED_PASSWORD}")
+
+
+if __name__ == "__main__":
+    main()
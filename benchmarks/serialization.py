@@ -0,0 +1,83 @@
+'''serialization.py
+
+Compares the two ways GET /posts/ can serialize a page of rows:
+
+* response_model: validate List[schemas.PostOut] through orm_mode,
+  jsonable_encoder, stdlib json (what FastAPI does for response_model)
+* fast: the compiled serializers from app/serializers.py plus orjson
+
+Run from the repository root (the app settings must be loadable,
+e.g. from .env, because app.models imports the database module):
+
+    python -m benchmarks.serialization --rows 1000
+'''
+import argparse
+import json
+import timeit
+from collections import namedtuple
+from typing import List
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from pydantic import parse_obj_as
+
+from app import models, schemas
+from app.serializers import serialize_many, serialize_post_out
+
+Row = namedtuple("Row", ["Post", "votes"])
+
+
+def make_rows(count: int):
+    '''Builds detached ORM rows shaped like get_posts results'''
+    owners = [
+        models.User(id=i, email=f"user{i}@example.com", password="x")
+        for i in range(1, 51)
+    ]
+    rows = []
+    for i in range(1, count + 1):
+        owner = owners[i % len(owners)]
+        post = models.Post(
+            id=i,
+            title=f"Post number {i}",
+            content="Lorem ipsum dolor sit amet, " * 20,
+            published=True,
+            owner_id=owner.id,
+            owner=owner
+        )
+        rows.append(Row(post, i % 37))
+    return rows
+
+
+def response_model_path(rows):
+    validated = parse_obj_as(List[schemas.PostOut], rows)
+    return json.dumps(jsonable_encoder(validated)).encode()
+
+
+def fast_path(rows):
+    return orjson.dumps(serialize_many(serialize_post_out, rows))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.serialization")
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    rows = make_rows(args.rows)
+    assert json.loads(response_model_path(rows)) == json.loads(fast_path(rows))
+
+    results = {}
+    for name, fn in (("response_model", response_model_path), ("fast", fast_path)):
+        timings = timeit.repeat(
+            lambda: fn(rows), repeat=args.repeat, number=args.number
+        )
+        results[name] = min(timings) / args.number * 1000
+
+    for name, ms in results.items():
+        print(f"{name:>15}: {ms:8.2f} ms per {args.rows}-row page")
+    print(f"{'speedup':>15}: {results['response_model'] / results['fast']:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+'''serve.py
+
+Throughput of the server setups over real sockets: the old Procfile's
+single `uvicorn app.main:app` process against `python -m app.serve`.
+
+Each setup is started as a subprocess on a free port. Client processes
+then hold keep-alive connections open and send requests back to back
+for a fixed time. Reports requests per second and p50/p99 latency per
+endpoint:
+
+* root: GET /, no database
+* post: GET /posts/{id}, skewed ids as in benchmarks.load
+
+Needs data from benchmarks.seed. Run from the repository root, with
+the client processes on other cores than the server where possible:
+
+    python -m benchmarks.serve --seconds 20 --clients 4
+'''
+import argparse
+import asyncio
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from .load import Fixture, percentile
+
+SETUPS = {
+    "single": lambda port: [
+        sys.executable, "-m", "uvicorn", "app.main:app",
+        "--host", "127.0.0.1", "--port", str(port),
+    ],
+    "serve": lambda port: [
+        sys.executable, "-m", "app.serve", "--host", "127.0.0.1", "--port", str(port),
+    ],
+}
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_ready(port: int, process, timeout: float = 60):
+    '''Polls GET / until the server answers'''
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"server exited with {process.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1) as sock:
+                sock.sendall(b"GET / HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n")
+                if sock.recv(12).startswith(b"HTTP/1.1 200"):
+                    return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise SystemExit("server did not start")
+
+
+async def _connection(port: int, requests, deadline: float, latencies):
+    '''Sends requests until deadline; returns (errors, reconnects)'''
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    errors = reconnects = 0
+    try:
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                writer.write(random.choice(requests))
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in head.split(b"\r\n"):
+                    name, _, value = line.partition(b":")
+                    if name.lower() == b"content-length":
+                        length = int(value)
+                await reader.readexactly(length)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # A worker replaced after max_requests closes its connections
+                writer.close()
+                reconnects += 1
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                continue
+            if not head.startswith(b"HTTP/1.1 200"):
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+    return errors, reconnects
+
+
+def _client(port: int, requests, connections: int, seconds: float):
+    '''One client process: returns (latencies, errors, reconnects)'''
+    random.seed()
+    latencies = []
+
+    async def run():
+        deadline = time.perf_counter() + seconds
+        return await asyncio.gather(*(
+            _connection(port, requests, deadline, latencies) for _ in range(connections)
+        ))
+
+    counts = asyncio.run(run())
+    return latencies, sum(errors for errors, _ in counts), sum(reconnects for _, reconnects in counts)
+
+
+def measure(port: int, requests, clients: int, connections: int, seconds: float):
+    with ProcessPoolExecutor(clients) as pool:
+        results = list(pool.map(
+            _client,
+            [port] * clients, [requests] * clients,
+            [connections] * clients, [seconds] * clients
+        ))
+    latencies = sorted(latency for result in results for latency in result[0])
+    return {
+        "requests": len(latencies),
+        "errors": sum(result[1] for result in results),
+        "reconnects": sum(result[2] for result in results),
+        "throughput": round(len(latencies) / seconds, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def _requests(fixture: Fixture, count: int = 1000):
+    auth = "".join(f"{name}: {value}\r\n" for name, value in fixture.auth().items())
+    return {
+        "root": [b"GET / HTTP/1.1\r\nHost: bench\r\n\r\n"],
+        "post": [
+            f"GET /posts/{fixture.post_id()} HTTP/1.1\r\nHost: bench\r\n{auth}\r\n".encode()
+            for _ in range(count)
+        ],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.serve")
+    parser.add_argument("--setups", nargs="+", choices=SETUPS, default=list(SETUPS))
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--clients", type=int, default=2, help="client processes")
+    parser.add_argument("--connections", type=int, default=32, help="connections per client")
+    parser.add_argument("--skew", type=float, default=1.1)
+    args = parser.parse_args(argv)
+
+    endpoints = _requests(Fixture(args.skew, random.Random(0)))
+    results = {}
+    for setup in args.setups:
+        port = _free_port()
+        # The response cache would turn the post endpoint into a memory read
+        env = dict(os.environ, RESPONSE_CACHE_ENABLED="false", ADMISSION_CONTROL_ENABLED="false")
+        process = subprocess.Popen(SETUPS[setup](port), env=env, stdout=subprocess.DEVNULL)
+        try:
+            _wait_ready(port, process)
+            for name, requests in endpoints.items():
+                results[(setup, name)] = measure(
+                    port, requests, args.clients, args.connections, args.seconds
+                )
+        finally:
+            process.terminate()
+            process.wait()
+
+    print(
+        f"{'setup':>8} {'endpoint':>8} {'req/s':>10} {'p50 ms':>9} {'p99 ms':>9} "
+        f"{'errors':>7} {'reconnects':>10}"
+    )
+    for (setup, name), result in results.items():
+        print(
+            f"{setup:>8} {name:>8} {result['throughput']:>10.1f} {result['p50_ms']:>9.2f} "
+            f"{result['p99_ms']:>9.2f} {result['errors']:>7} {result['reconnects']:>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
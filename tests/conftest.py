@@ -0,0 +1,57 @@
+'''conftest.py'''
+import os
+import tempfile
+
+# Settings are read when app.config is imported, so the environment is
+# filled in first: statement budgets that fail the request instead of
+# logging, and a database the tests may drop. That is TEST_DATABASE_URL,
+# else a throwaway SQLite database, never the configured DATABASE_URL
+os.environ["DATABASE_URL"] = os.environ.get("TEST_DATABASE_URL") or (
+    "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test.db")
+)
+for name, value in {
+    "DATABASE_HOSTNAME": "localhost",
+    "DATABASE_PORT": "5432",
+    "DATABASE_PASSWORD": "password",
+    "DATABASE_NAME": "test",
+    "DATABASE_USERNAME": "test",
+    "SECRET_KEY": "test-secret-key",
+    "ALGORITHM": "HS256",
+    "ACCESS_TOKEN_EXPIRE_MINUTES": "30",
+    "QUERY_BUDGET_ACTION": "raise",
+    "PASSWORD_WORKERS": "1",
+}.items():
+    os.environ.setdefault(name, value)
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import models, oauth2
+from app.database import engine
+from app.main import app
+from app.response_cache import response_cache
+
+
+@pytest.fixture
+def client():
+    models.Base.metadata.drop_all(engine)
+    models.Base.metadata.create_all(engine)
+    # Ids are reused once the tables are recreated, so nothing cached
+    # by an earlier test may survive
+    response_cache.clear()
+    oauth2.user_cache.clear()
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.fixture
+def create_user(client):
+    '''Creates a user and returns its id and a bearer header'''
+    def create_user(email, password="password"):
+        user = client.post("/users/", json={"email": email, "password": password})
+        assert user.status_code == 201
+        login = client.post("/login", data={"username": email, "password": password})
+        assert login.status_code == 200
+        token = login.json()["access_token"]
+        return user.json()["id"], {"Authorization": f"Bearer {token}"}
+    return create_user
@@ -0,0 +1,53 @@
+'''test_admission.py'''
+import asyncio
+
+from app.admission import READ, AdmissionMiddleware, GradientLimit
+from app.config import settings
+
+
+async def _call(app, path="/posts/"):
+    '''Runs one GET through app; returns (status, headers)'''
+    scope = {"type": "http", "method": "GET", "path": path, "headers": []}
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    start = messages[0]
+    return start["status"], dict(start.get("headers", []))
+
+
+def test_requests_over_the_limit_are_shed(monkeypatch):
+    monkeypatch.setattr(settings, "admission_control_enabled", True)
+    limit = GradientLimit(initial=2, min_limit=2, max_limit=2)
+
+    async def run():
+        release = asyncio.Event()
+
+        async def slow_app(scope, receive, send):
+            if scope["path"] == "/posts/":
+                await release.wait()
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            await send({"type": "http.response.body", "body": b""})
+
+        app = AdmissionMiddleware(slow_app, limits={READ: limit})
+        in_flight = [asyncio.ensure_future(_call(app)) for _ in range(2)]
+        await asyncio.sleep(0)
+        assert limit.in_flight == 2
+
+        status, headers = await _call(app)
+        assert status == 503
+        assert headers[b"retry-after"] == str(settings.admission_retry_after_seconds).encode()
+        # Exempt paths are admitted however loaded the service is
+        assert (await _call(app, "/metrics"))[0] == 200
+
+        release.set()
+        assert [status for status, _ in await asyncio.gather(*in_flight)] == [200, 200]
+        assert (await _call(app))[0] == 200
+
+    asyncio.run(run())
+    assert (limit.admitted, limit.rejected, limit.in_flight) == (3, 1, 0)
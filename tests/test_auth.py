@@ -0,0 +1,49 @@
+'''test_auth.py'''
+
+
+def _login(client, email, password="password"):
+    response = client.post("/login", data={"username": email, "password": password})
+    assert response.status_code == 200
+    return response.json()["refresh_token"]
+
+
+def _refresh(client, token):
+    return client.post("/token/refresh", json={"refresh_token": token})
+
+
+def test_refresh_tokens_work_once(client, create_user):
+    user_id, _ = create_user("user@example.com")
+    first = _login(client, "user@example.com")
+
+    response = _refresh(client, first)
+    assert response.status_code == 200
+    body = response.json()
+    assert body["refresh_token"] != first
+    headers = {"Authorization": f"Bearer {body['access_token']}"}
+    assert client.get(f"/users/{user_id}", headers=headers).status_code == 200
+
+    assert _refresh(client, first).status_code == 401
+    assert _refresh(client, "never issued").status_code == 401
+
+
+def test_reused_token_revokes_its_family(client, create_user):
+    create_user("user@example.com")
+    first = _login(client, "user@example.com")
+    other_session = _login(client, "user@example.com")
+    second = _refresh(client, first).json()["refresh_token"]
+    third = _refresh(client, second).json()["refresh_token"]
+
+    # Replaying a rotated token means it leaked: every token descended
+    # from the same login stops working
+    assert _refresh(client, first).status_code == 401
+    assert _refresh(client, third).status_code == 401
+    assert _refresh(client, other_session).status_code == 200
+
+
+def test_revoke_logs_out_every_session(client, create_user):
+    _, headers = create_user("user@example.com")
+    first = _login(client, "user@example.com")
+    second = _login(client, "user@example.com")
+    assert client.post("/token/revoke", headers=headers).status_code == 204
+    assert _refresh(client, first).status_code == 401
+    assert _refresh(client, second).status_code == 401
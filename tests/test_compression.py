@@ -0,0 +1,27 @@
+'''test_compression.py'''
+import pytest
+
+
+@pytest.fixture
+def feed(client, create_user):
+    _, headers = create_user("author@example.com")
+    for number in range(10):
+        client.post("/posts/", json={"title": f"t{number}", "content": "lorem ipsum " * 40}, headers=headers)
+    return headers
+
+
+@pytest.mark.parametrize("path", ["/posts/?limit=10", "/posts/trending?limit=10"])
+@pytest.mark.parametrize("accept_encoding", ["gzip", "identity"])
+def test_compressible_responses_vary_on_accept_encoding(client, feed, path, accept_encoding):
+    response = client.get(path, headers={**feed, "Accept-Encoding": accept_encoding})
+    assert response.status_code == 200
+    assert response.headers.get("content-encoding") == (None if accept_encoding == "identity" else "gzip")
+    assert response.headers["vary"] == "Accept-Encoding"
+
+
+def test_not_modified_varies_on_accept_encoding(client, feed):
+    headers = {**feed, "Accept-Encoding": "identity"}
+    etag = client.get("/posts/?limit=10", headers=headers).headers["etag"]
+    response = client.get("/posts/?limit=10", headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["vary"] == "Accept-Encoding"
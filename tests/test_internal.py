@@ -0,0 +1,33 @@
+'''test_internal.py'''
+from app.config import settings
+
+
+def test_pool_stats_require_an_admin(client, create_user, monkeypatch):
+    assert client.get("/internal/pool").status_code == 401
+    admin_id, admin = create_user("admin@example.com")
+    _, user = create_user("user@example.com")
+    monkeypatch.setattr(settings, "admin_user_ids", [admin_id])
+    assert client.get("/internal/pool", headers=user).status_code == 403
+    response = client.get("/internal/pool", headers=admin)
+    assert response.status_code == 200
+    assert "async" in response.json()
+
+
+def test_warmup_timings_require_an_admin(client, create_user, monkeypatch):
+    assert client.get("/internal/warmup").status_code == 401
+    admin_id, admin = create_user("admin@example.com")
+    _, user = create_user("user@example.com")
+    monkeypatch.setattr(settings, "admin_user_ids", [admin_id])
+    assert client.get("/internal/warmup", headers=user).status_code == 403
+    assert client.get("/internal/warmup", headers=admin).status_code == 200
+
+
+def test_metrics_require_the_metrics_token(client, create_user, monkeypatch):
+    assert client.get("/metrics").status_code == 403
+    monkeypatch.setattr(settings, "metrics_token", "scrape-secret")
+    assert client.get("/metrics").status_code == 401
+    _, user = create_user("user@example.com")
+    assert client.get("/metrics", headers=user).status_code == 401
+    response = client.get("/metrics", headers={"Authorization": "Bearer scrape-secret"})
+    assert response.status_code == 200
+    assert "db_pool_checked_out" in response.text
@@ -0,0 +1,140 @@
+'''test_posts.py'''
+import asyncio
+
+from app import bulk, crud
+from app.config import settings
+from app.response_cache import post_key, post_tag, response_cache
+
+
+def test_delete_post_drops_cached_search_results(client, create_user):
+    _, author = create_user("author@example.com")
+    post_id = client.post("/posts/", json={"title": "needle", "content": "c"}, headers=author).json()["id"]
+    results = client.get("/posts/?search=needle", headers=author).json()
+    assert [item["Post"]["id"] for item in results] == [post_id]
+
+    assert client.delete(f"/posts/{post_id}", headers=author).status_code == 204
+    assert client.get("/posts/?search=needle", headers=author).json() == []
+
+
+def test_import_parses_off_the_event_loop(client, create_user, monkeypatch):
+    admin_id, admin = create_user("admin@example.com")
+    monkeypatch.setattr(settings, "admin_user_ids", [admin_id])
+    on_loop = []
+    read_posts = bulk.read_posts
+
+    def recording_read_posts(*args, **kwargs):
+        for record in read_posts(*args, **kwargs):
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                on_loop.append(False)
+            else:
+                on_loop.append(True)
+            yield record
+
+    monkeypatch.setattr("app.routers.post.read_posts", recording_read_posts)
+    body = b"".join(b'{"title": "t%d", "content": "c"}\n' % i for i in range(3))
+    response = client.post("/posts/import", data=body, headers=admin)
+    assert response.json() == {"imported": 3}
+    assert on_loop == [False] * 3
+
+
+def test_imported_posts_are_trending(client, create_user, monkeypatch):
+    admin_id, admin = create_user("admin@example.com")
+    monkeypatch.setattr(settings, "admin_user_ids", [admin_id])
+    body = b"".join(b'{"title": "t%d", "content": "c"}\n' % i for i in range(3))
+    assert client.post("/posts/import", data=body, headers=admin).json() == {"imported": 3}
+    trending = client.get("/posts/trending", headers=admin).json()
+    assert sorted(item["Post"]["title"] for item in trending) == ["t0", "t1", "t2"]
+
+
+def test_read_racing_a_write_is_not_cached(client, create_user, monkeypatch):
+    _, author = create_user("author@example.com")
+    post_id = client.post("/posts/", json={"title": "t", "content": "c"}, headers=author).json()["id"]
+    get_post_with_votes = crud.get_post_with_votes
+
+    async def read_then_write(db, id):
+        post = await get_post_with_votes(db, id)
+        # A write to the post commits while the read is in flight
+        response_cache.invalidate(post_tag(id))
+        return post
+
+    monkeypatch.setattr(crud, "get_post_with_votes", read_then_write)
+    assert client.get(f"/posts/{post_id}", headers=author).status_code == 200
+    assert response_cache.get(post_key(post_id)) is None
+
+    monkeypatch.setattr(crud, "get_post_with_votes", get_post_with_votes)
+    assert client.get(f"/posts/{post_id}", headers=author).status_code == 200
+    assert response_cache.get(post_key(post_id)) is not None
+
+
+def test_deleting_the_post_past_a_page_refreshes_its_cursor(client, create_user):
+    _, author = create_user("author@example.com")
+    oldest = client.post("/posts/", json={"title": "t0", "content": "c"}, headers=author).json()["id"]
+    client.post("/posts/", json={"title": "t1", "content": "c"}, headers=author)
+    assert "x-next-cursor" in client.get("/posts/?limit=1", headers=author).headers
+
+    assert client.delete(f"/posts/{oldest}", headers=author).status_code == 204
+    assert "x-next-cursor" not in client.get("/posts/?limit=1", headers=author).headers
+
+
+def _page(client, headers, **params):
+    response = client.get("/posts/", params=params, headers=headers)
+    assert response.status_code == 200
+    return [item["Post"]["id"] for item in response.json()], response.headers
+
+
+def _walk(client, headers, limit, cursor=None):
+    '''Post ids of every page from cursor on'''
+    ids = []
+    while True:
+        params = {"cursor": cursor} if cursor else {}
+        page, page_headers = _page(client, headers, limit=limit, **params)
+        ids += page
+        cursor = page_headers.get("x-next-cursor")
+        if cursor is None:
+            return ids
+
+
+def _create_posts(client, headers, count):
+    return [
+        client.post("/posts/", json={"title": f"t{i}", "content": "c"}, headers=headers).json()["id"]
+        for i in range(count)
+    ]
+
+
+def test_cursors_walk_the_feed_both_ways(client, create_user):
+    _, author = create_user("author@example.com")
+    ids = _create_posts(client, author, 5)[::-1]
+    assert _walk(client, author, 2) == ids
+
+    _, first = _page(client, author, limit=2)
+    second, headers = _page(client, author, limit=2, cursor=first["x-next-cursor"])
+    assert second == ids[2:4]
+    back, headers = _page(client, author, limit=2, cursor=headers["x-prev-cursor"])
+    assert back == ids[:2]
+    assert "x-prev-cursor" not in headers
+
+
+def test_posts_added_between_pages_shift_nothing(client, create_user):
+    _, author = create_user("author@example.com")
+    ids = _create_posts(client, author, 5)[::-1]
+    first, headers = _page(client, author, limit=2)
+    client.post("/posts/", json={"title": "new", "content": "c"}, headers=author)
+    assert first + _walk(client, author, 2, headers["x-next-cursor"]) == ids
+
+
+def test_bad_page_parameters_are_rejected(client, create_user):
+    _, author = create_user("author@example.com")
+    for params in ({"cursor": "not a cursor"}, {"cursor": "e30"}):
+        assert client.get("/posts/", params=params, headers=author).status_code == 400
+    for params in ({"limit": -1}, {"limit": 0}, {"limit": 101}, {"skip": -1}):
+        assert client.get("/posts/", params=params, headers=author).status_code == 422
+
+
+def test_import_rejects_unknown_owners(client, create_user, monkeypatch):
+    admin_id, admin = create_user("admin@example.com")
+    monkeypatch.setattr(settings, "admin_user_ids", [admin_id])
+    body = b'{"title": "t", "content": "c", "owner_id": %d}\n' % (admin_id + 1)
+    assert client.post("/posts/import", data=body, headers=admin).status_code == 422
+    assert client.get("/posts/", headers=admin).json() == []
@@ -0,0 +1,15 @@
+'''test_query_plans.py'''
+import asyncio
+
+from app import models
+from app.database import engine
+from benchmarks import query_plans
+
+
+def test_routes_read_through_indexes():
+    models.Base.metadata.drop_all(engine)
+    models.Base.metadata.create_all(engine)
+    query_plans.seed_if_empty(2000)
+    failures, checked = asyncio.run(query_plans.run_check())
+    assert checked
+    assert not failures, "\n".join(query_plans.describe(*failure) for failure in failures)
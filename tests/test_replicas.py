@@ -0,0 +1,76 @@
+'''test_replicas.py'''
+import sqlite3
+
+import pytest
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from starlette.requests import Request
+
+from app.database import SQLALCHEMY_DATABASE_URL, replica_router
+from app.replicas import PIN_COOKIE, ReplicaRouter
+from app.response_cache import post_key, post_tag, response_cache
+
+
+def _request(method, token, cookie=None):
+    headers = [(b"authorization", f"Bearer {token}".encode())]
+    if cookie is not None:
+        headers.append((b"cookie", f"{PIN_COOKIE}={cookie}".encode()))
+    return Request({"type": "http", "method": method, "headers": headers})
+
+
+def _worker():
+    router = ReplicaRouter(check_interval=5, read_your_writes_seconds=5, secret=b"secret")
+    router.add("replica1", create_async_engine("sqlite+aiosqlite://"))
+    return router
+
+
+def test_a_write_pins_its_client_to_the_primary_on_every_worker():
+    writer, reader = _worker(), _worker()
+    write = _request("POST", "token-a")
+    assert writer.engine_for(write) is None
+    pin = write.state.replica_pin
+
+    assert reader.engine_for(_request("GET", "token-a", pin)) is None
+    assert reader.engine_for(_request("GET", "token-a")) is reader.replicas[0].engine
+    # A pin only holds for the token it was signed for
+    assert reader.engine_for(_request("GET", "token-b", pin)) is reader.replicas[0].engine
+    expired = "1." + pin.partition(".")[2]
+    assert reader.engine_for(_request("GET", "token-a", expired)) is reader.replicas[0].engine
+
+
+def test_write_responses_set_the_pin_cookie(client, create_user, monkeypatch):
+    monkeypatch.setattr(replica_router, "replicas", _worker().replicas)
+    _, author = create_user("author@example.com")
+    response = client.post("/posts/", json={"title": "t", "content": "c"}, headers=author)
+    assert response.status_code == 201
+    assert PIN_COOKIE in response.cookies
+
+
+@pytest.mark.skipif(
+    make_url(SQLALCHEMY_DATABASE_URL).get_backend_name() != "sqlite",
+    reason="copies the SQLite database file to stand in for a lagging replica"
+)
+def test_pinned_clients_never_read_a_lagging_replica_through_the_cache(
+    client, create_user, monkeypatch, tmp_path
+):
+    _, author = create_user("author@example.com")
+    _, reader = create_user("reader@example.com")
+    post_id = client.post("/posts/", json={"title": "t", "content": "c"}, headers=author).json()["id"]
+
+    # The replica stops replicating before the vote below
+    replica_path = tmp_path / "replica.db"
+    primary = sqlite3.connect(make_url(SQLALCHEMY_DATABASE_URL).database)
+    with sqlite3.connect(replica_path) as replica:
+        primary.backup(replica)
+    primary.close()
+    router = ReplicaRouter(check_interval=5, read_your_writes_seconds=5, secret=b"secret")
+    router.add("replica1", create_async_engine(f"sqlite+aiosqlite:///{replica_path}"))
+    monkeypatch.setattr(replica_router, "replicas", router.replicas)
+
+    assert client.post("/vote", json={"post_id": post_id, "dir": 1}, headers=author).status_code == 201
+    assert client.get(f"/posts/{post_id}", headers=reader).json()["votes"] == 0
+    assert client.get(f"/posts/{post_id}", headers=author).json()["votes"] == 1
+
+    # An entry another worker has yet to evict is not served to the writer
+    response_cache.set(post_key(post_id), b"stale", {}, {post_tag(post_id)})
+    assert client.get(f"/posts/{post_id}", headers=author).json()["votes"] == 1
@@ -0,0 +1,69 @@
+'''test_serve.py'''
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+import pytest
+
+from app.broadcast import broadcast
+
+pytest.importorskip("uvicorn")
+pytestmark = pytest.mark.skipif(not hasattr(os, "fork"), reason="app.serve forks its workers")
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _get(url: str, timeout: float = 30):
+    '''Polls url until the server answers'''
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                return response.status
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+def test_supervisor_serves_and_shuts_down(client):
+    port = _free_port()
+    supervisor = subprocess.Popen(
+        [sys.executable, "-m", "app.serve", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", "1", "--max-requests", "2", "--max-requests-jitter", "0"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True
+    )
+    try:
+        # Enough requests for the worker to reach max_requests and be replaced
+        for _ in range(6):
+            assert _get(f"http://127.0.0.1:{port}/") == 200
+    finally:
+        supervisor.send_signal(signal.SIGTERM)
+        try:
+            code = supervisor.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            os.killpg(supervisor.pid, signal.SIGKILL)
+            raise
+    assert code == 0
+
+
+@pytest.mark.skipif(broadcast.shared, reason="PostgreSQL keeps worker caches in step")
+def test_workers_without_postgres_are_refused(client):
+    result = subprocess.run(
+        [sys.executable, "-m", "app.serve", "--port", str(_free_port()), "--workers", "2"],
+        capture_output=True,
+        text=True,
+        timeout=60
+    )
+    assert result.returncode == 2
+    assert "--workers 1" in result.stderr
@@ -0,0 +1,81 @@
+'''test_users.py'''
+from app import models
+from app.database import SessionLocal
+
+
+def _post_ids(response):
+    return [item["Post"]["id"] for item in response.json()]
+
+
+def test_delete_voter_decrements_vote_count(client, create_user):
+    _, author = create_user("author@example.com")
+    voter_id, voter = create_user("voter@example.com")
+    post_id = client.post("/posts/", json={"title": "t", "content": "c"}, headers=author).json()["id"]
+    assert client.post("/vote", json={"post_id": post_id, "dir": 1}, headers=voter).status_code == 201
+    assert client.get(f"/posts/{post_id}", headers=author).json()["votes"] == 1
+
+    assert client.delete(f"/users/{voter_id}", headers=voter).status_code == 204
+    assert client.get(f"/posts/{post_id}", headers=author).json()["votes"] == 0
+
+
+def test_delete_author_drops_cached_posts(client, create_user):
+    author_id, author = create_user("author@example.com")
+    _, reader = create_user("reader@example.com")
+    post_id = client.post("/posts/", json={"title": "gone", "content": "c"}, headers=author).json()["id"]
+    assert client.get(f"/posts/{post_id}", headers=reader).status_code == 200
+    assert _post_ids(client.get("/posts/", headers=reader)) == [post_id]
+    assert _post_ids(client.get("/posts/?search=gone", headers=reader)) == [post_id]
+
+    assert client.delete(f"/users/{author_id}", headers=author).status_code == 204
+    assert client.get(f"/posts/{post_id}", headers=reader).status_code == 404
+    assert _post_ids(client.get("/posts/", headers=reader)) == []
+    assert _post_ids(client.get("/posts/?search=gone", headers=reader)) == []
+
+
+def test_login_after_password_update(client, create_user):
+    user_id, headers = create_user("user@example.com", "old password")
+    response = client.put(
+        f"/users/{user_id}",
+        json={"email": "user@example.com", "password": "new password"},
+        headers=headers
+    )
+    assert response.status_code == 202
+    login = {"username": "user@example.com"}
+    assert client.post("/login", data={**login, "password": "new password"}).status_code == 200
+    assert client.post("/login", data={**login, "password": "old password"}).status_code == 403
+
+
+def test_delete_author_drops_trending_posts(client, create_user):
+    author_id, author = create_user("author@example.com")
+    _, reader = create_user("reader@example.com")
+    post_id = client.post("/posts/", json={"title": "t", "content": "c"}, headers=author).json()["id"]
+    assert post_id in _post_ids(client.get("/posts/trending", headers=reader))
+
+    assert client.delete(f"/users/{author_id}", headers=author).status_code == 204
+    assert post_id not in _post_ids(client.get("/posts/trending", headers=reader))
+
+
+def test_delete_user_cascades_to_their_rows(client, create_user):
+    author_id, author = create_user("author@example.com")
+    _, voter = create_user("voter@example.com")
+    post_id = client.post("/posts/", json={"title": "t", "content": "c"}, headers=author).json()["id"]
+    assert client.post("/vote", json={"post_id": post_id, "dir": 1}, headers=author).status_code == 201
+    assert client.post("/vote", json={"post_id": post_id, "dir": 1}, headers=voter).status_code == 201
+
+    assert client.delete(f"/users/{author_id}", headers=author).status_code == 204
+    with SessionLocal() as db:
+        assert db.query(models.Post).count() == 0
+        assert db.query(models.Vote).count() == 0
+        assert db.query(models.RefreshToken).filter_by(user_id=author_id).count() == 0
+
+
+def test_update_to_a_taken_email_conflicts(client, create_user):
+    user_id, headers = create_user("user@example.com")
+    create_user("taken@example.com")
+    response = client.put(
+        f"/users/{user_id}",
+        json={"email": "taken@example.com", "password": "password"},
+        headers=headers
+    )
+    assert response.status_code == 409
+    assert client.get(f"/users/{user_id}", headers=headers).json()["email"] == "user@example.com"
@@ -0,0 +1,58 @@
+'''test_votes.py'''
+
+
+def _batch(client, headers, *votes):
+    response = client.post(
+        "/vote/batch",
+        json={"votes": [{"post_id": post_id, "dir": dir} for post_id, dir in votes]},
+        headers=headers
+    )
+    assert response.status_code == 200
+    return [(item["post_id"], item["status"]) for item in response.json()["results"]]
+
+
+def _votes(client, headers, post_id):
+    return client.get(f"/posts/{post_id}", headers=headers).json()["votes"]
+
+
+def test_batch_reports_each_outcome(client, create_user):
+    _, author = create_user("author@example.com")
+    _, voter = create_user("voter@example.com")
+    up, down, kept, unvoted = (
+        client.post("/posts/", json={"title": f"t{i}", "content": "c"}, headers=author).json()["id"]
+        for i in range(4)
+    )
+    assert _batch(client, voter, (down, 1), (kept, 1)) == [(down, "voted"), (kept, "voted")]
+
+    missing = unvoted + 1000
+    assert _batch(client, voter, (up, 1), (down, 0), (kept, 1), (unvoted, 0), (missing, 1)) == [
+        (up, "voted"),
+        (down, "deleted"),
+        (kept, "already_voted"),
+        (unvoted, "not_voted"),
+        (missing, "post_not_found"),
+    ]
+    assert [_votes(client, author, id) for id in (up, down, kept, unvoted)] == [1, 0, 1, 0]
+
+
+def test_batch_counts_every_voter(client, create_user):
+    _, author = create_user("author@example.com")
+    post_id = client.post("/posts/", json={"title": "t", "content": "c"}, headers=author).json()["id"]
+    voters = [create_user(f"voter{i}@example.com")[1] for i in range(3)]
+    for voter in voters:
+        assert _batch(client, voter, (post_id, 1)) == [(post_id, "voted")]
+    assert _votes(client, author, post_id) == 3
+    assert _batch(client, voters[0], (post_id, 0)) == [(post_id, "deleted")]
+    assert _votes(client, author, post_id) == 2
+
+
+def test_batch_rejects_repeated_posts(client, create_user):
+    _, author = create_user("author@example.com")
+    post_id = client.post("/posts/", json={"title": "t", "content": "c"}, headers=author).json()["id"]
+    response = client.post(
+        "/vote/batch",
+        json={"votes": [{"post_id": post_id, "dir": 1}, {"post_id": post_id, "dir": 0}]},
+        headers=author
+    )
+    assert response.status_code == 422
+    assert _votes(client, author, post_id) == 0